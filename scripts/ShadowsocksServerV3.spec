@@ -30,14 +30,35 @@ a = Analysis(
         'shadowsocks_server_ui',
         'shadowsocks_server_ui.server',
         'shadowsocks_server_ui.tcprelay_ext',
+        'shadowsocks_server_ui.loop_tasks',
+        'shadowsocks_server_ui.sockopts',
+        'shadowsocks_server_ui.acl',
+        'shadowsocks_server_ui.replay',
+        'shadowsocks_server_ui.scheduler',
+        'shadowsocks_server_ui.crypto_offload',
+        'shadowsocks_server_ui.relay_loop',
+        'shadowsocks_server_ui.trace',
+        'shadowsocks_server_ui.handover',
+        'shadowsocks_server_ui.upstream',
+        'shadowsocks_server_ui.web.federation',
+        'shadowsocks_server_ui.tcpinfo',
+        'shadowsocks_server_ui.monitor',
+        'shadowsocks_server_ui.profiling',
+        'shadowsocks_server_ui.headless',
         'shadowsocks_server_ui.config',
         'shadowsocks_server_ui.config.manager',
         'shadowsocks_server_ui.config.defaults',
         'shadowsocks_server_ui.stats',
         'shadowsocks_server_ui.stats.collector',
+        'shadowsocks_server_ui.stats.geoip',
+        'shadowsocks_server_ui.stats.store',
+        'shadowsocks_server_ui.stats.targets',
+        'shadowsocks_server_ui.stats.histogram',
         'shadowsocks_server_ui.web',
         'shadowsocks_server_ui.web.app',
+        'shadowsocks_server_ui.web.serving',
         'flask',
+        'waitress',
         'flask.helpers',
         'flask.templating',
         'jinja2',
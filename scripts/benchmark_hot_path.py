@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hot path micro-benchmarks - per-write statistics and stats reads, no sockets
+Usage: python benchmark_hot_path.py [--quick] [--save] [--check --threshold 20]
+
+Times the code every relayed chunk goes through, in isolation:
+TCPRelayHandlerExt._write_to_sock -> TCPRelayExt._stats_wrapper ->
+RelayLoop._stats_callback -> StatsCollector (or StatsShard) add_bytes_*,
+driven by synthetic handlers whose sockets accept every write. Also times
+get_stats / list_clients / snapshot_totals on large client and target maps,
+and the write path while a reader thread polls get_stats, to show what the
+dashboard costs the relay through the collector lock.
+
+Results are compared with the stored baseline (scripts/baselines/hot_path.json)
+and printed as percent changes; --save replaces the baseline, --check exits
+with status 1 when a benchmark got slower than --threshold percent.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import threading
+import statistics
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'hot_path.json')
+CHUNK = b'\0' * 16384
+# (clients, targets per client): one active connection per client and target
+SIZES = [(10, 10), (1000, 10), (10000, 10)]
+QUICK_SIZES = SIZES[:2]
+
+
+class FakeSocket:
+    """Socket stand-in that takes every write in full"""
+
+    def send(self, data):
+        return len(data)
+
+
+def build_collector(clients, targets):
+    """
+    Create a collector with clients x targets active connections and some traffic
+
+    Returns:
+        tuple: (collector, [(connection_id, client_ip, target_addr)])
+    """
+    from shadowsocks_server_ui.stats.collector import StatsCollector
+
+    collector = StatsCollector()
+    connections = []
+    connection_id = 0
+    for client in range(clients):
+        client_ip = f"10.{client >> 16 & 255}.{client >> 8 & 255}.{client & 255}"
+        for target in range(targets):
+            connection_id += 1
+            target_addr = f"www.site{target}.example.com:443"
+            collector.add_connection(connection_id, client_ip)
+            collector.update_target_addr(connection_id, target_addr)
+            collector.add_bytes_sent(connection_id * 7 % 5000, connection_id)
+            collector.add_bytes_received(connection_id * 13 % 500000, connection_id)
+            connections.append((connection_id, client_ip, target_addr))
+    return collector, connections
+
+
+def build_handlers(stats, connections, count=1024):
+    """
+    Create stream-stage handlers wired to stats like a relay loop wires them
+
+    Args:
+        stats: StatsCollector or StatsShard the loop writes to
+        connections: (connection_id, client_ip, target_addr) to spread the handlers over
+    """
+    from shadowsocks import tcprelay
+    from shadowsocks_server_ui.relay_loop import RelayLoop
+    from shadowsocks_server_ui.tcprelay_ext import TCPRelayExt, TCPRelayHandlerExt, ConnectionTimings
+
+    loop = RelayLoop(None, 0, 1, stats)
+    relay = TCPRelayExt.__new__(TCPRelayExt)
+    relay.stats_callback = loop._stats_callback
+    step = max(1, len(connections) // count)
+    handlers = []
+    for connection_id, client_ip, target_addr in connections[::step][:count]:
+        # Only what _write_to_sock reads, the parent's __init__ would open sockets
+        handler = TCPRelayHandlerExt.__new__(TCPRelayHandlerExt)
+        handler.connection_id = connection_id
+        handler.stats_callback = relay._stats_wrapper
+        handler.bytes_sent = handler.bytes_received = 0
+        handler.timings = ConnectionTimings()
+        handler.client_ip = client_ip
+        host, port = target_addr.rsplit(':', 1)
+        handler._remote_address = (host, int(port))
+        handler.target_addr = target_addr
+        handler._pending_local = handler._pending_remote = None
+        handler._remote_paused = False
+        handler._crypto_jobs = None
+        handler._trace = None
+        handler._upstream_counters = None
+        handler._stage = tcprelay.STAGE_STREAM
+        handler._upstream_status = handler._downstream_status = tcprelay.WAIT_STATUS_READING
+        handler._local_sock = FakeSocket()
+        handler._remote_sock = FakeSocket()
+        handlers.append(handler)
+    return handlers
+
+
+def measure(operation, ops, repeat):
+    """
+    Time `repeat` runs of operation() (which performs `ops` operations)
+
+    Returns:
+        dict: {'min_ns': ..., 'median_ns': ...} per operation
+    """
+    operation()  # Warm up
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            operation()
+            samples.append((time.perf_counter_ns() - start) / ops)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {'min_ns': round(min(samples), 1), 'median_ns': round(statistics.median(samples), 1)}
+
+
+def write_loop(handlers, writes):
+    """Return a function making `writes` writes spread over the handlers, both directions"""
+    pairs = [(handler._write_to_sock, handler._local_sock, handler._remote_sock) for handler in handlers]
+    rounds = max(1, writes // (2 * len(pairs)))
+
+    def run():
+        for _ in range(rounds):
+            for write, local_sock, remote_sock in pairs:
+                write(CHUNK, local_sock)
+                write(CHUNK, remote_sock)
+    return run, rounds * 2 * len(pairs)
+
+
+def bench_write_path(results, size, repeat, writes):
+    """Handler write -> loop callback -> collector, and -> shard of an extra loop"""
+    collector, connections = build_collector(*size)
+    label = f"{size[0]}x{size[1]}"
+    run, ops = write_loop(build_handlers(collector, connections), writes)
+    results[f"write_path/{label}"] = measure(run, ops, repeat)
+
+    shard = collector.add_shard()
+    run, ops = write_loop(build_handlers(shard, connections), writes)
+    results[f"write_path_shard/{label}"] = measure(run, ops, repeat)
+    results[f"write_path_shard_merged/{label}"] = measure(lambda: (run(), collector.merge_shards()), ops, repeat)
+    collector.remove_shard(shard)
+
+    ids = [connection[0] for connection in connections[::max(1, len(connections) // 1024)][:1024]]
+    rounds = max(1, writes // (2 * len(ids)))
+
+    def direct():
+        add_sent = collector.add_bytes_sent
+        add_received = collector.add_bytes_received
+        for _ in range(rounds):
+            for connection_id in ids:
+                add_received(16384, connection_id)
+                add_sent(16384, connection_id)
+    results[f"collector_add_bytes/{label}"] = measure(direct, rounds * 2 * len(ids), repeat)
+    return collector, connections
+
+
+def bench_reads(results, collector, size, repeat):
+    """Dashboard and API reads over the full maps"""
+    label = f"{size[0]}x{size[1]}"
+    # Big maps take long per call, fewer repeats keep the run short
+    reads = max(3, repeat // (1 + size[0] * size[1] // 10000))
+    results[f"get_stats_all/{label}"] = measure(collector.get_stats, 1, reads)
+    results[f"get_stats_top/{label}"] = measure(
+        lambda: collector.get_stats(max_clients=100, max_targets=20), 1, reads)
+    results[f"list_clients/{label}"] = measure(lambda: collector.list_clients(limit=50), 1, reads)
+    results[f"snapshot_totals/{label}"] = measure(collector.snapshot_totals, 1, reads)
+
+
+def bench_contention(results, collector, connections, size, repeat, writes):
+    """Write path while a reader thread polls get_stats, as often as it can and at 10 Hz"""
+    label = f"{size[0]}x{size[1]}"
+    run, ops = write_loop(build_handlers(collector, connections), writes)
+    for mode, interval in (('busy', 0), ('10hz', 0.1)):
+        stop = threading.Event()
+        polls = []
+
+        def reader():
+            while not stop.is_set():
+                collector.get_stats(max_clients=100, max_targets=20)
+                polls.append(1)
+                if interval:
+                    stop.wait(interval)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            start = time.monotonic()
+            result = measure(run, ops, repeat)
+            result['reader_polls_per_s'] = round(len(polls) / (time.monotonic() - start), 1)
+        finally:
+            stop.set()
+            thread.join()
+        results[f"write_path_polled_{mode}/{label}"] = result
+
+
+def compare(results, baseline, threshold):
+    """Print results next to the baseline, returns names that regressed past threshold percent"""
+    regressed = []
+    width = max(len(name) for name in results)
+    print(f"{'benchmark':{width}}  {'min ns/op':>12}  {'median':>12}  {'vs baseline':>12}")
+    for name, result in results.items():
+        line = f"{name:{width}}  {result['min_ns']:12.1f}  {result['median_ns']:12.1f}"
+        old = baseline.get(name)
+        if old:
+            # Minimum is the least noisy estimate of the code's own cost
+            change = (result['min_ns'] - old['min_ns']) / old['min_ns'] * 100
+            line += f"  {change:+11.1f}%"
+            if change > threshold:
+                regressed.append(name)
+                line += '  REGRESSION'
+        if 'reader_polls_per_s' in result:
+            line += f"  ({result['reader_polls_per_s']} polls/s)"
+        print(line)
+    return regressed
+
+
+def machine_info():
+    """Describe where the numbers were taken, baselines only compare on the same machine"""
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark the statistics hot path')
+    parser.add_argument('--quick', action='store_true', help='Skip the largest map size')
+    parser.add_argument('--repeat', type=int, default=15, help='Timed runs per benchmark')
+    parser.add_argument('--writes', type=int, default=20000, help='Writes per timed run')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 on a regression')
+    parser.add_argument('--threshold', type=float, default=20, help='Regression threshold in percent')
+    args = parser.parse_args()
+
+    results = {}
+    for size in (QUICK_SIZES if args.quick else SIZES):
+        collector, connections = bench_write_path(results, size, args.repeat, args.writes)
+        bench_reads(results, collector, size, args.repeat)
+        bench_contention(results, collector, connections, size, args.repeat, args.writes)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored['results']
+        if stored.get('machine') != machine_info():
+            print(f"Baseline taken on another machine or Python ({stored.get('machine')}), "
+                  f"changes are only indicative")
+    regressed = compare(results, baseline, args.threshold)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine_info(), 'results': dict(baseline, **results)}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline saved to {args.baseline}")
+    if regressed:
+        print(f"{len(regressed)} benchmarks slower than the baseline by more than {args.threshold}%")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
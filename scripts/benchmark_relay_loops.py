@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Relay loop scaling benchmark - download throughput for different relay_loops values
+Usage: python benchmark_relay_loops.py [--loops 1,2,4] [--python python3.13t]
+
+Runs the relay in a subprocess (optionally under another interpreter, e.g. a
+free-threaded python3.13t) for each loop count, with a local target streaming
+data and client processes reading through the relay. Clients only count the
+encrypted bytes they receive, so the relay's cipher and event loop work is
+what limits throughput. Compare runs of the same interpreter with and without
+the GIL to see how far the loops scale on the machine's cores.
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import selectors
+import threading
+import subprocess
+import multiprocessing
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'benchmark'
+CHUNK = b'\0' * 65536
+
+
+def serve(loops, port, method):
+    """Run the relay until stdin closes (subprocess entry point)"""
+    from shadowsocks_server_ui.server import ShadowsocksServer
+    from shadowsocks_server_ui.config.defaults import DEFAULT_CONFIG
+
+    logging.disable(logging.ERROR)  # Clients closing mid-stream log broken pipes
+    config = dict(DEFAULT_CONFIG, server='127.0.0.1', server_port=port, password=PASSWORD,
+                  method=method, relay_loops=loops, max_connections=100000,
+                  tcp_info_interval=0, loop_lag_probe_interval=0, replay_filter=False)
+    server = ShadowsocksServer(config, log_callback=lambda message: None)
+    if not server.start():
+        print("failed", flush=True)
+        sys.exit(1)
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print(f"ready {len(server.loops)} {'gil' if gil else 'nogil'}", flush=True)
+    sys.stdin.read()
+    server.stop()
+
+
+def start_target():
+    """Start a target that streams zeros to every connection until it closes"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+
+    def stream(conn):
+        try:
+            while True:
+                conn.sendall(CHUNK)
+        except OSError:
+            conn.close()
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=stream, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def run_client(port, target_port, method, connections, duration, results):
+    """Open connections through the relay and count bytes received for `duration` seconds"""
+    from shadowsocks import encrypt
+
+    header = b'\x01' + socket.inet_aton('127.0.0.1') + target_port.to_bytes(2, 'big')
+    selector = selectors.DefaultSelector()
+    for _ in range(connections):
+        conn = socket.create_connection(('127.0.0.1', port))
+        conn.sendall(encrypt.Encryptor(PASSWORD.encode(), method).encrypt(header))
+        conn.setblocking(False)
+        selector.register(conn, selectors.EVENT_READ)
+    received = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                received += len(key.fileobj.recv(262144))
+            except BlockingIOError:
+                pass
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    results.put(received)
+
+
+def measure(python, loops, port, target_port, method, clients, connections, duration):
+    """Start a relay with `loops` loops and measure aggregate download throughput"""
+    server = subprocess.Popen([python, os.path.abspath(__file__), '--serve', str(loops),
+                               '--port', str(port), '--method', method],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        status = server.stdout.readline().split()
+        if not status or status[0] != 'ready':
+            raise RuntimeError(f"relay failed to start with {loops} loops")
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_client,
+                                           args=(port, target_port, method, connections, duration, results))
+                   for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        received = sum(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        return int(status[1]), status[2], received * 8 / duration / 1000000
+    finally:
+        server.stdin.close()
+        server.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure relay throughput for different relay_loops values')
+    parser.add_argument('--loops', default='1,2,4', help='Comma-separated relay_loops values')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter running the relay')
+    parser.add_argument('--method', default='chacha20', help='Encryption method')
+    parser.add_argument('--clients', type=int, default=4, help='Client processes')
+    parser.add_argument('--connections', type=int, default=8, help='Connections per client process')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds per measurement')
+    parser.add_argument('--port', type=int, default=18391, help='Relay port on 127.0.0.1')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.port, args.method)
+        return
+
+    target_port = start_target()
+    print("=" * 60)
+    print(f"Relay interpreter: {args.python}")
+    print(f"CPUs: {os.cpu_count()}, method: {args.method}, "
+          f"{args.clients * args.connections} connections, {args.duration:.0f}s per run")
+    print("=" * 60)
+    baseline = None
+    for loops in [int(value) for value in args.loops.split(',')]:
+        started, gil, mbps = measure(args.python, loops, args.port, target_port, args.method,
+                                     args.clients, args.connections, args.duration)
+        baseline = baseline or mbps
+        print(f"relay_loops={loops:<3} (running {started}, {gil:5}) {mbps:9.1f} Mbit/s  "
+              f"x{mbps / baseline:.2f}")
+
+
+if __name__ == '__main__':
+    main()
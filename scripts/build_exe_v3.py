@@ -91,14 +91,35 @@ def build():
             '--hidden-import=shadowsocks_server_ui',
             '--hidden-import=shadowsocks_server_ui.server',
             '--hidden-import=shadowsocks_server_ui.tcprelay_ext',
+            '--hidden-import=shadowsocks_server_ui.loop_tasks',
+            '--hidden-import=shadowsocks_server_ui.sockopts',
+            '--hidden-import=shadowsocks_server_ui.acl',
+            '--hidden-import=shadowsocks_server_ui.replay',
+            '--hidden-import=shadowsocks_server_ui.scheduler',
+            '--hidden-import=shadowsocks_server_ui.crypto_offload',
+            '--hidden-import=shadowsocks_server_ui.relay_loop',
+            '--hidden-import=shadowsocks_server_ui.trace',
+            '--hidden-import=shadowsocks_server_ui.handover',
+            '--hidden-import=shadowsocks_server_ui.upstream',
+            '--hidden-import=shadowsocks_server_ui.web.federation',
+            '--hidden-import=shadowsocks_server_ui.tcpinfo',
+            '--hidden-import=shadowsocks_server_ui.monitor',
+            '--hidden-import=shadowsocks_server_ui.profiling',
+            '--hidden-import=shadowsocks_server_ui.headless',
             '--hidden-import=shadowsocks_server_ui.config',
             '--hidden-import=shadowsocks_server_ui.config.manager',
             '--hidden-import=shadowsocks_server_ui.config.defaults',
             '--hidden-import=shadowsocks_server_ui.stats',
             '--hidden-import=shadowsocks_server_ui.stats.collector',
+            '--hidden-import=shadowsocks_server_ui.stats.geoip',
+            '--hidden-import=shadowsocks_server_ui.stats.store',
+            '--hidden-import=shadowsocks_server_ui.stats.targets',
+            '--hidden-import=shadowsocks_server_ui.stats.histogram',
             '--hidden-import=shadowsocks_server_ui.web',
             '--hidden-import=shadowsocks_server_ui.web.app',
+            '--hidden-import=shadowsocks_server_ui.web.serving',
             '--hidden-import=flask',
+            '--hidden-import=waitress',
             '--hidden-import=jinja2',
             '--collect-all=shadowsocks',    # Collect all shadowsocks related files
             '--collect-all=flask',          # Collect all Flask related files
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stats federation on loopback - several instances, one aggregator
+Usage: python federation_local.py [--nodes 3] [--connections 4]
+
+Starts `--nodes` instances in this process, each with its own relay and web
+interface on 127.0.0.1, pushes traffic through every relay to a local echo
+target and lets the first instance pull the others' stats. Prints the fleet
+status and top clients and checks the merged totals against the sum of the
+nodes' own collectors.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'federation'
+METHOD = 'aes-256-cfb'
+
+
+def start_echo():
+    """Start a target echoing everything back"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def start_node(index, relay_port, web_port, peers, interval, workdir):
+    """Start one instance: relay plus web interface on its own ports"""
+    from shadowsocks_server_ui.web.app import WebApp
+    from shadowsocks_server_ui.web.serving import BoundedWSGIServer
+    from shadowsocks_server_ui.server import ShadowsocksServer
+
+    config_file = os.path.join(workdir, f"node{index}.json")
+    with open(config_file, 'w') as f:
+        json.dump({'server': '127.0.0.1', 'server_port': relay_port, 'password': PASSWORD,
+                   'method': METHOD, 'stats_db': '', 'federation_peers': peers,
+                   'federation_interval': interval}, f)
+    web = WebApp(host='127.0.0.1', port=web_port, config_file=config_file)
+    config = web.config_manager.load()
+    web.server = ShadowsocksServer(config, stats_collector=web.stats_collector,
+                                   log_callback=lambda message: None)
+    if not web.server.start():
+        raise RuntimeError(f"node {index}: relay failed to start on port {relay_port}")
+    http_server = BoundedWSGIServer('127.0.0.1', web_port, web.app)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    web._configure_federation(config)
+    return web, http_server
+
+
+def push_traffic(relay_port, echo_port, size, connections):
+    """Send `size` bytes through the relay on each connection and read the echo"""
+    from shadowsocks import encrypt
+
+    header = b'\x01' + socket.inet_aton('127.0.0.1') + echo_port.to_bytes(2, 'big')
+    for _ in range(connections):
+        encryptor = encrypt.Encryptor(PASSWORD.encode(), METHOD)
+        with socket.create_connection(('127.0.0.1', relay_port)) as conn:
+            conn.sendall(encryptor.encrypt(header + b'x' * size))
+            received = b''
+            while len(received) < size:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                received += encryptor.decrypt(data)
+
+
+def get_json(port, path):
+    """GET a JSON endpoint of a local web interface"""
+    import urllib.request
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run several instances on loopback and federate their stats')
+    parser.add_argument('--nodes', type=int, default=3, help='Instances to start')
+    parser.add_argument('--connections', type=int, default=4, help='Connections per node')
+    parser.add_argument('--size', type=int, default=100000, help='Bytes sent per connection')
+    parser.add_argument('--relay-port', type=int, default=18400, help='First relay port')
+    parser.add_argument('--web-port', type=int, default=18500, help='First web port')
+    args = parser.parse_args()
+
+    echo_port = start_echo()
+    workdir = tempfile.mkdtemp(prefix='federation-')
+    peers = [f"http://127.0.0.1:{args.web_port + index}" for index in range(1, args.nodes)]
+    nodes = []
+    try:
+        # Only the first instance aggregates, start it last so its peers are up
+        for index in reversed(range(args.nodes)):
+            nodes.insert(0, start_node(index, args.relay_port + index, args.web_port + index,
+                                       peers if index == 0 else [], 1, workdir))
+        for index in range(args.nodes):
+            push_traffic(args.relay_port + index, echo_port, args.size * (index + 1), args.connections)
+        time.sleep(1.5)  # Let the relays account the closed connections and snapshots expire
+        aggregator = nodes[0][0]
+        aggregator.federation.pull_all()
+
+        status = get_json(args.web_port, '/api/federation/status')
+        print("=" * 60)
+        print(f"{len(status['nodes'])} nodes, {status['fleet']['nodes_up']} up")
+        for node in status['nodes']:
+            print(f"  {node['url']:28} up={node['up']!s:5} latency={node['latency_ms']}ms "
+                  f"sent={node['bytes_sent']} received={node['bytes_received']}")
+        fleet = status['fleet']
+        print(f"fleet: {fleet['total_connections']} connections, sent={fleet['bytes_sent']} "
+              f"received={fleet['bytes_received']}")
+        for client in get_json(args.web_port, '/api/federation/clients?limit=5')['items']:
+            print(f"  client {client['client_ip']:16} {client['total_bytes']} bytes on {client['nodes']} nodes")
+
+        expected = {key: sum(web.stats_collector.get_stats()[key] for web, _ in nodes)
+                    for key in ('total_connections', 'bytes_sent', 'bytes_received')}
+        merged = {key: fleet[key] for key in expected}
+        print("totals match" if merged == expected else f"MISMATCH: merged {merged}, expected {expected}")
+        print("=" * 60)
+        if merged != expected:
+            sys.exit(1)
+    finally:
+        for web, http_server in nodes:
+            http_server.shutdown()
+            web.stop()
+
+
+if __name__ == '__main__':
+    main()
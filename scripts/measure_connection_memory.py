@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-connection memory measurement - opens idle connections through a local relay
+Usage: python measure_connection_memory.py [--connections 1000] [--method chacha20]
+
+Starts the relay in-process with a local target, opens connections that each
+send one request and then stay idle, and reports the Python heap growth per
+connection (tracemalloc) with the largest allocation sites. Kernel socket
+memory is not included.
+"""
+
+import os
+import sys
+import gc
+import time
+import socket
+import argparse
+import threading
+import tracemalloc
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shadowsocks import encrypt  # noqa: E402
+from shadowsocks_server_ui.server import ShadowsocksServer  # noqa: E402
+from shadowsocks_server_ui.config.defaults import DEFAULT_CONFIG  # noqa: E402
+
+PASSWORD = 'measure'
+WARMUP_CONNECTIONS = 20
+
+
+def start_target():
+    """Start a target that answers the first request of each connection, then idles"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(4096)
+    accepted = []
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            accepted.append(conn)  # Keep it open
+            conn.recv(1024)
+            conn.sendall(b'ok')
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def open_idle_connections(count, server_port, target_port, method):
+    """Open connections that complete one round trip and stay open"""
+    header = b'\x01' + socket.inet_aton('127.0.0.1') + target_port.to_bytes(2, 'big')
+    connections = []
+    for _ in range(count):
+        encryptor = encrypt.Encryptor(PASSWORD.encode(), method)
+        conn = socket.create_connection(('127.0.0.1', server_port))
+        conn.sendall(encryptor.encrypt(header + b'ping'))
+        conn.recv(1024)
+        connections.append(conn)
+    return connections
+
+
+def raise_fd_limit(count):
+    """Each connection needs three descriptors in this process (client, relay x2) plus the target's"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = count * 4 + 256
+        if soft < wanted:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def measure(count, method, port, top):
+    """Run the measurement and print the report"""
+    raise_fd_limit(count)
+    target_port = start_target()
+    config = dict(DEFAULT_CONFIG, server='127.0.0.1', server_port=port, password=PASSWORD,
+                  # The limit is checked against open sockets, two per streaming connection
+                  method=method, max_connections=(count + WARMUP_CONNECTIONS) * 2 + 10,
+                  tcp_info_interval=0, loop_lag_probe_interval=0)
+    server = ShadowsocksServer(config, log_callback=lambda message: None)
+    if not server.start():
+        print("[ERROR] Failed to start server")
+        sys.exit(1)
+    try:
+        time.sleep(0.3)
+        # Warm up lazily created module state (cipher libraries, buffers)
+        clients = open_idle_connections(WARMUP_CONNECTIONS, port, target_port, method)
+        time.sleep(0.3)
+        gc.collect()
+        tracemalloc.start(1)
+        before = tracemalloc.take_snapshot()
+        clients += open_idle_connections(count, port, target_port, method)
+        time.sleep(0.5)  # Let the loop finish handling the last round trips
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        differences = after.compare_to(before, 'lineno')
+        total = sum(difference.size_diff for difference in differences)
+        print("=" * 60)
+        print(f"Method: {method}, idle connections: {count}")
+        print(f"Python heap per connection: {total / count:.0f} bytes")
+        print("=" * 60)
+        print("Largest allocation sites (bytes per connection):")
+        for difference in differences[:top]:
+            frame = difference.traceback[0]
+            print(f"  {difference.size_diff / count:7.0f}  {os.path.basename(frame.filename)}:{frame.lineno}")
+        for conn in clients:
+            conn.close()
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure relay memory per idle connection')
+    parser.add_argument('--connections', type=int, default=1000, help='Idle connections to open')
+    parser.add_argument('--method', default='chacha20', help='Encryption method')
+    parser.add_argument('--port', type=int, default=18390, help='Relay port on 127.0.0.1')
+    parser.add_argument('--top', type=int, default=15, help='Allocation sites to list')
+    args = parser.parse_args()
+    measure(args.connections, args.method, args.port, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Connection trace replay - drives a local relay with the traffic pattern of a recorded trace
+Usage: python replay_trace.py TRACE [--speed 10] [--limit 1000] [--summary]
+
+Record a trace by setting trace_file on a running server. Replay starts a
+relay in a subprocess and a synthetic target in this process, then opens
+every traced connection at its recorded start time (divided by --speed).
+The client side sends the recorded upstream chunks and the target the
+recorded downstream chunks, each at its recorded offset, and a chunk also
+waits for the bytes that preceded it from the other side, so request and
+response order is kept when the relay is slower than the original. Payload
+is zeros. The target identifies a connection by a 4-byte index in front of
+its first upstream bytes.
+"""
+
+import os
+import sys
+import time
+import heapq
+import socket
+import argparse
+import selectors
+import subprocess
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'replay'
+GRACE = 30.0  # Seconds past its lifetime a connection may run before it counts as failed
+
+
+def serve(port, method, loops):
+    """Run the relay until stdin closes (subprocess entry point)"""
+    import logging
+    from shadowsocks_server_ui.server import ShadowsocksServer
+    from shadowsocks_server_ui.config.defaults import DEFAULT_CONFIG
+
+    logging.disable(logging.ERROR)  # Closing connections log broken pipes
+    config = dict(DEFAULT_CONFIG, server='127.0.0.1', server_port=port, password=PASSWORD,
+                  method=method, relay_loops=loops, max_connections=100000, replay_filter=False)
+    server = ShadowsocksServer(config, log_callback=lambda message: None)
+    if not server.start():
+        print("failed", flush=True)
+        sys.exit(1)
+    print("ready", flush=True)
+    sys.stdin.read()
+    server.stop()
+
+
+def percentile(values, fraction):
+    """Get a percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Peer:
+    """One side (client or target) of a replayed connection"""
+
+    def __init__(self, conn, events):
+        self.conn = conn
+        self.sock = None
+        self.events = events  # [(seconds since start, bytes, peer bytes needed first)]
+        self.next = 0
+        self.received = 0  # Payload bytes received from the other side
+        self.out = bytearray()
+        self.timer = None  # Time of the pending wake-up, if any
+        self.closed = False
+
+
+class Connection:
+    """A traced connection being replayed"""
+
+    def __init__(self, index, record, speed):
+        self.index = index
+        self.start = record.start
+        self.lifetime = record.lifetime / speed
+        up, down = [], []
+        up_bytes = down_bytes = 0
+        for offset, direction, size in record.events:
+            if direction == 0:
+                up.append((offset / speed, size, down_bytes))
+                up_bytes += size
+            else:
+                down.append((offset / speed, size, up_bytes))
+                down_bytes += size
+        self.up_bytes = up_bytes
+        self.down_bytes = down_bytes
+        self.client = Peer(self, up)
+        self.target = Peer(self, down)
+        self.started = None
+        self.encryptor = None
+        self.failed = False
+        self.done = False
+
+
+class Replayer:
+    """Single-threaded driver for clients and the synthetic target"""
+
+    def __init__(self, connections, relay_port, method, trace_start, speed):
+        self.connections = connections
+        self.relay_port = relay_port
+        self.method = method
+        self.trace_start = trace_start
+        self.speed = speed
+        self.selector = selectors.DefaultSelector()
+        self.timers = []  # (when, sequence, callback, argument)
+        self.sequence = 0
+        self.pending_targets = {}  # Accepted target socket -> received bytes before the index
+        self.lags = []  # Seconds each chunk went out after its scheduled time
+        self.sent = [0, 0]
+        self.open_count = 0
+        self.peak_open = 0
+        self.finished = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(4096)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, ('accept', None))
+
+    def _at(self, when, callback, argument):
+        self.sequence += 1
+        heapq.heappush(self.timers, (when, self.sequence, callback, argument))
+
+    def run(self):
+        """Replay all connections, returns the wall time taken"""
+        self.begin = time.monotonic()
+        for conn in self.connections:
+            self._at(self.begin + (conn.start - self.trace_start) / self.speed, self._open, conn)
+        while self.finished < len(self.connections):
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback, argument = heapq.heappop(self.timers)
+                callback(argument)
+            timeout = max(0.0, self.timers[0][0] - time.monotonic()) if self.timers else 1.0
+            for key, mask in self.selector.select(min(timeout, 1.0)):
+                kind, peer = key.data
+                if kind == 'accept':
+                    self._accept()
+                elif kind == 'identify':
+                    self._identify(key.fileobj)
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self._read(peer)
+                    if mask & selectors.EVENT_WRITE and not peer.closed:
+                        self._flush(peer)
+        return time.monotonic() - self.begin
+
+    def _open(self, conn):
+        """Connect a client through the relay and send the address header"""
+        from shadowsocks import encrypt
+
+        conn.started = time.monotonic()
+        conn.encryptor = encrypt.Encryptor(PASSWORD.encode(), self.method)
+        client = conn.client
+        client.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.sock.setblocking(False)
+        client.sock.connect_ex(('127.0.0.1', self.relay_port))
+        port = self.listener.getsockname()[1]
+        header = b'\x01' + socket.inet_aton('127.0.0.1') + port.to_bytes(2, 'big')
+        client.out += conn.encryptor.encrypt(header + conn.index.to_bytes(4, 'big'))
+        self.selector.register(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, ('peer', client))
+        self.open_count += 1
+        self.peak_open = max(self.peak_open, self.open_count)
+        self._at(conn.started + conn.lifetime + GRACE, self._expire, conn)
+        self._advance(client)
+
+    def _accept(self):
+        """Accept target connections, they are matched once their index arrives"""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            self.pending_targets[sock] = b''
+            self.selector.register(sock, selectors.EVENT_READ, ('identify', None))
+
+    def _identify(self, sock):
+        """Read the connection index in front of the first upstream bytes"""
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return
+        if not data:
+            self.selector.unregister(sock)
+            del self.pending_targets[sock]
+            sock.close()
+            return
+        data = self.pending_targets[sock] + data
+        if len(data) < 4:
+            self.pending_targets[sock] = data
+            return
+        del self.pending_targets[sock]
+        target = self.connections[int.from_bytes(data[:4], 'big')].target
+        target.sock = sock
+        self.selector.modify(sock, selectors.EVENT_READ, ('peer', target))
+        self._received(target, len(data) - 4)
+
+    def _read(self, peer):
+        """Read from one side; a closed socket ends that side"""
+        try:
+            data = peer.sock.recv(262144)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(peer)
+            return
+        if peer is peer.conn.client:
+            data = peer.conn.encryptor.decrypt(data)
+        self._received(peer, len(data))
+
+    def _received(self, peer, count):
+        peer.received += count
+        self._advance(peer)
+        self._check_done(peer.conn)
+
+    def _advance(self, peer):
+        """Send every chunk that is due and whose preceding peer bytes arrived"""
+        if peer.closed or peer.sock is None:
+            return
+        now = time.monotonic()
+        start = peer.conn.started
+        while peer.next < len(peer.events):
+            offset, size, needed = peer.events[peer.next]
+            if peer.received < needed:
+                break  # _received advances again
+            due = start + offset
+            if due > now:
+                if peer.timer is None or peer.timer > due:
+                    peer.timer = due
+                    self._at(due, self._wake, peer)
+                break
+            self.lags.append(now - due)
+            data = bytes(size)
+            if peer is peer.conn.client:
+                data = peer.conn.encryptor.encrypt(data)
+                self.sent[0] += size
+            else:
+                self.sent[1] += size
+            peer.out += data
+            peer.next += 1
+        self._flush(peer)
+
+    def _wake(self, peer):
+        peer.timer = None
+        self._advance(peer)
+        self._check_done(peer.conn)
+
+    def _flush(self, peer):
+        """Write queued bytes, wait for EVENT_WRITE if the socket is full"""
+        if peer.out:
+            try:
+                count = peer.sock.send(peer.out)
+                del peer.out[:count]
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                self._close(peer)
+                return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.out else 0)
+        if self.selector.get_key(peer.sock).events != events:
+            self.selector.modify(peer.sock, events, ('peer', peer))
+
+    def _check_done(self, conn):
+        """Close the client once everything was exchanged and its lifetime is over"""
+        client = conn.client
+        if client.closed or client.next < len(client.events) or client.out:
+            return
+        if client.received < conn.down_bytes or conn.target.received < conn.up_bytes:
+            return
+        end = conn.started + conn.lifetime
+        if time.monotonic() < end:
+            if client.timer is None:
+                client.timer = end
+                self._at(end, self._wake, client)
+            return
+        self._close(client)
+
+    def _close(self, peer):
+        """Close one side; the connection is done when the client side closes"""
+        if peer.closed or peer.sock is None:
+            return
+        peer.closed = True
+        self.selector.unregister(peer.sock)
+        peer.sock.close()
+        conn = peer.conn
+        if peer is conn.client:
+            if conn.client.received < conn.down_bytes or conn.target.received < conn.up_bytes:
+                conn.failed = True
+            self._finish(conn)
+
+    def _expire(self, conn):
+        """Give up on a connection that ran far past its lifetime"""
+        if not conn.done:
+            conn.failed = True
+            self._close(conn.client)
+            self._close(conn.target)
+            self._finish(conn)
+
+    def _finish(self, conn):
+        if not conn.done:
+            conn.done = True
+            self.open_count -= 1
+            self.finished += 1
+
+
+def summarize(records):
+    """Print what a trace contains"""
+    if not records:
+        print("Trace is empty")
+        return
+    start = min(record.start for record in records)
+    end = max(record.start + record.lifetime for record in records)
+    up = sum(size for record in records for _, direction, size in record.events if direction == 0)
+    down = sum(size for record in records for _, direction, size in record.events if direction == 1)
+    chunks = [size for record in records for _, _, size in record.events]
+    totals = sorted(sum(size for _, _, size in record.events) for record in records)
+    print(f"{len(records)} connections over {end - start:.1f}s "
+          f"({sum(record.truncated for record in records)} truncated)")
+    print(f"Bytes: {up} up, {down} down in {len(chunks)} chunks "
+          f"(median chunk {percentile(chunks, 0.5)} B, p99 {percentile(chunks, 0.99)} B)")
+    print(f"Bytes per connection: median {percentile(totals, 0.5)}, p99 {percentile(totals, 0.99)}, "
+          f"max {totals[-1]}")
+    lifetimes = [record.lifetime for record in records]
+    print(f"Lifetime: median {percentile(lifetimes, 0.5):.2f}s, p99 {percentile(lifetimes, 0.99):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a connection trace against a local relay')
+    parser.add_argument('trace', nargs='?', help='Trace file written by trace_file')
+    parser.add_argument('--speed', type=float, default=1.0, help='Time compression factor (10 = 10x faster)')
+    parser.add_argument('--limit', type=int, default=0, help='Replay only the first N connections')
+    parser.add_argument('--summary', action='store_true', help='Only print what the trace contains')
+    parser.add_argument('--method', default='aes-256-cfb', help='Encryption method')
+    parser.add_argument('--loops', type=int, default=1, help='relay_loops of the relay')
+    parser.add_argument('--port', type=int, default=18392, help='Relay port on 127.0.0.1')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.port, args.method, args.loops)
+        return
+    if not args.trace:
+        parser.error("a trace file is required")
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    from shadowsocks_server_ui.trace import read_trace
+
+    records = sorted(read_trace(args.trace), key=lambda record: record.start)
+    if args.limit:
+        records = records[:args.limit]
+    print("=" * 60)
+    summarize(records)
+    print("=" * 60)
+    if args.summary or not records:
+        return
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', '--port', str(args.port),
+                               '--method', args.method, '--loops', str(args.loops)],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        if server.stdout.readline().strip() != 'ready':
+            raise RuntimeError("relay failed to start")
+        connections = [Connection(index, record, args.speed) for index, record in enumerate(records)]
+        replayer = Replayer(connections, args.port, args.method, records[0].start, args.speed)
+        elapsed = replayer.run()
+    finally:
+        server.stdin.close()
+        server.wait(timeout=10)
+
+    failed = sum(conn.failed for conn in connections)
+    span = (max(record.start + record.lifetime for record in records) - records[0].start) / args.speed
+    print(f"Replayed {len(connections)} connections at {args.speed:g}x in {elapsed:.1f}s "
+          f"(trace span {span:.1f}s), {failed} failed, peak {replayer.peak_open} open")
+    print(f"Sent: {replayer.sent[0]} up, {replayer.sent[1]} down")
+    lags = replayer.lags
+    print(f"Chunk lag behind schedule: p50 {percentile(lags, 0.5) * 1000:.1f}ms, "
+          f"p99 {percentile(lags, 0.99) * 1000:.1f}ms, max {max(lags, default=0) * 1000:.1f}ms")
+    print("=" * 60)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Soak test - adversarial clients against a local relay, checking for leaks
+Usage: python soak_test.py [--duration 3600] [--round 30] [--workers 32]
+
+The relay runs in this process. Each round starts a client process that
+runs its own targets and mixes normal requests with slow readers, half-closed
+sockets, clients that never send a header or stop halfway through it, abrupt
+resets, garbage, refused and resetting targets, idle streams and reconnect
+storms. The client process then exits, closing whatever it still holds.
+
+While a round runs, the collector's active count must match its connection
+table. After each round, once the idle and connect timeouts have had time to
+fire, these must all be back at baseline: the process fd count, the relays'
+_fd_to_handlers and timeout tables, connection_times, active_connections,
+and closed_connections == total_connections. RSS may not grow more than
+--rss-slack-mb past its level after the first round. The first violation
+is printed with the handlers still alive, and the exit code is 1.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+from collections import Counter
+
+# Run from a source checkout without installing
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PASSWORD = 'soak'
+# Scenario -> relative weight
+SCENARIOS = {
+    'request': 30,
+    'slow_reader': 6,
+    'half_close': 6,
+    'no_header': 6,
+    'partial_header': 4,
+    'reset': 6,
+    'reset_download': 4,
+    'garbage': 4,
+    'storm': 2,
+    'refused_target': 4,
+    'silent_target': 3,
+    'target_reset': 4,
+    'idle_stream': 3,
+}
+
+
+# ---------------------------------------------------------------- client process
+
+def _listen(handler):
+    """Start a loopback target calling handler(conn) per connection on a thread"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=handler, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def _echo(conn):
+    try:
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+    except OSError:
+        pass
+    conn.close()
+
+
+def _source(conn):
+    """Stream zeros until the relay closes the connection"""
+    chunk = bytes(65536)
+    try:
+        while True:
+            conn.sendall(chunk)
+    except OSError:
+        pass
+    conn.close()
+
+
+def _silent(conn):
+    """Accept and never answer, until the relay gives up"""
+    try:
+        while conn.recv(65536):
+            pass
+    except OSError:
+        pass
+    conn.close()
+
+
+def _resetting(conn):
+    """Read a little, then reset the connection"""
+    try:
+        conn.recv(1024)
+    except OSError:
+        pass
+    _reset(conn)
+
+
+def _reset(sock):
+    """Close with RST instead of FIN"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    sock.close()
+
+
+class ClientContext:
+    """Targets and connection helpers of the client process"""
+
+    def __init__(self, relay_port, method, deadline):
+        self.relay_port = relay_port
+        self.method = method
+        self.deadline = deadline
+        self.ports = {
+            'echo': _listen(_echo),
+            'source': _listen(_source),
+            'silent': _listen(_silent),
+            'reset': _listen(_resetting),
+        }
+        unused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        unused.bind(('127.0.0.1', 0))
+        self.ports['refused'] = unused.getsockname()[1]
+        unused.close()  # Nothing listens there any more
+
+    def connect(self):
+        conn = socket.create_connection(('127.0.0.1', self.relay_port), timeout=5)
+        conn.settimeout(5)
+        return conn
+
+    def encryptor(self):
+        from shadowsocks import encrypt
+        return encrypt.Encryptor(PASSWORD.encode(), self.method)
+
+    def header(self, target):
+        return b'\x01' + socket.inet_aton('127.0.0.1') + self.ports[target].to_bytes(2, 'big')
+
+    def open_stream(self, target, payload=b''):
+        """Connect and send the address header (plus payload), returns (conn, encryptor)"""
+        conn = self.connect()
+        encryptor = self.encryptor()
+        conn.sendall(encryptor.encrypt(self.header(target) + payload))
+        return conn, encryptor
+
+    def read_until_eof(self, conn, limit=5.0):
+        end = time.monotonic() + limit
+        while time.monotonic() < end:
+            if not conn.recv(65536):
+                return
+
+    def hold(self, seconds):
+        """Sleep, but not past the end of the round"""
+        time.sleep(max(0.0, min(seconds, self.deadline - time.monotonic())))
+
+
+def scenario_request(ctx, rng):
+    size = rng.randint(1, 16384)
+    conn, encryptor = ctx.open_stream('echo', bytes(size))
+    received = 0
+    while received < size:
+        data = conn.recv(65536)
+        if not data:
+            raise ConnectionError("echo closed early")
+        received += len(encryptor.decrypt(data))
+    conn.close()
+
+
+def scenario_slow_reader(ctx, rng):
+    conn, _ = ctx.open_stream('source')
+    end = time.monotonic() + rng.uniform(0.2, 1.5)
+    while time.monotonic() < end:
+        conn.recv(4096)
+        time.sleep(0.02)
+    conn.close()  # Unread data makes this a reset
+
+
+def scenario_half_close(ctx, rng):
+    conn, _ = ctx.open_stream('echo', bytes(rng.randint(1, 4096)))
+    conn.shutdown(socket.SHUT_WR)
+    ctx.read_until_eof(conn)
+    conn.close()
+
+
+def scenario_no_header(ctx, rng):
+    conn = ctx.connect()
+    # Some give up, the rest wait for the connect timeout or the end of the round
+    ctx.hold(rng.uniform(0, 2) if rng.random() < 0.5 else ctx.deadline)
+    conn.close()
+
+
+def scenario_partial_header(ctx, rng):
+    conn = ctx.connect()
+    data = ctx.encryptor().encrypt(ctx.header('echo'))
+    conn.sendall(data[:rng.randint(1, len(data) - 1)])
+    ctx.hold(rng.uniform(0, 3))
+    conn.close()
+
+
+def scenario_reset(ctx, rng):
+    conn, _ = ctx.open_stream('echo', bytes(rng.randint(1, 8192)))
+    time.sleep(rng.uniform(0, 0.05))
+    _reset(conn)
+
+
+def scenario_reset_download(ctx, rng):
+    conn, _ = ctx.open_stream('source')
+    conn.recv(65536)
+    _reset(conn)
+
+
+def scenario_garbage(ctx, rng):
+    conn = ctx.connect()
+    conn.sendall(os.urandom(rng.randint(1, 512)))
+    ctx.hold(rng.uniform(0, 0.5))
+    conn.close()
+
+
+def scenario_storm(ctx, rng):
+    conns = []
+    for index in range(rng.randint(20, 100)):
+        try:
+            conn = ctx.connect()
+        except OSError:
+            break  # Backlog full is part of the storm
+        if index % 2:
+            conn.sendall(ctx.encryptor().encrypt(ctx.header('echo') + b'x'))
+        conns.append(conn)
+    for index, conn in enumerate(conns):
+        if index % 3 == 0:
+            _reset(conn)
+        else:
+            conn.close()
+
+
+def scenario_refused_target(ctx, rng):
+    conn, _ = ctx.open_stream('refused', b'hello')
+    ctx.read_until_eof(conn)
+    conn.close()
+
+
+def scenario_silent_target(ctx, rng):
+    conn, _ = ctx.open_stream('silent', b'hello')
+    ctx.hold(rng.uniform(0.1, 1.0))
+    conn.close()
+
+
+def scenario_target_reset(ctx, rng):
+    conn, _ = ctx.open_stream('reset', b'hello')
+    ctx.read_until_eof(conn)
+    conn.close()
+
+
+def scenario_idle_stream(ctx, rng):
+    conn, encryptor = ctx.open_stream('echo', b'ping')
+    encryptor.decrypt(conn.recv(1024))
+    # Idle until the relay's idle timeout closes it or the client process exits
+    conn.settimeout(max(0.1, ctx.deadline - time.monotonic()))
+    try:
+        ctx.read_until_eof(conn, limit=ctx.deadline - time.monotonic())
+    except socket.timeout:
+        pass
+    conn.close()
+
+
+def run_clients(relay_port, method, seconds, workers, seed):
+    """Client process: run random scenarios on worker threads for `seconds`"""
+    deadline = time.monotonic() + seconds
+    ctx = ClientContext(relay_port, method, deadline)
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name] for name in names]
+    functions = {name: globals()[f'scenario_{name}'] for name in names}
+    counts = Counter()
+    errors = Counter()
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            try:
+                functions[name](ctx, rng)
+                failed = False
+            except (OSError, ValueError):
+                failed = True  # Resets and timeouts are expected in this mix
+            with lock:
+                counts[name] += 1
+                errors[name] += failed
+
+    threads = [threading.Thread(target=worker, args=(index,), daemon=True) for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=max(0.0, deadline - time.monotonic()) + 5)
+    print(json.dumps({'counts': counts, 'errors': errors}), flush=True)
+    os._exit(0)  # Sockets still held are closed by the kernel
+
+
+# ---------------------------------------------------------------- relay process
+
+def count_fds():
+    """Open file descriptors of this process (Linux), None elsewhere"""
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def rss_mb():
+    """Resident set size in MB (Linux), None elsewhere"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576
+    except (OSError, ValueError):
+        return None
+
+
+def relay_state(server):
+    """Handler tables of every relay loop, read on the loop threads"""
+    def collect(loop):
+        relays = loop.get_relays()
+        return {
+            'handlers': {handler for relay in relays for handler in relay._fd_to_handlers.values()},
+            'fds': sum(len(relay._fd_to_handlers) for relay in relays),
+            'live': sum(len(relay._handlers) for relay in relays),
+            'timeouts': sum(len(relay._handler_to_timeouts) for relay in relays),
+        }
+    state = {'handlers': set(), 'fds': 0, 'live': 0, 'timeouts': 0}
+    for loop in server.loops:
+        result = loop.loop_tasks.call_and_wait(lambda loop=loop: collect(loop))
+        state['handlers'] |= result['handlers']
+        for key in ('fds', 'live', 'timeouts'):
+            state[key] += result[key]
+    return state
+
+
+def collector_state(collector):
+    """Connection table size and counters, consistent with each other"""
+    collector.merge_shards()
+    with collector.lock:
+        stats = collector.stats
+        return {
+            'table': len(collector.connection_times),
+            'active': stats['active_connections'],
+            'total': stats['total_connections'],
+            'closed': stats['closed_connections'],
+        }
+
+
+def describe_handler(handler):
+    """One line about a handler that should be gone"""
+    age = time.time() - handler._start_time
+    return (f"stage={handler._stage} client={handler.client_ip} target={handler.target_addr} "
+            f"age={age:.1f}s up={handler._upstream_status} down={handler._downstream_status}")
+
+
+def check_settled(server, base_fds):
+    """List what is not back at baseline (empty when settled)"""
+    problems = []
+    relays = relay_state(server)
+    stats = collector_state(server.stats_collector)
+    if relays['fds'] or relays['live'] or relays['timeouts']:
+        problems.append(f"relays still hold {relays['fds']} fds, {relays['live']} handlers, "
+                        f"{relays['timeouts']} timeout entries")
+    if stats['table'] or stats['active']:
+        problems.append(f"collector has {stats['table']} connections, active_connections={stats['active']}")
+    if stats['closed'] != stats['total']:
+        problems.append(f"closed_connections={stats['closed']} but total_connections={stats['total']}")
+    fds = count_fds()
+    if base_fds is not None and fds != base_fds:
+        problems.append(f"{fds} fds open, baseline {base_fds}")
+    return problems, relays, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak a local relay with adversarial clients and check for leaks')
+    parser.add_argument('--duration', type=float, default=600, help='Total seconds of client traffic')
+    parser.add_argument('--round', type=float, default=30, help='Seconds of traffic per round')
+    parser.add_argument('--workers', type=int, default=32, help='Concurrent client threads')
+    parser.add_argument('--method', default='aes-256-cfb', help='Encryption method')
+    parser.add_argument('--loops', type=int, default=1, help='relay_loops')
+    parser.add_argument('--offload', type=int, default=0, help='crypto_offload_threshold')
+    parser.add_argument('--egress-mbps', type=float, default=0, help='egress_rate_mbps (bandwidth scheduler)')
+    parser.add_argument('--idle-timeout', type=int, default=5, help='Relay idle timeout in seconds')
+    parser.add_argument('--rss-slack-mb', type=float, default=32, help='Allowed RSS growth after the first round')
+    parser.add_argument('--port', type=int, default=18393, help='Relay port on 127.0.0.1')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed of the first round')
+    parser.add_argument('--clients', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.clients:
+        run_clients(args.port, args.method, args.round, args.workers, args.seed)
+        return
+
+    import logging
+    from shadowsocks_server_ui.server import ShadowsocksServer
+    from shadowsocks_server_ui.config.defaults import DEFAULT_CONFIG
+
+    logging.disable(logging.ERROR)  # Every reset and bad header is logged by the library
+    config = dict(DEFAULT_CONFIG, server='127.0.0.1', server_port=args.port, password=PASSWORD,
+                  method=args.method, relay_loops=args.loops, max_connections=100000,
+                  timeout=args.idle_timeout, target_connect_timeout=3,
+                  crypto_offload_threshold=args.offload, egress_rate_mbps=args.egress_mbps)
+    server = ShadowsocksServer(config, log_callback=lambda message: None)
+    if not server.start():
+        sys.exit("relay failed to start")
+    # Idle and connect timeouts are swept by the relays' periodic callback (every 10s)
+    settle_timeout = args.idle_timeout + 25
+    time.sleep(0.5)
+    base_fds = count_fds()
+    base_rss = None
+    rounds = max(1, int(args.duration // args.round))
+    print("=" * 72)
+    print(f"{rounds} rounds of {args.round:g}s, {args.workers} workers, method {args.method}, "
+          f"{len(server.loops)} loop(s), baseline {base_fds} fds")
+    print("=" * 72)
+    failed = False
+    try:
+        for number in range(1, rounds + 1):
+            clients = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), '--clients', '--port', str(args.port),
+                 '--method', args.method, '--round', str(args.round), '--workers', str(args.workers),
+                 '--seed', str(args.seed + number)],
+                stdout=subprocess.PIPE, text=True)
+            peak = 0
+            mismatches = 0
+            while clients.poll() is None:
+                time.sleep(0.5)
+                stats = collector_state(server.stats_collector)
+                peak = max(peak, stats['active'])
+                if stats['active'] != stats['table']:
+                    mismatches += 1
+            report = json.loads(clients.communicate()[0] or '{}')
+            if mismatches:
+                print(f"round {number}: active_connections differed from connection_times {mismatches} times")
+                failed = True
+                break
+
+            start = time.monotonic()
+            while True:
+                problems, relays, stats = check_settled(server, base_fds)
+                if not problems or time.monotonic() - start > settle_timeout:
+                    break
+                time.sleep(0.5)
+            rss = rss_mb()
+            if base_rss is None:
+                base_rss = rss
+            elif rss is not None and rss - base_rss > args.rss_slack_mb:
+                problems.append(f"RSS {rss:.1f} MB, {rss - base_rss:.1f} MB above the first round")
+            scenarios = sum(report.get('counts', {}).values())
+            errors = sum(report.get('errors', {}).values())
+            rss_text = f"rss {rss:.1f} MB" if rss is not None else "rss n/a"
+            print(f"round {number:3}: {scenarios:6} scenarios ({errors} errors), peak {peak:5} active, "
+                  f"{stats['total']:7} total, {rss_text}, "
+                  f"{'settled' if not problems else 'NOT settled'} in {time.monotonic() - start:.1f}s")
+            if problems:
+                for problem in problems:
+                    print(f"  {problem}")
+                for handler in list(relays['handlers'])[:20]:
+                    print(f"  leftover: {describe_handler(handler)}")
+                failed = True
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    print("=" * 72)
+    print("FAILED" if failed else "No leaks found")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
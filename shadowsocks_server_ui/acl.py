@@ -0,0 +1,192 @@
+"""Access control - client and target allow/deny rules with trie lookups"""
+import socket
+import ipaddress
+
+ACTIONS = ('allow', 'deny')
+
+# Config keys holding rule lists
+ACL_KEYS = ('client_allow', 'client_deny', 'target_allow', 'target_deny')
+
+
+class Rule:
+    """One allow/deny pattern and how many times it decided a lookup"""
+    __slots__ = ('pattern', 'action', 'hits')
+
+    def __init__(self, pattern, action):
+        self.pattern = pattern
+        self.action = action
+        self.hits = 0
+
+    @property
+    def allows(self):
+        return self.action == 'allow'
+
+
+class IPTrie:
+    """Binary prefix trie over address bits, longest-prefix match
+
+    Nodes are [zero_child, one_child, rule] lists. A lookup walks at most as
+    many bits as the longest prefix inserted on its path.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+
+    def insert(self, value, prefix_len, rule):
+        """Insert a prefix, deny wins over allow on the same prefix"""
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - prefix_len, -1):
+            bit = (value >> shift) & 1
+            child = node[bit]
+            if child is None:
+                child = node[bit] = [None, None, None]
+            node = child
+        if node[2] is None or not rule.allows:
+            node[2] = rule
+
+    def lookup(self, value):
+        """Get rule of the longest prefix containing value, or None"""
+        node = self.root
+        best = node[2]
+        shift = self.bits - 1
+        while shift >= 0:
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                best = node[2]
+            shift -= 1
+        return best
+
+
+class DomainTrie:
+    """Suffix trie over reversed domain labels, 'example.com' also matches its subdomains"""
+
+    _RULE = ''  # Labels are never empty, so '' holds the node's rule
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, domain, rule):
+        """Insert a domain suffix ('' for every domain), deny wins over allow"""
+        node = self.root
+        if domain:
+            for label in reversed(domain.split('.')):
+                node = node.setdefault(label, {})
+        existing = node.get(self._RULE)
+        if existing is None or not rule.allows:
+            node[self._RULE] = rule
+
+    def lookup(self, host):
+        """Get rule of the longest matching suffix, or None"""
+        node = self.root
+        best = node.get(self._RULE)
+        for label in reversed(host.rstrip('.').lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(self._RULE)
+            if rule is not None:
+                best = rule
+        return best
+
+
+def parse_ip(address):
+    """Get (version, integer) of an IP string, IPv4-mapped IPv6 as IPv4; None if not an IP"""
+    if ':' not in address:
+        if address.count('.') != 3:
+            return None
+        try:
+            return 4, int.from_bytes(socket.inet_aton(address), 'big')
+        except OSError:
+            return None
+    try:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, address.strip('[]')), 'big')
+    except (OSError, ValueError):
+        return None
+    if value >> 32 == 0xffff:
+        return 4, value & 0xffffffff
+    return 6, value
+
+
+class AccessList:
+    """
+    Allow/deny rules for IP networks and domain names
+
+    The most specific matching rule decides (deny wins a tie). When there are
+    allow rules, anything no rule matches is denied; otherwise it is allowed.
+    """
+
+    def __init__(self, allow=(), deny=()):
+        self.rules = []
+        self.ip_tries = {4: IPTrie(32), 6: IPTrie(128)}
+        self.domains = DomainTrie()
+        self.has_allow = False
+        self.unmatched_denied = 0  # Denied because allow rules exist and none matched
+        for action, patterns in (('allow', allow or ()), ('deny', deny or ())):
+            for pattern in patterns:
+                self.add(pattern, action)
+
+    def add(self, pattern, action):
+        """Add a rule: CIDR, IP address, domain suffix, or '*' for everything"""
+        if action not in ACTIONS:
+            raise ValueError(f"Invalid ACL action: {action}")
+        pattern = str(pattern).strip()
+        rule = Rule(pattern, action)
+        if pattern == '*':
+            self.ip_tries[4].insert(0, 0, rule)
+            self.ip_tries[6].insert(0, 0, rule)
+            self.domains.insert('', rule)
+        else:
+            try:
+                network = ipaddress.ip_network(pattern, strict=False)
+            except ValueError:
+                domain = pattern.lower().lstrip('*').strip('.')
+                if not domain or ' ' in domain or '/' in domain:
+                    raise ValueError(f"Invalid ACL pattern: {pattern}")
+                self.domains.insert(domain, rule)
+            else:
+                self.ip_tries[network.version].insert(
+                    int(network.network_address), network.prefixlen, rule)
+        self.rules.append(rule)
+        if action == 'allow':
+            self.has_allow = True
+        return rule
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match_ip(self, address):
+        """Get the rule deciding an IP address (None if no rule matches or not an IP)"""
+        parsed = parse_ip(address)
+        if parsed is None:
+            return None
+        return self.ip_tries[parsed[0]].lookup(parsed[1])
+
+    def match_domain(self, host):
+        """Get the rule deciding a domain name (None if no rule matches)"""
+        return self.domains.lookup(host)
+
+    def decide(self, rule):
+        """Apply the default policy to a lookup result and count the hit"""
+        if rule is not None:
+            rule.hits += 1
+            return rule.allows
+        if self.has_allow:
+            self.unmatched_denied += 1
+            return False
+        return True
+
+    def allows_ip(self, address):
+        """Check an IP address (client addresses)"""
+        return self.decide(self.match_ip(address))
+
+    def get_stats(self):
+        """Get rules with hit counters"""
+        return {
+            'rules': [{'pattern': rule.pattern, 'action': rule.action, 'hits': rule.hits}
+                      for rule in self.rules],
+            'default': 'deny' if self.has_allow else 'allow',
+            'unmatched_denied': self.unmatched_denied,
+        }
@@ -137,3 +137,49 @@ def _patch_shadowsocks_openssl():
 # Try to fix immediately (will be called after shadowsocks import)
 # This function will be called when shadowsocks is imported
 
+
+
+def patch_thread_safe_ciphers():
+    """
+    Give each thread its own output buffer in shadowsocks cipher update()
+    
+    The library writes every OpenSSL/libsodium update into one module-global
+    buffer, and ctypes releases the GIL during the call, so two relay loop
+    threads (or a free-threaded build) would overwrite each other's output.
+    """
+    import threading
+    from ctypes import byref, c_char_p, c_long, create_string_buffer
+    from shadowsocks.crypto import openssl as openssl_module, sodium as sodium_module
+    
+    if getattr(openssl_module.OpenSSLCrypto.update, 'thread_safe', False):
+        return
+    local = threading.local()
+    
+    def thread_buffer(size):
+        buf = getattr(local, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = local.buf = create_string_buffer(max(size * 2, 2048))
+        return buf
+    
+    def openssl_update(self, data):
+        cipher_out_len = c_long(0)
+        l = len(data)
+        buf = thread_buffer(l)
+        openssl_module.libcrypto.EVP_CipherUpdate(self._ctx, byref(buf), byref(cipher_out_len),
+                                                  c_char_p(data), l)
+        return buf[:cipher_out_len.value]
+    
+    def sodium_update(self, data):
+        l = len(data)
+        padding = self.counter % sodium_module.BLOCK_SIZE
+        buf = thread_buffer(padding + l)
+        if padding:
+            data = (b'\0' * padding) + data
+        self.cipher(byref(buf), c_char_p(data), padding + l,
+                    self.iv_ptr, self.counter // sodium_module.BLOCK_SIZE, self.key_ptr)
+        self.counter += l
+        return buf[padding:padding + l]
+    
+    openssl_update.thread_safe = sodium_update.thread_safe = True
+    openssl_module.OpenSSLCrypto.update = openssl_update
+    sodium_module.SodiumCrypto.update = sodium_update
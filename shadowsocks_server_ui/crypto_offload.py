@@ -0,0 +1,154 @@
+"""Crypto offload - runs bulk stream cipher work on worker threads"""
+import time
+import queue
+import ctypes
+import threading
+from shadowsocks.crypto import openssl, sodium
+
+# Per-direction cap on chunks waiting for a worker; reads pause at the cap
+MAX_IN_FLIGHT = 4
+# Jobs a worker finishes before handing results back in one loop task
+COMPLETION_BATCH = 8
+
+_STOP = object()
+
+
+def _openssl_update(cipher, data):
+    """EVP_CipherUpdate into a fresh buffer (the library's shared buffer isn't thread-safe)"""
+    length = len(data)
+    out = bytearray(length)  # Offloaded ciphers are stream modes, output length equals input
+    out_len = ctypes.c_long(0)
+    openssl.libcrypto.EVP_CipherUpdate(cipher._ctx, ctypes.byref((ctypes.c_char * length).from_buffer(out)),
+                                       ctypes.byref(out_len), data, length)
+    return out
+
+
+def _sodium_update(cipher, data):
+    """libsodium stream xor into a fresh buffer, continuing the cipher's byte counter"""
+    length = len(data)
+    padding = cipher.counter % sodium.BLOCK_SIZE
+    out = bytearray(padding + length)
+    buffer = (ctypes.c_char * len(out)).from_buffer(out)
+    if padding:
+        # Counter is mid-block: xor in place after `padding` bytes of filler
+        out[padding:] = data
+        source = ctypes.cast(buffer, ctypes.c_char_p)
+    else:
+        source = data
+    cipher.cipher(ctypes.byref(buffer), source, padding + length,
+                  cipher.iv_ptr, cipher.counter // sodium.BLOCK_SIZE, cipher.key_ptr)
+    cipher.counter += length
+    return memoryview(out)[padding:] if padding else out
+
+
+def update_function(cipher):
+    """Get a thread-safe update function for a cipher object, None if it must stay inline"""
+    if isinstance(cipher, openssl.OpenSSLCrypto):
+        return _openssl_update
+    if isinstance(cipher, sodium.SodiumCrypto):
+        return _sodium_update
+    return None  # Table cipher is pure Python and would hold the GIL anyway
+
+
+class CryptoOffload:
+    """
+    Thread pool for stream cipher work on large chunks
+
+    ctypes releases the GIL while OpenSSL/libsodium run, so the loop thread
+    keeps serving other connections meanwhile. A connection always maps to
+    the same worker, whose queue is FIFO, so its chunks are ciphered and
+    handed back to the loop in the order they were read. Results go to the
+    loop_tasks of the handler's relay, so one pool serves every relay loop.
+    """
+
+    def __init__(self, workers=2, threshold=16384):
+        """
+        Args:
+            workers: worker threads
+            threshold: chunks of at least this many bytes are offloaded (0 = none)
+        """
+        self.threshold = threshold
+        self._queues = [queue.SimpleQueue() for _ in range(max(1, workers))]
+        self._threads = []
+        self._lock = threading.Lock()  # submit() runs on every relay loop thread
+        self.jobs = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busy_time = 0.0  # Seconds spent ciphering on workers
+
+    def start(self):
+        """Start worker threads"""
+        for index, jobs in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(jobs,), daemon=True,
+                                      name=f"CryptoOffload-{index}")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop workers after the jobs already queued"""
+        for jobs in self._queues:
+            jobs.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=2.0)
+        self._threads = []
+
+    def submit(self, handler, stream, update, cipher, data, prefix=b''):
+        """Queue a chunk; handler.crypto_done(stream, result) runs on the loop thread later"""
+        with self._lock:
+            self.jobs += 1
+            self.bytes += len(data)
+        self._queues[hash(handler) % len(self._queues)].put((handler, stream, update, cipher, data, prefix))
+
+    def _run(self, jobs):
+        """Worker: cipher queued chunks, hand results back to the loop in batches"""
+        while True:
+            job = jobs.get()
+            done = {}  # loop_tasks -> [(handler, stream, result)]
+            count = 0
+            while job is not _STOP:
+                handler, stream, update, cipher, data, prefix = job
+                start = time.perf_counter()
+                try:
+                    result = update(cipher, data)
+                    if prefix:
+                        result = prefix + result
+                except Exception:
+                    result = None
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.busy_time += elapsed
+                    if result is None:
+                        self.errors += 1
+                done.setdefault(handler._server.loop_tasks, []).append((handler, stream, result))
+                count += 1
+                if count >= COMPLETION_BATCH:
+                    break
+                try:
+                    job = jobs.get_nowait()
+                except queue.Empty:
+                    break
+            for loop_tasks, results in done.items():
+                try:
+                    loop_tasks.call_soon(self._complete, results)
+                except OSError:
+                    pass  # Task queue closed, that loop stopped
+            if job is _STOP:
+                return
+
+    @staticmethod
+    def _complete(done):
+        """Deliver results in order (loop thread)"""
+        for handler, stream, result in done:
+            handler.crypto_done(stream, result)
+
+    def get_stats(self):
+        """Get offload counters"""
+        return {
+            'workers': len(self._queues),
+            'threshold': self.threshold,
+            'jobs': self.jobs,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'queued': sum(jobs.qsize() for jobs in self._queues),
+            'busy_seconds': round(self.busy_time, 3),
+        }
@@ -0,0 +1,95 @@
+"""Listener handover - start a new process on this process's listening sockets
+
+The running instance starts its successor with the listening sockets as
+inherited file descriptors (named in SHADOWSOCKS_LISTEN_FDS) and a pipe the
+successor writes to once it serves. Both processes accept on the same sockets
+until the old one drains, so an upgrade never refuses a connection. POSIX only.
+"""
+import os
+import sys
+import select
+import socket
+import subprocess
+
+LISTEN_FDS_ENV = 'SHADOWSOCKS_LISTEN_FDS'  # Comma-separated fds of inherited listening sockets
+READY_FD_ENV = 'SHADOWSOCKS_READY_FD'  # Write end of the predecessor's readiness pipe
+READY = b'ready\n'
+
+
+def inherited_listeners():
+    """Take the listening sockets passed by a predecessor (empty list when started normally)"""
+    listeners = []
+    for fd in filter(None, os.environ.pop(LISTEN_FDS_ENV, '').split(',')):
+        sock = socket.socket(fileno=int(fd))
+        os.set_inheritable(sock.fileno(), False)  # Passed on explicitly, not to every child
+        sock.setblocking(False)
+        listeners.append(sock)
+    return listeners
+
+
+def notify_ready():
+    """Tell the predecessor this process is serving, it starts draining then"""
+    fd = os.environ.pop(READY_FD_ENV, '')
+    if not fd:
+        return
+    try:
+        os.write(int(fd), READY)
+    except OSError:
+        pass  # Predecessor gave up waiting
+    finally:
+        os.close(int(fd))
+
+
+def successor_command():
+    """Get the command line that started this process"""
+    if getattr(sys, 'frozen', False):
+        return [sys.executable] + sys.argv[1:]
+    # orig_argv (Python 3.10+) keeps interpreter options such as -m
+    argv = getattr(sys, 'orig_argv', None)
+    if argv:
+        return [sys.executable] + argv[1:]
+    return [sys.executable] + sys.argv
+
+
+def spawn_successor(listeners, timeout=30, command=None):
+    """
+    Start a new instance of this program on the given listening sockets
+
+    Args:
+        listeners: listening sockets, passed in this order
+        timeout: seconds the successor has to report it is serving
+        command: command line (default: the one that started this process)
+
+    Returns:
+        subprocess.Popen: the successor, serving when this returns
+
+    Raises:
+        RuntimeError: the successor exited or was not ready in time (it is killed)
+    """
+    fds = [sock.fileno() for sock in listeners]
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    env[LISTEN_FDS_ENV] = ','.join(str(fd) for fd in fds)
+    env[READY_FD_ENV] = str(write_fd)
+    try:
+        process = subprocess.Popen(command or successor_command(), env=env, pass_fds=fds + [write_fd])
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    try:
+        readable, _, _ = select.select([read_fd], [], [], timeout)
+        message = os.read(read_fd, len(READY)) if readable else b''
+    finally:
+        os.close(read_fd)
+    if message == READY:
+        return process
+    try:
+        # A closed pipe means the successor is exiting
+        process.wait(timeout=5 if readable else 0)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise RuntimeError(f"New process was not ready within {timeout}s") from None
+    raise RuntimeError(f"New process exited with status {process.returncode}")
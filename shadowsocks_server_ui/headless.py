@@ -0,0 +1,185 @@
+"""Headless daemon - runs the relay without the web interface (no Flask import)"""
+import sys
+import time
+import signal
+import datetime
+import threading
+
+try:
+    from shadowsocks_server_ui.server import ShadowsocksServer
+    from shadowsocks_server_ui.config.manager import ConfigManager
+    from shadowsocks_server_ui.stats.collector import StatsCollector
+    from shadowsocks_server_ui.stats.store import StatsStore, StatsPersister
+    from shadowsocks_server_ui.handover import inherited_listeners, notify_ready, spawn_successor
+except ImportError:
+    from .server import ShadowsocksServer
+    from .config.manager import ConfigManager
+    from .stats.collector import StatsCollector
+    from .stats.store import StatsStore, StatsPersister
+    from .handover import inherited_listeners, notify_ready, spawn_successor
+
+
+class HeadlessDaemon:
+    """
+    Runs ShadowsocksServer from the config file until SIGTERM/SIGINT
+
+    Stopping drains open connections for up to drain_timeout seconds, a second
+    signal stops right away. SIGUSR2 starts a new process on the listening
+    sockets and drains this one once the new process serves.
+    """
+
+    def __init__(self, config_file='shadowsocks_config.json'):
+        self.config_manager = ConfigManager(config_file)
+        self.stats_collector = StatsCollector()
+        self.stats_persister = None
+        self.server = None
+        self._stop_event = threading.Event()  # Only set by stop signals
+        self._wake_event = threading.Event()  # Set by every signal, wakes up wait()
+        self._reload_requested = threading.Event()
+        self._upgrade_requested = threading.Event()
+        self._force_stop = threading.Event()  # Second stop signal, cuts the drain short
+
+    def _log(self, message):
+        """Log to stdout with timestamp"""
+        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
+        print(f"[{timestamp}] {message}", flush=True)
+
+    def start(self):
+        """Load configuration and start the relay"""
+        config = self.config_manager.load()
+        if not config.get('password'):
+            raise ValueError(f"Password is required (set it in {self.config_manager.config_file})")
+        if not config.get('server_port') or config['server_port'] < 1 or config['server_port'] > 65535:
+            raise ValueError('Invalid port number')
+
+        self.stats_collector.configure(config)
+        if config.get('stats_db'):
+            self.stats_persister = StatsPersister(
+                self.stats_collector,
+                StatsStore(config['stats_db']),
+                interval=config.get('stats_checkpoint_interval', 30),
+                raw_retention=config.get('stats_raw_retention', 86400),
+                retention_days=config.get('stats_retention_days', 90),
+                log_callback=self._log
+            )
+            self.stats_persister.start()
+
+        self.server = ShadowsocksServer(config, stats_collector=self.stats_collector,
+                                        log_callback=self._log, listeners=inherited_listeners())
+        if not self.server.start():
+            raise RuntimeError('Failed to start server')
+        notify_ready()
+
+    def reload(self):
+        """Re-read the config file and apply it without dropping connections"""
+        try:
+            config = self.config_manager.load()
+            result = self.server.apply_config(config)
+            if result['applied']:
+                self._log(f"Reloaded configuration: {', '.join(result['applied'])}")
+            else:
+                self._log("Reloaded configuration: no changes")
+        except Exception as e:
+            self._log(f"Reload failed: {e}")
+
+    def upgrade(self):
+        """
+        Hand the listening sockets to a new process started with the same command line
+
+        Returns:
+            bool: True once the new process serves (this one should drain and exit)
+        """
+        listeners = self.server.get_listeners()
+        if not listeners:
+            self._log("Upgrade failed: no listening socket to hand over")
+            return False
+        self._log(f"Starting a new process on {len(listeners)} listening sockets")
+        try:
+            process = spawn_successor(listeners)
+        except Exception as e:
+            self._log(f"Upgrade failed, this process keeps serving: {e}")
+            return False
+        self._log(f"New process {process.pid} is serving, draining this one")
+        return True
+
+    def stop(self, drain=False):
+        """Stop the relay (draining open connections first if asked) and flush statistics"""
+        if self.server:
+            if drain:
+                self.server.drain(self.server.config.get('drain_timeout', 30), cancel=self._force_stop)
+            self.server.stop()
+            self.server = None
+        if self.stats_persister:
+            self.stats_persister.stop()
+            self.stats_persister = None
+
+    def install_signal_handlers(self):
+        """SIGTERM/SIGINT stop the daemon, SIGHUP reloads the config file, SIGUSR2 upgrades"""
+        def request_stop(signum, frame):
+            if self._stop_event.is_set():
+                self._force_stop.set()
+            self._stop_event.set()
+            self._wake_event.set()
+
+        def request_reload(signum, frame):
+            self._reload_requested.set()
+            self._wake_event.set()
+
+        def request_upgrade(signum, frame):
+            self._upgrade_requested.set()
+            self._wake_event.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        if hasattr(signal, 'SIGHUP'):  # Not available on Windows
+            signal.signal(signal.SIGHUP, request_reload)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, request_upgrade)
+
+    def wait(self):
+        """Block until a stop signal arrives, handling reloads on the way"""
+        while True:
+            # Short timeout keeps signals responsive on Windows
+            self._wake_event.wait(1.0)
+            # Cleared before the checks, so a signal arriving during them wakes the next wait
+            self._wake_event.clear()
+            if self._stop_event.is_set():
+                return
+            if self._reload_requested.is_set():
+                self._reload_requested.clear()
+                self.reload()
+                continue
+            if self._upgrade_requested.is_set():
+                self._upgrade_requested.clear()
+                if self.upgrade():
+                    return
+                continue
+            if self.server and not self.server.is_running():
+                self._log("Event loop exited, shutting down")
+                return
+
+
+def run_headless(config_file='shadowsocks_config.json', started_at=None):
+    """
+    Run the relay without the web interface
+
+    Args:
+        config_file: configuration file to load
+        started_at: time.perf_counter() value at process entry, for the cold-start report
+    """
+    started_at = started_at if started_at is not None else time.perf_counter()
+    daemon = HeadlessDaemon(config_file)
+    daemon.install_signal_handlers()
+    try:
+        daemon.start()
+    except Exception as e:
+        daemon._log(f"Failed to start: {e}")
+        daemon.stop()
+        sys.exit(1)
+
+    daemon._log(f"Headless server ready in {(time.perf_counter() - started_at) * 1000:.0f} ms")
+    try:
+        daemon.wait()
+    finally:
+        daemon._log("Shutting down...")
+        daemon.stop(drain=True)
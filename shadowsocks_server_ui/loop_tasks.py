@@ -0,0 +1,99 @@
+"""Loop task queue - runs callbacks on the event loop thread"""
+import socket
+import logging
+import threading
+from collections import deque
+from shadowsocks import eventloop
+
+
+class LoopTaskQueue:
+    """Self-pipe based queue that lets other threads run code on the event loop thread"""
+
+    def __init__(self):
+        # socketpair works on Windows too (unlike os.pipe with select/epoll)
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        self._tasks = deque()
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def add_to_loop(self, loop):
+        """Register the wakeup socket with the event loop"""
+        self._loop = loop
+        loop.add(self._rsock, eventloop.POLL_IN | eventloop.POLL_ERR, self)
+
+    def call_soon(self, callback, *args):
+        """Schedule callback(*args) to run on the event loop thread (thread-safe)"""
+        with self._lock:
+            self._tasks.append((callback, args))
+        try:
+            self._wsock.send(b'\0')
+        except (BlockingIOError, OSError):
+            # Pipe is full, the loop already has a pending wakeup
+            pass
+
+    def call_and_wait(self, callback, timeout=5.0):
+        """Run callback on the event loop thread and return its result
+
+        Exceptions raised by the callback are re-raised in the calling thread.
+        A callback the loop hasn't started within timeout is cancelled and
+        never runs; one that already started is waited for.
+        """
+        done = threading.Event()
+        outcome = {}
+        state_lock = threading.Lock()
+        state = ['pending']  # -> 'running' on the loop thread, or 'cancelled' by the caller
+
+        def task():
+            with state_lock:
+                if state[0] == 'cancelled':
+                    return
+                state[0] = 'running'
+            try:
+                outcome['result'] = callback()
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        self.call_soon(task)
+        if not done.wait(timeout):
+            with state_lock:
+                cancelled = state[0] == 'pending'
+                if cancelled:
+                    state[0] = 'cancelled'
+            if cancelled:
+                raise TimeoutError('Event loop did not respond in time')
+            done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('result')
+
+    def handle_event(self, sock, fd, event):
+        """Drain wakeup bytes and run queued tasks"""
+        try:
+            while self._rsock.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while True:
+            with self._lock:
+                if not self._tasks:
+                    break
+                callback, args = self._tasks.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                logging.error(f"Loop task failed: {e}")
+
+    def close(self):
+        """Unregister from the event loop and close sockets"""
+        if self._loop:
+            try:
+                self._loop.remove(self._rsock)
+            except Exception:
+                pass
+            self._loop = None
+        self._rsock.close()
+        self._wsock.close()
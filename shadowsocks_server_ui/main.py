@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 """
 Shadowsocks Server UI - Main Entry Point
-Web-based interface using Flask
+Web-based interface using Flask, or headless relay with --headless
 """
+import time
+_STARTED_AT = time.perf_counter()  # Reference point for the cold-start report
+
 import sys
 import os
+import argparse
 
 # Add the package directory to sys.path for PyInstaller compatibility
 if getattr(sys, 'frozen', False):
@@ -24,30 +28,60 @@ except ImportError:
     # Fallback for relative import when running as module
     from . import compat  # noqa: F401
 
-try:
-    from shadowsocks_server_ui.web.app import WebApp
-except ImportError:
-    # Fallback for relative import when running as module
-    from .web.app import WebApp
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description='Shadowsocks Server UI')
+    parser.add_argument('--headless', action='store_true',
+                        help='start the relay immediately without the web interface')
+    parser.add_argument('-c', '--config', default='shadowsocks_config.json',
+                        help='configuration file (default: shadowsocks_config.json)')
+    parser.add_argument('--web-host', default='0.0.0.0',
+                        help='web interface listen address (default: 0.0.0.0)')
+    parser.add_argument('--web-port', type=int, default=8888,
+                        help='web interface port (default: 8888)')
+    parser.add_argument('--web-server', default='auto', choices=('auto', 'waitress', 'builtin', 'flask'),
+                        help='web server: waitress if installed, otherwise a bounded built-in server')
+    parser.add_argument('--web-threads', type=int, default=4,
+                        help='maximum web request worker threads (default: 4)')
+    return parser.parse_args(argv)
 
 
 def main():
     """Main function"""
+    args = parse_args()
+    
+    if args.headless:
+        # Only relay modules are imported, Flask is never loaded
+        try:
+            from shadowsocks_server_ui.headless import run_headless
+        except ImportError:
+            from .headless import run_headless
+        run_headless(args.config, started_at=_STARTED_AT)
+        return
+    
+    # Web control plane is imported lazily so headless mode stays light
+    try:
+        from shadowsocks_server_ui.web.app import WebApp
+    except ImportError:
+        # Fallback for relative import when running as module
+        from .web.app import WebApp
+    
     print("=" * 60)
     print("Shadowsocks Server UI")
     print("=" * 60)
     print("\nStarting web interface...")
-    print("Open your browser and navigate to: http://127.0.0.1:8888")
+    print(f"Open your browser and navigate to: http://127.0.0.1:{args.web_port}")
     print("\nPress Ctrl+C to stop the server")
     print("=" * 60)
     
     # Create and run web app
     # Use 0.0.0.0 to allow access from any interface (including localhost and 127.0.0.1)
     # Use port 8888 to avoid conflict with macOS AirPlay Receiver (port 5000)
-    web_app = WebApp(host='0.0.0.0', port=8888)
+    web_app = WebApp(host=args.web_host, port=args.web_port, config_file=args.config)
     
     try:
-        web_app.run(debug=False)
+        web_app.run(debug=False, server=args.web_server, threads=args.web_threads)
     except KeyboardInterrupt:
         print("\n\nShutting down...")
         web_app.stop()
@@ -0,0 +1,148 @@
+"""Event loop monitoring - loop lag probe, iteration counters and overload shedding"""
+import time
+import threading
+from shadowsocks import eventloop
+
+try:
+    from shadowsocks_server_ui.stats.histogram import LogLinearHistogram
+except ImportError:
+    from .stats.histogram import LogLinearHistogram
+
+
+class MonitoredEventLoop(eventloop.EventLoop):
+    """EventLoop that counts iterations, events and busy time per iteration"""
+
+    def __init__(self):
+        super().__init__()
+        self.iterations = 0
+        self.events_handled = 0
+        self.busy_time = 0.0  # Seconds spent outside poll()
+        self.busy_histogram = LogLinearHistogram()  # Busy time per iteration (us)
+        self._iteration_start = None
+
+    def poll(self, timeout=None):
+        """Poll, accounting the time since the previous poll returned as busy time"""
+        now = time.perf_counter()
+        if self._iteration_start is not None:
+            busy = now - self._iteration_start
+            self.busy_time += busy
+            self.busy_histogram.record(busy * 1000000)
+        events = super().poll(timeout)
+        self._iteration_start = time.perf_counter()
+        self.iterations += 1
+        self.events_handled += len(events)
+        return events
+
+
+class LoopMonitor:
+    """Measures event loop lag and pauses accepts when the loop is overloaded
+
+    A probe thread posts a timestamped task through the loop task queue every
+    `interval` seconds; the delay until the loop runs it is the loop lag.
+    """
+
+    def __init__(self, loop, loop_tasks, set_accepting=None, interval=0.5, shed_threshold_ms=0,
+                 log_callback=None):
+        """
+        Args:
+            loop: MonitoredEventLoop
+            loop_tasks: LoopTaskQueue of the same loop
+            set_accepting: callback(bool) that pauses/resumes accepting (runs on loop thread)
+            interval: seconds between probes
+            shed_threshold_ms: lag that pauses accepts (0 disables shedding)
+        """
+        self.loop = loop
+        self.loop_tasks = loop_tasks
+        self.set_accepting = set_accepting
+        self.interval = interval
+        self.shed_threshold_ms = shed_threshold_ms
+        self.log_callback = log_callback
+        self.lag_histogram = LogLinearHistogram()  # microseconds
+        self.last_lag = 0.0  # seconds
+        self.max_lag = 0.0
+        self.shedding = False
+        self.shed_count = 0  # Times accepts were paused
+        self._probe_sent = None  # monotonic time of the probe in flight
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start probe thread"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="LoopMonitor")
+        self._thread.start()
+
+    def stop(self):
+        """Stop probe thread"""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=2.0)
+        self._thread = None
+
+    def _run(self):
+        """Probe loop"""
+        while not self._stop_event.wait(self.interval):
+            with self._lock:
+                if self._probe_sent is not None:
+                    # Previous probe still queued, the loop is at least this late
+                    self.last_lag = time.monotonic() - self._probe_sent
+                    continue
+                self._probe_sent = time.monotonic()
+            try:
+                self.loop_tasks.call_soon(self._on_probe)
+            except OSError:
+                return  # Task queue closed, server stopped
+
+    def _on_probe(self):
+        """Probe task (runs on the loop thread)"""
+        now = time.monotonic()
+        with self._lock:
+            if self._probe_sent is None:
+                return
+            lag = now - self._probe_sent
+            self._probe_sent = None
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.lag_histogram.record(lag * 1000000)
+        self._apply_shedding(lag)
+
+    def _apply_shedding(self, lag):
+        """Pause accepts above the threshold, resume below half of it"""
+        if not self.shed_threshold_ms or not self.set_accepting:
+            if self.shedding and self.set_accepting:
+                self.shedding = False
+                self.set_accepting(True)
+            return
+        lag_ms = lag * 1000
+        if not self.shedding and lag_ms > self.shed_threshold_ms:
+            self.shedding = True
+            self.shed_count += 1
+            self.set_accepting(False)
+            if self.log_callback:
+                self.log_callback(f"Event loop lag {lag_ms:.0f}ms > {self.shed_threshold_ms}ms, pausing new connections")
+        elif self.shedding and lag_ms < self.shed_threshold_ms / 2:
+            self.shedding = False
+            self.set_accepting(True)
+            if self.log_callback:
+                self.log_callback(f"Event loop lag back to {lag_ms:.0f}ms, accepting new connections")
+
+    def get_metrics(self):
+        """Get loop lag and iteration metrics"""
+        with self._lock:
+            lag = self.lag_histogram.summary()
+            last_lag = self.last_lag
+            if self._probe_sent is not None:
+                last_lag = max(last_lag, time.monotonic() - self._probe_sent)
+            return {
+                'lag_ms': round(last_lag * 1000, 3),
+                'max_lag_ms': round(self.max_lag * 1000, 3),
+                'lag_us': lag,
+                'iterations': self.loop.iterations,
+                'events_handled': self.loop.events_handled,
+                'busy_seconds': round(self.loop.busy_time, 3),
+                'busy_per_iteration_us': self.loop.busy_histogram.summary(),
+                'shedding': self.shedding,
+                'shed_count': self.shed_count,
+                'shed_threshold_ms': self.shed_threshold_ms,
+            }
@@ -0,0 +1,207 @@
+"""On-demand profiling of a running relay - stack sampling, cProfile and tracemalloc
+
+Nothing here is active until requested: the sampler is a short-lived thread,
+cProfile is enabled only for the requested window and tracemalloc is started
+and stopped explicitly.
+"""
+import io
+import os
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+MAX_PROFILE_SECONDS = 60
+MAX_STACK_DEPTH = 64
+TRACEMALLOC_GROUPS = ('lineno', 'filename', 'traceback')
+
+
+def _frame_label(frame):
+    """Get 'function (file:line)' label of a frame's code object"""
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, max_depth=MAX_STACK_DEPTH):
+    """Get collapsed stack string (root first, ';' separated) of a frame"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+class RelayProfiler:
+    """CPU and memory profiling for the relay thread, one CPU profile at a time"""
+
+    def __init__(self):
+        self._cpu_lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        self._baseline = None  # tracemalloc snapshot diffs are taken against
+
+    def _check_duration(self, duration):
+        """Validate a profile duration"""
+        if not 0 < duration <= MAX_PROFILE_SECONDS:
+            raise ValueError(f"duration must be between 0 and {MAX_PROFILE_SECONDS} seconds")
+
+    def sample_stacks(self, thread_ident, duration=5.0, interval=0.005):
+        """
+        Sample the stack of a thread for a while
+
+        Returns:
+            dict: samples, duration, and stacks in collapsed format
+            ('frame;frame;frame count' per line, input for flamegraph tools)
+        """
+        self._check_duration(duration)
+        if not self._cpu_lock.acquire(blocking=False):
+            raise RuntimeError('A CPU profile is already running')
+        try:
+            counts = {}
+            samples = 0
+            started = time.monotonic()
+            deadline = started + duration
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_ident)
+                if frame is None:
+                    break  # Thread exited
+                stack = collapse_stack(frame)
+                del frame
+                counts[stack] = counts.get(stack, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            lines = [f"{stack} {count}" for stack, count in
+                     sorted(counts.items(), key=lambda item: item[1], reverse=True)]
+            return {
+                'samples': samples,
+                'duration': round(time.monotonic() - started, 3),
+                'collapsed': '\n'.join(lines),
+            }
+        finally:
+            self._cpu_lock.release()
+
+    def profile_calls(self, loop_tasks, duration=5.0, sort='cumulative', limit=50, raw=False):
+        """
+        Run cProfile on the event loop thread for a while
+
+        From Python 3.12 cProfile profiles every thread of the process, so the
+        report also has the other threads' calls.
+
+        Args:
+            loop_tasks: LoopTaskQueue of the loop to profile
+            raw: return a marshalled pstats dump (load with pstats.Stats(path))
+                instead of a text report
+
+        Returns:
+            bytes if raw, otherwise the text report
+        """
+        self._check_duration(duration)
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError(f"Invalid sort key: {sort}")
+        if not self._cpu_lock.acquire(blocking=False):
+            raise RuntimeError('A CPU profile is already running')
+        try:
+            profiler = cProfile.Profile()
+            if sys.version_info >= (3, 12):
+                # cProfile uses sys.monitoring, which covers all threads wherever it is enabled
+                profiler.enable()
+                try:
+                    time.sleep(duration)
+                finally:
+                    profiler.disable()
+            else:
+                # cProfile hooks the thread that enables it, so enable and disable on the loop thread
+                loop_tasks.call_and_wait(profiler.enable)
+                try:
+                    time.sleep(duration)
+                finally:
+                    self._disable_on_loop(loop_tasks, profiler)
+            profiler.create_stats()
+            if raw:
+                return marshal.dumps(profiler.stats)
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+        finally:
+            self._cpu_lock.release()
+
+    @staticmethod
+    def _disable_on_loop(loop_tasks, profiler, timeout=5.0):
+        """Disable a profiler enabled on the loop thread, even if the loop is slow to get to it"""
+        disabled = threading.Event()
+
+        def disable():
+            profiler.disable()
+            disabled.set()
+
+        # Not call_and_wait: a busy loop would get it cancelled and stay profiled for good
+        loop_tasks.call_soon(disable)
+        if not disabled.wait(timeout):
+            raise TimeoutError('Event loop did not respond in time, the profile was discarded')
+
+    def start_memory_tracing(self, nframes=10):
+        """Start tracemalloc and take the baseline snapshot"""
+        with self._memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(nframes)
+            self._baseline = self._take_snapshot()
+            return self._memory_status()
+
+    def memory_diff(self, limit=25, group_by='lineno', reset=False):
+        """
+        Compare current allocations with the baseline snapshot
+
+        Args:
+            limit: number of entries, largest growth first
+            group_by: 'lineno', 'filename' or 'traceback'
+            reset: use the current snapshot as the next baseline
+        """
+        if group_by not in TRACEMALLOC_GROUPS:
+            raise ValueError(f"group_by must be one of: {', '.join(TRACEMALLOC_GROUPS)}")
+        with self._memory_lock:
+            if not tracemalloc.is_tracing() or self._baseline is None:
+                raise RuntimeError('Memory tracing is not running')
+            snapshot = self._take_snapshot()
+            stats = snapshot.compare_to(self._baseline, group_by)
+            if reset:
+                self._baseline = snapshot
+            entries = []
+            for stat in stats[:limit]:
+                entries.append({
+                    'location': [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                    'size': stat.size,
+                    'size_diff': stat.size_diff,
+                    'count': stat.count,
+                    'count_diff': stat.count_diff,
+                })
+            result = self._memory_status()
+            result['entries'] = entries
+            return result
+
+    def stop_memory_tracing(self):
+        """Stop tracemalloc and drop the baseline"""
+        with self._memory_lock:
+            self._baseline = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def _take_snapshot(self):
+        """Take a snapshot without tracemalloc's own and import machinery allocations"""
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+
+    def _memory_status(self):
+        """Get traced memory totals"""
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'tracing': tracemalloc.is_tracing(),
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'overhead_bytes': tracemalloc.get_tracemalloc_memory(),
+        }
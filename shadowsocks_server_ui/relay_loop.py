@@ -0,0 +1,311 @@
+"""Relay loop - one event loop thread with its own listener, relays and monitors"""
+import itertools
+import threading
+from shadowsocks import asyncdns
+
+try:
+    from shadowsocks_server_ui.tcprelay_ext import TCPRelayExt
+    from shadowsocks_server_ui.loop_tasks import LoopTaskQueue
+    from shadowsocks_server_ui.monitor import MonitoredEventLoop, LoopMonitor
+    from shadowsocks_server_ui.scheduler import FairScheduler
+    from shadowsocks_server_ui.tcpinfo import TCP_INFO, TcpInfoSampler
+    from shadowsocks_server_ui.sockopts import create_listener, listener_matches
+    from shadowsocks_server_ui.config.defaults import LIVE_RELOAD_KEYS, LISTENER_KEYS
+    from shadowsocks_server_ui.upstream import UPSTREAM_KEYS
+except ImportError:
+    from .tcprelay_ext import TCPRelayExt
+    from .loop_tasks import LoopTaskQueue
+    from .monitor import MonitoredEventLoop, LoopMonitor
+    from .scheduler import FairScheduler
+    from .tcpinfo import TCP_INFO, TcpInfoSampler
+    from .sockopts import create_listener, listener_matches
+    from .config.defaults import LIVE_RELOAD_KEYS, LISTENER_KEYS
+    from .upstream import UPSTREAM_KEYS
+
+
+class RelayLoop:
+    """
+    One event loop thread serving a share of the server's connections
+
+    Each loop has its own listener, DNS resolver, task queue, lag monitor,
+    TCP_INFO sampler and bandwidth scheduler, so loops never touch each
+    other's sockets. With several loops the listeners share the port through
+    SO_REUSEPORT and the kernel spreads new connections between them; the
+    connection limit is split evenly and the egress rate by the loops'
+    waiting clients.
+    Methods marked (loop thread) must run on this loop's thread.
+    """
+
+    def __init__(self, server, index, count, stats):
+        """
+        Args:
+            server: ShadowsocksServer owning the loop
+            index: position of the loop, 0 is the primary loop
+            count: number of loops the server runs
+            stats: StatsCollector, or a StatsShard of it, receiving this loop's statistics
+        """
+        self.server = server
+        self.index = index
+        self.count = count
+        self.stats = stats
+        self.connection_ids = itertools.count(index + 1, count)  # Disjoint from other loops' IDs
+        self.eventloop = None
+        self.dns_resolver = None
+        self.loop_tasks = None
+        self.tcp_relay = None
+        self.draining_relays = []  # Relays replaced by a config reload, finishing their connections
+        self.loop_monitor = None
+        self.tcp_info_sampler = None
+        self.scheduler = None
+        self.thread = None
+
+    @property
+    def name(self):
+        return "ShadowsocksServer" if self.index == 0 else f"ShadowsocksServer-{self.index}"
+
+    def open(self):
+        """Create the event loop and bind the listener (raises on failure)"""
+        self.eventloop = MonitoredEventLoop()
+        self.dns_resolver = asyncdns.DNSResolver()
+        self.dns_resolver.add_to_loop(self.eventloop)
+        # Task queue for running config changes on the loop thread
+        self.loop_tasks = LoopTaskQueue()
+        self.loop_tasks.add_to_loop(self.eventloop)
+        self.eventloop.add_periodic(self._handle_periodic)
+        self.configure_scheduler()
+        self.tcp_relay = self.create_relay(self.server.config, self.server.take_listener(self.server.config))
+        self.tcp_relay.add_to_loop(self.eventloop)
+
+    def start(self):
+        """Start the loop thread, lag monitor and TCP_INFO sampler"""
+        config = self.server.config
+        self.thread = threading.Thread(target=self._run, daemon=True, name=self.name)
+        self.thread.start()
+
+        # Loop lag probe, optionally pausing accepts when overloaded
+        self.loop_monitor = LoopMonitor(
+            self.eventloop, self.loop_tasks,
+            set_accepting=self.set_accepting,
+            interval=config.get('loop_lag_probe_interval', 0.5),
+            shed_threshold_ms=config.get('loop_lag_shed_ms', 0),
+            log_callback=self.server.log_warning
+        )
+        self.loop_monitor.start()
+
+        tcp_info_interval = config.get('tcp_info_interval', 10)
+        if tcp_info_interval and TCP_INFO is not None:
+            self.tcp_info_sampler = TcpInfoSampler(
+                self.loop_tasks, self.get_relays, self.stats,
+                interval=tcp_info_interval,
+                batch_size=config.get('tcp_info_batch', 256)
+            )
+            self.tcp_info_sampler.start()
+
+    def _run(self):
+        """Run event loop (in separate thread)"""
+        try:
+            self.eventloop.run()
+        except Exception as e:
+            self.server.log_error(f"Event loop error ({self.name}): {str(e)}")
+            import traceback
+            traceback.print_exc()
+            self.server.loop_failed(self)
+
+    def close(self):
+        """Stop monitors and the loop thread, then close relays"""
+        if self.loop_monitor:
+            self.loop_monitor.stop()
+        if self.tcp_info_sampler:
+            self.tcp_info_sampler.stop()
+        if self.scheduler:
+            self.scheduler.stop()
+            self.scheduler = None
+        if self.eventloop:
+            self.eventloop.stop()
+        if self.thread and self.thread.is_alive():
+            try:
+                # Wake poll() so the loop sees the stop flag now rather than after its timeout
+                self.loop_tasks.call_soon(lambda: None)
+            except OSError:
+                pass
+            self.thread.join(timeout=2.0)
+        for relay in self.get_relays():
+            relay.close(next_tick=False)
+        self.draining_relays = []
+        if self.loop_tasks:
+            self.loop_tasks.close()
+        if self.dns_resolver:
+            self.dns_resolver.close()
+
+    def _max_connections(self, config):
+        """Get this loop's share of the connection limit"""
+        return -(-config.get('max_connections', 2000) // self.count)
+
+    def create_relay(self, config, listener=None):
+        """Create a TCP relay (server mode) for a configuration, on `listener` if given"""
+        server = self.server
+        if listener is None and server.reuse_port:
+            listener = create_listener(config, reuse_port=True)
+        try:
+            # Each relay gets its own config copy so a draining relay keeps its settings
+            return TCPRelayExt(
+                dict(config),
+                self.dns_resolver,
+                is_local=False,  # Server mode
+                stats_callback=self._stats_callback,
+                log_callback=server._log,
+                max_connections=self._max_connections(config),
+                replay_filter=server.replay_filter,
+                scheduler=self.scheduler,
+                crypto_offload=server.crypto_offload,
+                listener=listener,
+                loop_tasks=self.loop_tasks,
+                trace_recorder=server.trace_recorder,
+                connection_ids=self.connection_ids,
+                upstreams=server.upstreams
+            )
+        except Exception:
+            if listener is not None:
+                listener.close()
+            raise
+
+    def _stats_callback(self, action, value=None, client_ip=None, target_addr=None):
+        """Statistics callback"""
+        if action == 'add_connection':
+            self.stats.add_connection(value, client_ip, target_addr)
+        elif action == 'remove_connection':
+            self.stats.remove_connection(value)
+        elif action == 'reject_connection':
+            self.stats.reject_connection()
+        elif action == 'update_target_addr':
+            # value is connection_id, client_ip is client_ip, target_addr is target_addr
+            self.stats.update_target_addr(value, target_addr)
+        elif action == 'update_target_ip':
+            # value is connection_id, target_addr is the resolved IP
+            self.stats.update_target_ip(value, target_addr)
+        elif action == 'add_bytes_sent':
+            self.stats.add_bytes_sent(value, client_ip)  # client_ip is actually connection_id
+        elif action == 'add_bytes_received':
+            self.stats.add_bytes_received(value, client_ip)  # client_ip is actually connection_id
+        elif action == 'record_latency':
+            # value is {stage: seconds} for one closed connection
+            self.stats.record_latency(value)
+
+    def apply_changes(self, changes, old_config):
+        """
+        Apply config changes already merged into server.config (loop thread)
+
+        Returns:
+            bool: True if the listener was restarted
+        """
+        config = self.server.config
+        listener_restarted = False
+        if any(key in LISTENER_KEYS for key in changes) and not self._listener_in_place(config):
+            self._restart_listener(config, old_config)
+            listener_restarted = True
+        else:
+            if any(key in LISTENER_KEYS for key in changes):
+                self.tcp_relay.update_listener({key: config.get(key) for key in ('fast_open', 'listen_backlog')})
+            live = {key: value for key, value in changes.items() if key in LIVE_RELOAD_KEYS}
+            if 'max_connections' in live:
+                live['max_connections'] = self._max_connections(config)
+            self.tcp_relay.update_config(live)
+        if 'egress_rate_mbps' in changes or 'egress_weights' in changes:
+            self.configure_scheduler()
+        if 'crypto_offload_threshold' in changes:
+            for relay in self.get_relays():
+                relay.crypto_offload = self.server.crypto_offload
+        if 'trace_file' in changes:
+            for relay in self.get_relays():
+                relay.trace_recorder = self.server.trace_recorder
+        if any(key in UPSTREAM_KEYS for key in changes):
+            for relay in self.get_relays():
+                relay.upstreams = self.server.upstreams
+        if 'loop_lag_shed_ms' in changes:
+            self.loop_monitor.shed_threshold_ms = changes['loop_lag_shed_ms']
+        return listener_restarted
+
+    def _listener_in_place(self, config):
+        """Check if the active listener is already bound where config listens (only its options change)"""
+        listener = self.tcp_relay._server_socket
+        return listener is not None and listener_matches(listener, config)
+
+    def _restart_listener(self, config, old_config):
+        """Start a relay for the new listen address and drain the old one (loop thread)"""
+        old_relay = self.tcp_relay
+        same_port = old_config.get('server_port') == config.get('server_port')
+        try:
+            new_relay = self.create_relay(config)
+        except OSError:
+            if not same_port:
+                raise
+            # The port can't be bound twice without SO_REUSEPORT, release it first
+            self.server.log_warning(f"Can't bind {config.get('server')}:{config.get('server_port')} next to the "
+                                    f"old listener, closing it first (its queued connections are reset)")
+            old_relay.drain()
+            try:
+                new_relay = self.create_relay(config)
+            except OSError:
+                # Put a listener back with the previous settings
+                self.draining_relays.append(old_relay)
+                self.tcp_relay = self.create_relay(old_config)
+                self.tcp_relay.add_to_loop(self.eventloop)
+                raise
+        new_relay.add_to_loop(self.eventloop)
+        new_relay.set_accepting(not self.loop_monitor.shedding)
+        old_relay.drain()
+        self.draining_relays.append(old_relay)
+        self.tcp_relay = new_relay
+
+    def _handle_periodic(self):
+        """Close draining relays once all their connections are gone"""
+        for relay in list(self.draining_relays):
+            if relay.get_handler_count() == 0:
+                relay.close(next_tick=False)
+                self.draining_relays.remove(relay)
+                self.server.log_info("Old listener drained and closed")
+        if self.index == 0:
+            # Bound the memory held by other loops' shards when nothing reads statistics
+            self.server.stats_collector.merge_shards()
+
+    def configure_scheduler(self):
+        """Create, update or remove the bandwidth scheduler from the config (loop thread)"""
+        config = self.server.config
+        rate = int(float(config.get('egress_rate_mbps', 0) or 0) * 125000)  # Mbit/s -> bytes/s
+        weights = config.get('egress_weights') or {}
+        if rate > 0 and self.scheduler:
+            self.scheduler.configure(rate, weights)
+            return
+        if rate > 0:
+            self.scheduler = FairScheduler(self.loop_tasks, rate, weights, shares=self.server.egress_shares)
+            self.scheduler.start()
+        elif self.scheduler:
+            self.scheduler.stop()
+            self.scheduler.release_all()
+            self.scheduler = None
+        else:
+            return
+        for relay in self.get_relays():
+            relay.scheduler = self.scheduler
+
+    def get_relays(self):
+        """Get active and draining relays (loop thread)"""
+        return [relay for relay in [self.tcp_relay] + self.draining_relays if relay]
+
+    def set_accepting(self, accepting):
+        """Pause or resume accepts on the active listener (runs on the loop thread)"""
+        if self.tcp_relay:
+            self.tcp_relay.set_accepting(accepting)
+
+    def drain(self):
+        """Stop accepting on every relay, open connections keep running (loop thread)"""
+        for relay in self.get_relays():
+            relay.drain()
+
+    def get_connection_count(self):
+        """Get number of connections on active and draining relays"""
+        return sum(relay.get_handler_count() for relay in self.get_relays())
+
+    def get_draining_connections(self):
+        """Get number of connections still running on replaced listeners"""
+        return sum(relay.get_handler_count() for relay in self.draining_relays)
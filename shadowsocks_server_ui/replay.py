@@ -0,0 +1,104 @@
+"""Replay protection - remembers recent connection IVs in rotating Bloom filters"""
+import os
+import math
+import hashlib
+import threading
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over a keyed BLAKE2b digest"""
+
+    def __init__(self, capacity, error_rate, key):
+        """
+        Args:
+            capacity: number of items before the false positive rate exceeds error_rate
+            error_rate: target false positive probability
+            key: secret hash key, so remote peers can't craft colliding items
+        """
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._key = key
+
+    def _positions(self, item):
+        """Get bit positions of an item"""
+        digest = hashlib.blake2b(item, digest_size=16, key=self._key).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hash_count)]
+
+    def __contains__(self, item):
+        bits = self.bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, item):
+        """Add an item"""
+        bits = self.bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class ReplayFilter:
+    """
+    Detects reused IVs with two Bloom filters
+
+    New IVs go into the current filter; lookups check both. When the current
+    filter is full it becomes the previous one and the oldest is dropped, so
+    memory is fixed and at least `capacity` recent IVs are always remembered.
+    Shared by every relay loop, so lookups and inserts hold a lock.
+    """
+
+    def __init__(self, capacity=100000, error_rate=1e-6):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise ValueError('Replay filter capacity must be positive and error rate between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._key = os.urandom(16)
+        self.current = BloomFilter(capacity, error_rate, self._key)
+        self.previous = None
+        self.checked = 0
+        self.replays = 0
+        self.rotations = 0
+        self._lock = threading.Lock()
+
+    def check_and_add(self, iv):
+        """Check an IV and remember it; returns True if it was seen before"""
+        with self._lock:
+            self.checked += 1
+            if iv in self.current or (self.previous is not None and iv in self.previous):
+                self.replays += 1
+                return True
+            self._add(iv)
+            return False
+
+    def add(self, iv):
+        """Remember an IV (e.g. one the server generated itself)"""
+        with self._lock:
+            self._add(iv)
+
+    def _add(self, iv):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate, self._key)
+            self.rotations += 1
+        self.current.add(iv)
+
+    def get_stats(self):
+        """Get filter counters"""
+        return {
+            'capacity': self.capacity,
+            'error_rate': self.error_rate,
+            'hash_count': self.current.hash_count,
+            'memory_bytes': len(self.current.bits) * 2,
+            'current_fill': self.current.count,
+            'checked': self.checked,
+            'replays': self.replays,
+            'rotations': self.rotations,
+        }
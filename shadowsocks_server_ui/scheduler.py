@@ -0,0 +1,246 @@
+"""Weighted fair bandwidth scheduler - deficit round robin over client IPs"""
+import time
+import threading
+from collections import deque
+from shadowsocks import tcprelay
+
+
+class ClientQueue:
+    """Handlers of one client waiting to read from their targets"""
+    __slots__ = ('client_ip', 'weight', 'deficit', 'in_round', 'handlers')
+
+    def __init__(self, client_ip, weight):
+        self.client_ip = client_ip
+        self.weight = weight
+        self.deficit = 0
+        self.in_round = False  # Quantum already added for the current visit
+        self.handlers = deque()
+
+
+class EgressShares:
+    """
+    Splits the egress rate between the schedulers of several relay loops
+
+    Each loop gets a share proportional to the total weight of its waiting
+    clients, so a waiting client gets about the same rate whichever loop
+    serves it. While no client waits anywhere, the rate is split evenly;
+    a loop that runs out queues its clients and takes its share.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rate = 0
+        self._waiting = {}  # FairScheduler -> weight of its waiting clients
+
+    def add(self, scheduler):
+        """Start sharing the rate with a scheduler"""
+        with self._lock:
+            self._waiting[scheduler] = 0
+            self._split()
+
+    def remove(self, scheduler):
+        """Stop sharing the rate with a scheduler"""
+        with self._lock:
+            self._waiting.pop(scheduler, None)
+            self._split()
+
+    def set_rate(self, rate):
+        """Set the total rate (bytes/s)"""
+        with self._lock:
+            self.rate = rate
+            self._split()
+
+    def update(self, scheduler, waiting_weight):
+        """Record a scheduler's waiting weight and split the rate again (any loop thread)"""
+        with self._lock:
+            if scheduler in self._waiting:
+                self._waiting[scheduler] = waiting_weight
+                self._split()
+
+    def _split(self):
+        """Give every scheduler its share of the rate (lock held)"""
+        total = sum(self._waiting.values())
+        for scheduler, waiting_weight in self._waiting.items():
+            share = waiting_weight / total if total else 1 / len(self._waiting)
+            scheduler.set_rate(int(self.rate * share))
+
+
+class FairScheduler:
+    """
+    Limits total client-bound traffic and shares it between clients by weight
+
+    While tokens are available, reads go straight through and are only
+    charged. Once the bucket is empty, handlers wanting to read from their
+    target are paused and queued per client. A ticker then serves the clients
+    round robin on the loop thread, each getting `quantum * weight` bytes per
+    round, so one bulk download can't starve other clients.
+    With several relay loops, each loop has a scheduler and EgressShares
+    splits the rate between them.
+    All methods except start/stop and set_rate run on the loop thread.
+    """
+
+    def __init__(self, loop_tasks, rate, weights=None, quantum=tcprelay.BUF_SIZE, tick=0.005, shares=None):
+        """
+        Args:
+            loop_tasks: LoopTaskQueue of the relay loop
+            rate: total egress rate to clients in bytes per second
+            weights: {client_ip: weight}, other clients have weight 1
+            quantum: bytes per round for weight 1
+            tick: minimum seconds between service rounds while clients are waiting
+            shares: EgressShares splitting rate with the other loops' schedulers, or None
+        """
+        self.loop_tasks = loop_tasks
+        self.quantum = quantum
+        self.tick = tick
+        self.shares = shares
+        self.waiting_weight = 0  # Total weight of the waiting clients
+        self.rate = 0
+        if shares is not None:
+            shares.add(self)
+        self.configure(rate, weights)
+        self.tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._clients = {}  # client_ip -> ClientQueue, only while it has waiting handlers
+        self._active = deque()  # Round robin order of waiting clients
+        self.throttled = 0  # Times a handler was paused
+        self.bytes_charged = 0
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def configure(self, rate, weights=None):
+        """Set total rate (bytes/s) and per-client weights"""
+        self.weights = {ip: max(1, int(weight)) for ip, weight in (weights or {}).items()}
+        if self.shares is not None:
+            self.shares.set_rate(rate)
+        else:
+            self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Set the rate (bytes/s) this scheduler sends at (any thread)"""
+        self.rate = rate
+        # Two ticks of traffic (at least a few reads) may pass unqueued; a larger
+        # burst lets clients with more connections take more than their share
+        self.burst = max(rate * self.tick * 2, 4 * self.quantum)
+
+    def _set_waiting_weight(self, waiting_weight):
+        """Track the weight of the waiting clients for the other loops' shares"""
+        self.waiting_weight = waiting_weight
+        if self.shares is not None:
+            self.shares.update(self, waiting_weight)
+
+    def start(self):
+        """Start ticker thread"""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="FairScheduler")
+        self._thread.start()
+
+    def stop(self):
+        """Stop ticker thread (call release_all on the loop thread to resume paused handlers)"""
+        self._stopping = True
+        if self.shares is not None:
+            self.shares.remove(self)
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=2.0)
+        self._thread = None
+
+    def _run(self):
+        """Post a service round to the loop while clients are waiting"""
+        while True:
+            self._wakeup.wait()
+            if self._stopping:
+                return
+            # Sleep until roughly one quantum of tokens is available
+            time.sleep(max(self.tick, (self.quantum - self.tokens) / self.rate if self.rate else self.tick))
+            self._wakeup.clear()
+            try:
+                self.loop_tasks.call_soon(self._service)
+            except OSError:
+                return  # Task queue closed, server stopped
+
+    def _refill(self):
+        """Add tokens for the time since the last refill"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def admit(self, handler):
+        """
+        Check if a handler may read from its target now
+
+        Returns False after queueing (and pausing) the handler.
+        """
+        if not self._active:
+            self._refill()
+            if self.tokens > 0:
+                return True
+        self._enqueue(handler)
+        return False
+
+    def charge(self, handler, bytes_count):
+        """Account bytes sent to a client outside a service round"""
+        self.tokens -= bytes_count
+        self.bytes_charged += bytes_count
+
+    def _enqueue(self, handler):
+        """Pause a handler and queue it behind its client's other handlers"""
+        client = self._clients.get(handler.client_ip)
+        if client is None:
+            client = self._clients[handler.client_ip] = ClientQueue(
+                handler.client_ip, self.weights.get(handler.client_ip, 1))
+            self._active.append(client)
+            self._set_waiting_weight(self.waiting_weight + client.weight)
+            self._wakeup.set()
+        handler.pause_remote_read()
+        client.handlers.append(handler)
+        self.throttled += 1
+
+    def _service(self):
+        """Serve waiting clients round robin until tokens run out (loop thread)"""
+        self._refill()
+        while self._active and self.tokens > 0:
+            client = self._active[0]
+            if not client.in_round:
+                client.deficit += self.quantum * client.weight
+                client.in_round = True
+            while client.handlers and client.deficit > 0 and self.tokens > 0:
+                handler = client.handlers.popleft()
+                bytes_count, more = handler.scheduled_remote_read()
+                client.deficit -= bytes_count
+                self.tokens -= bytes_count
+                self.bytes_charged += bytes_count
+                if more:
+                    client.handlers.append(handler)
+            if client.handlers and client.deficit > 0:
+                break  # Out of tokens, continue this visit next round
+            client.in_round = False
+            self._active.popleft()
+            if client.handlers:
+                self._active.append(client)
+            else:
+                client.deficit = 0
+                del self._clients[client.client_ip]
+                self._set_waiting_weight(self.waiting_weight - client.weight)
+        if self._active:
+            self._wakeup.set()
+
+    def release_all(self):
+        """Resume every paused handler (scheduler disabled or stopping)"""
+        for client in self._active:
+            for handler in client.handlers:
+                handler.resume_remote_read()
+        self._active.clear()
+        self._clients.clear()
+        self._set_waiting_weight(0)
+
+    def get_stats(self):
+        """Get scheduler counters"""
+        return {
+            'rate_bytes': self.rate,
+            'tokens': int(self.tokens),
+            'waiting_clients': len(self._active),
+            'waiting_connections': sum(len(client.handlers) for client in self._active),
+            'throttled': self.throttled,
+            'bytes_charged': self.bytes_charged,
+        }
@@ -5,24 +5,49 @@ try:
 except ImportError:
     from . import compat  # noqa: F401
 
+import sys
+import time
 import threading
 import logging
-from shadowsocks import eventloop, asyncdns
+from shadowsocks import encrypt
 # Try to fix OpenSSL again after shadowsocks import
 compat._patch_shadowsocks_openssl()
 
 try:
-    from shadowsocks_server_ui.tcprelay_ext import TCPRelayExt
+    from shadowsocks_server_ui.relay_loop import RelayLoop
     from shadowsocks_server_ui.stats.collector import StatsCollector
+    from shadowsocks_server_ui.acl import ACL_KEYS, AccessList
+    from shadowsocks_server_ui.replay import ReplayFilter
+    from shadowsocks_server_ui.crypto_offload import CryptoOffload
+    from shadowsocks_server_ui.scheduler import EgressShares
+    from shadowsocks_server_ui.trace import TraceRecorder
+    from shadowsocks_server_ui.upstream import UPSTREAM_KEYS, UpstreamPool, UpstreamCounters, parse_config
+    from shadowsocks_server_ui.sockopts import (
+        SOCKET_OPTION_KEYS, SO_REUSEPORT, probe_socket_options, format_probe_report, listener_matches
+    )
+    from shadowsocks_server_ui.config.defaults import LIVE_RELOAD_KEYS, LISTENER_KEYS
 except ImportError:
-    from .tcprelay_ext import TCPRelayExt
+    from .relay_loop import RelayLoop
     from .stats.collector import StatsCollector
+    from .acl import ACL_KEYS, AccessList
+    from .replay import ReplayFilter
+    from .crypto_offload import CryptoOffload
+    from .scheduler import EgressShares
+    from .trace import TraceRecorder
+    from .upstream import UPSTREAM_KEYS, UpstreamPool, UpstreamCounters, parse_config
+    from .sockopts import (
+        SOCKET_OPTION_KEYS, SO_REUSEPORT, probe_socket_options, format_probe_report, listener_matches
+    )
+    from .config.defaults import LIVE_RELOAD_KEYS, LISTENER_KEYS
+
+
+DRAIN_REPORT_INTERVAL = 5  # Seconds between progress messages while draining
 
 
 class ShadowsocksServer:
     """Shadowsocks server - based on event loop architecture"""
     
-    def __init__(self, config, stats_collector=None, log_callback=None):
+    def __init__(self, config, stats_collector=None, log_callback=None, listeners=None):
         """
         Initialize server
         
@@ -30,16 +55,23 @@ class ShadowsocksServer:
             config: shadowsocks configuration dictionary
             stats_collector: statistics collector instance
             log_callback: log callback function
+            listeners: listening sockets handed over by a previous process, see handover
         """
-        self.config = config
+        self.config = dict(config)
         self.stats_collector = stats_collector or StatsCollector()
         self.log_callback = log_callback
+        self.inherited_listeners = list(listeners or [])
         
-        self.eventloop = None
-        self.tcp_relay = None
-        self.dns_resolver = None
-        self.server_thread = None
+        self.loops = []  # RelayLoop instances, the first one is the primary loop
+        self.reuse_port = False  # Listeners use SO_REUSEPORT (more than one loop)
+        self.replay_filter = None
+        self.crypto_offload = None
+        self.trace_recorder = None
+        self.upstreams = None  # UpstreamPool while upstreams are configured
+        self.egress_shares = EgressShares()  # Splits egress_rate_mbps between the loops' schedulers
+        self.socket_report = {}  # Socket options the kernel accepted, see sockopts
         self.running = False
+        self._drain_deadline = None  # time.monotonic() at which drain() stops the server
         self._lock = threading.Lock()
     
     def _log(self, message):
@@ -61,21 +93,20 @@ class ShadowsocksServer:
         """Log warning message"""
         self._log(f"WARNING: {message}")
     
-    def _stats_callback(self, action, value=None, client_ip=None, target_addr=None):
-        """Statistics callback"""
-        if action == 'add_connection':
-            self.stats_collector.add_connection(value, client_ip, target_addr)
-        elif action == 'remove_connection':
-            self.stats_collector.remove_connection(value)
-        elif action == 'reject_connection':
-            self.stats_collector.reject_connection()
-        elif action == 'update_target_addr':
-            # value is connection_id, client_ip is client_ip, target_addr is target_addr
-            self.stats_collector.update_target_addr(value, target_addr)
-        elif action == 'add_bytes_sent':
-            self.stats_collector.add_bytes_sent(value, client_ip)  # client_ip is actually connection_id
-        elif action == 'add_bytes_received':
-            self.stats_collector.add_bytes_received(value, client_ip)  # client_ip is actually connection_id
+    @property
+    def loop_tasks(self):
+        """Task queue of the primary loop"""
+        return self.loops[0].loop_tasks if self.loops else None
+    
+    @property
+    def server_thread(self):
+        """Thread of the primary loop"""
+        return self.loops[0].thread if self.loops else None
+    
+    @property
+    def tcp_relay(self):
+        """Active relay of the primary loop"""
+        return self.loops[0].tcp_relay if self.loops else None
     
     def start(self):
         """Start server"""
@@ -85,42 +116,47 @@ class ShadowsocksServer:
                 return False
             
             try:
-                # Create event loop
-                self.eventloop = eventloop.EventLoop()
+                if self.config.get('replay_filter', True):
+                    self.replay_filter = ReplayFilter(
+                        capacity=self.config.get('replay_filter_capacity', 100000),
+                        error_rate=self.config.get('replay_filter_error_rate', 1e-6)
+                    )
                 
-                # Create DNS resolver
-                self.dns_resolver = asyncdns.DNSResolver()
-                self.dns_resolver.add_to_loop(self.eventloop)
+                self._configure_crypto_offload()
+                self._configure_trace()
+                self._configure_upstreams()
                 
-                # Create TCP relay (server mode)
-                max_connections = self.config.get('max_connections', 2000)
-                self.tcp_relay = TCPRelayExt(
-                    self.config,
-                    self.dns_resolver,
-                    is_local=False,  # Server mode
-                    stats_callback=self._stats_callback,
-                    log_callback=self._log,
-                    max_connections=max_connections
-                )
-                
-                # Add to event loop
-                self.tcp_relay.add_to_loop(self.eventloop)
+                loop_count = max(1, int(self.config.get('relay_loops', 1) or 1))
+                if loop_count > 1 and SO_REUSEPORT is None:
+                    self.log_warning("SO_REUSEPORT is not available, running a single relay loop")
+                    loop_count = 1
+                self.reuse_port = loop_count > 1
+                if self.reuse_port:
+                    compat.patch_thread_safe_ciphers()
+                # The primary loop writes statistics directly, the others through shards
+                self.loops = [RelayLoop(self, index, loop_count,
+                                        self.stats_collector if index == 0 else self.stats_collector.add_shard())
+                              for index in range(loop_count)]
+                for loop in self.loops:
+                    loop.open()
+                self._close_inherited_listeners()
                 
-                # Start event loop (in separate thread)
+                # Start event loops (in separate threads)
                 self.running = True
-                self.server_thread = threading.Thread(
-                    target=self._run_eventloop,
-                    daemon=True,
-                    name="ShadowsocksServer"
-                )
-                self.server_thread.start()
+                for loop in self.loops:
+                    loop.start()
                 
+                max_connections = self.config.get('max_connections', 2000)
                 server_addr = self.config.get('server', '0.0.0.0')
                 server_port = self.config.get('server_port', 1080)
                 self.log_info(f"Server started successfully, listening on {server_addr}:{server_port}")
                 self.log_info(f"Max connections: {max_connections}")
                 self.log_info(f"Idle timeout: {self.config.get('timeout', 43200)} seconds")
                 self.log_info(f"Encryption method: {self.config.get('method', 'aes-256-cfb')}")
+                if loop_count > 1:
+                    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+                    self.log_info(f"Relay loops: {loop_count} (GIL {'enabled' if gil else 'disabled'})")
+                self._probe_socket_options()
                 
                 return True
             except Exception as e:
@@ -128,43 +164,305 @@ class ShadowsocksServer:
                 import traceback
                 traceback.print_exc()
                 self.running = False
+                self._close_loops()
+                self._close_inherited_listeners()
                 return False
     
-    def _run_eventloop(self):
-        """Run event loop (in separate thread)"""
+    def take_listener(self, config):
+        """Get the next handed-over listening socket if it is bound where config listens, else None"""
+        if not self.inherited_listeners:
+            return None
+        if not listener_matches(self.inherited_listeners[0], config):
+            return None
+        self.log_info(f"Took over listening socket {self.inherited_listeners[0].getsockname()[:2]}")
+        return self.inherited_listeners.pop(0)
+    
+    def _close_inherited_listeners(self):
+        """Close handed-over sockets no relay loop took (their queued connections are reset)"""
+        for sock in self.inherited_listeners:
+            self.log_warning(f"Closing unused handed-over listening socket {sock.getsockname()[:2]}")
+            sock.close()
+        self.inherited_listeners = []
+    
+    def get_listeners(self):
+        """Get the listening sockets of the active relays, primary loop first (for handover)"""
+        return [loop.tcp_relay._server_socket for loop in self.loops
+                if loop.tcp_relay and loop.tcp_relay._server_socket is not None]
+    
+    def apply_config(self, new_config):
+        """
+        Apply configuration to the running server without dropping connections
+        
+        Live keys are updated in place. Listener keys start a new relay and
+        drain the old one, so existing connections finish on the old socket.
+        Every relay loop applies the changes on its own thread.
+        
+        Returns:
+            dict: {'applied': [keys], 'listener_restarted': bool}
+        """
+        changes = {key: value for key, value in new_config.items()
+                   if key in LIVE_RELOAD_KEYS + LISTENER_KEYS and self.config.get(key) != value}
+        if not changes:
+            return {'applied': [], 'listener_restarted': False}
+        
+        if 'method' in changes or 'password' in changes:
+            # Fail before touching anything if the cipher can't be created
+            # (Encryptor calls sys.exit on unknown methods, so check that first)
+            method = changes.get('method', self.config.get('method'))
+            if str(method).lower() not in encrypt.method_supported:
+                raise ValueError(f"Unsupported encryption method: {method}")
+            encrypt.try_cipher(changes.get('password', self.config.get('password')), method)
+        if any(key in ACL_KEYS for key in changes):
+            # Compile the new rules first, raises ValueError on a bad pattern
+            rules = dict(self.config, **changes)
+            for side in ('client', 'target'):
+                AccessList(rules.get(f'{side}_allow'), rules.get(f'{side}_deny'))
+        if any(key in UPSTREAM_KEYS for key in changes):
+            # Raises ValueError on a bad URL, rule or upstream name
+            merged = dict(self.config, **changes)
+            parse_config(merged.get('upstreams'), merged.get('upstream_rules'))
+        
+        with self._lock:
+            running = self.running
+            if self._drain_deadline is not None:
+                raise ValueError("Server is draining, start it again to apply configuration")
+        if not running:
+            self.config.update(changes)
+            return {'applied': sorted(changes), 'listener_restarted': False}
+        
+        old_config = dict(self.config)
+        primary, others = self.loops[0], self.loops[1:]
+        result = primary.loop_tasks.call_and_wait(lambda: self._apply_config_in_loop(changes, old_config))
+        for loop in others:
+            try:
+                loop.loop_tasks.call_and_wait(lambda loop=loop: loop.apply_changes(changes, old_config))
+            except Exception as e:
+                self.log_error(f"{loop.name} kept its previous settings: {e}")
+        return result
+    
+    def _apply_config_in_loop(self, changes, old_config):
+        """Apply config changes (runs on the primary loop thread)"""
+        self.config.update(changes)
+        if 'crypto_offload_threshold' in changes:
+            self._configure_crypto_offload()
+        if any(key in UPSTREAM_KEYS for key in changes):
+            self._configure_upstreams()
         try:
-            self.eventloop.run()
-        except Exception as e:
-            self._log(f"Event loop error: {str(e)}")
-            import traceback
-            traceback.print_exc()
-        finally:
+            if 'trace_file' in changes:
+                self._configure_trace()
+            listener_restarted = self.loops[0].apply_changes(changes, old_config)
+        except (OSError, ValueError):
+            self.config = old_config
+            self._configure_crypto_offload()
+            self._configure_trace()
+            raise
+        if listener_restarted:
+            self.log_info(f"Listening on {self.config.get('server')}:{self.config.get('server_port')}")
+        if any(key in SOCKET_OPTION_KEYS + ('fast_open',) for key in changes):
+            self._probe_socket_options()
+        
+        for key in sorted(changes):
+            if key != 'password':
+                self.log_info(f"Config applied: {key} = {changes[key]}")
+            else:
+                self.log_info("Config applied: password changed")
+        return {'applied': sorted(changes), 'listener_restarted': listener_restarted}
+    
+    def _configure_crypto_offload(self):
+        """Start the crypto offload pool once a threshold is set, or update the threshold"""
+        threshold = int(self.config.get('crypto_offload_threshold', 0) or 0)
+        if self.crypto_offload:
+            # The pool stays: connections with chunks in flight must keep their order
+            self.crypto_offload.threshold = threshold
+            return
+        if threshold <= 0:
+            return
+        self.crypto_offload = CryptoOffload(self.config.get('crypto_offload_workers', 2), threshold)
+        self.crypto_offload.start()
+    
+    def _configure_upstreams(self):
+        """Start the upstream pool once upstreams are configured, update or stop it (raises ValueError)"""
+        upstreams = self.config.get('upstreams') or {}
+        rules = self.config.get('upstream_rules') or {}
+        pool_size = self.config.get('upstream_pool_size', 2)
+        health_interval = self.config.get('upstream_health_interval', 10)
+        if not upstreams:
+            if self.upstreams:
+                # Chained connections keep their sockets, new ones connect directly
+                self.upstreams.stop()
+                self.upstreams = None
+            return
+        if self.upstreams:
+            self.upstreams.configure(upstreams, rules, pool_size, health_interval)
+            return
+        self.upstreams = UpstreamPool(upstreams, rules, pool_size, health_interval, log_callback=self._log)
+        self.upstreams.start()
+        self.log_info(f"Upstream proxies: {', '.join(sorted(self.upstreams.upstreams))}")
+    
+    def _configure_trace(self):
+        """Open a trace recorder for trace_file, close the previous one (raises if the file can't be used)"""
+        path = self.config.get('trace_file') or ''
+        old = self.trace_recorder
+        if (old.path if old else '') == path:
+            return
+        recorder = None
+        if path:
+            max_bytes = int(float(self.config.get('trace_max_mb', 100) or 0) * 1048576)
+            recorder = TraceRecorder(path, max_bytes, log_callback=self.log_warning)
+            self.log_info(f"Recording connection traces to {path}")
+        self.trace_recorder = recorder
+        if old:
+            old.close()
+    
+    def _probe_socket_options(self):
+        """Check and log which socket options the kernel accepts"""
+        report = probe_socket_options(self.config)
+        if self.tcp_relay:
+            report['fast_open']['listener'] = self.tcp_relay.fast_open_active
+        self.socket_report = report
+        self.log_info(format_probe_report(report))
+        if report['fast_open']['enabled'] and not report['fast_open'].get('listener'):
+            self.log_warning("TCP Fast Open was refused on the listening socket")
+    
+    def loop_failed(self, loop):
+        """Mark the server stopped when the primary loop died (called on that loop's thread)"""
+        if loop.index == 0:
             with self._lock:
                 self.running = False
     
+    def get_metrics(self):
+        """Get event loop and relay metrics (counters summed over relay loops)"""
+        if not self.loops or not self.loops[0].loop_monitor:
+            return {}
+        relays = [relay for loop in self.loops for relay in loop.get_relays()]
+        events = sum(relay.events_handled for relay in relays)
+        event_time = sum(relay.event_time for relay in relays)
+        metrics = {
+            'loop': self.loops[0].loop_monitor.get_metrics(),
+            'relay': {
+                'events_handled': events,
+                'event_seconds': round(event_time, 3),
+                'mean_event_us': round(event_time * 1000000 / events, 1) if events else 0,
+                'accepting': all(loop.tcp_relay.is_accepting() for loop in self.loops if loop.tcp_relay),
+                'draining_connections': self.get_draining_connections(),
+                'drain': self.get_drain_status(),
+            },
+            'acl': _merge_acl_stats([loop.tcp_relay.get_acl_stats() for loop in self.loops if loop.tcp_relay]),
+            'replay': self.replay_filter.get_stats() if self.replay_filter else None,
+            'scheduler': _sum_stats([loop.scheduler.get_stats() for loop in self.loops if loop.scheduler]),
+            'crypto_offload': self.crypto_offload.get_stats() if self.crypto_offload else None,
+            'read_chunks': _merge_read_chunk_stats([relay.get_read_chunk_stats() for relay in relays]),
+            'upstreams': self.upstreams.get_stats(_sum_upstream_counters(relays)) if self.upstreams else None,
+            'trace': self.trace_recorder.get_stats() if self.trace_recorder else None,
+            'sockets': self.socket_report,
+            'tcp_info': _sum_stats([loop.tcp_info_sampler.get_metrics()
+                                    for loop in self.loops if loop.tcp_info_sampler],
+                                   keep=('interval', 'batch_size')),
+        }
+        if len(self.loops) > 1:
+            metrics['loops'] = [{
+                'name': loop.name,
+                'lag_ms': loop.loop_monitor.get_metrics()['lag_ms'] if loop.loop_monitor else 0,
+                'connections': loop.tcp_relay.get_handler_count() if loop.tcp_relay else 0,
+                'events_handled': sum(relay.events_handled for relay in loop.get_relays()),
+                'accepting': loop.tcp_relay.is_accepting() if loop.tcp_relay else False,
+            } for loop in self.loops]
+        return metrics
+    
+    def get_draining_connections(self):
+        """Get number of connections still running on replaced listeners"""
+        return sum(loop.get_draining_connections() for loop in self.loops)
+    
+    def get_connection_count(self):
+        """Get number of open connections over all relay loops"""
+        return sum(loop.get_connection_count() for loop in self.loops)
+    
+    def get_drain_status(self):
+        """Get drain progress, None unless drain() is running"""
+        deadline = self._drain_deadline
+        if deadline is None:
+            return None
+        return {
+            'connections': self.get_connection_count(),
+            'seconds_left': round(max(0.0, deadline - time.monotonic()), 1),
+        }
+    
+    def drain(self, timeout=30, cancel=None):
+        """
+        Stop accepting connections and stop the server once the open ones finish
+        
+        Connections still open at the deadline are closed by stop(). Blocks
+        until the server is stopped.
+        
+        Args:
+            timeout: seconds to wait for open connections
+            cancel: threading.Event that cuts the wait short
+        
+        Returns:
+            int: connections still open when the server stopped
+        """
+        with self._lock:
+            if not self.running or self._drain_deadline is not None:
+                return 0
+            deadline = self._drain_deadline = time.monotonic() + max(0, timeout)
+        remaining = 0
+        try:
+            for loop in self.loops:
+                try:
+                    loop.loop_tasks.call_and_wait(loop.drain)
+                except Exception as e:
+                    self.log_error(f"{loop.name} did not stop accepting: {e}")
+            remaining = self.get_connection_count()
+            self.log_info(f"Draining {remaining} connections, stopping within {timeout} seconds")
+            next_report = time.monotonic() + DRAIN_REPORT_INTERVAL
+            while remaining and self.is_running():
+                now = time.monotonic()
+                if now >= deadline or (cancel is not None and cancel.is_set()):
+                    break
+                wait = min(0.2, deadline - now)
+                if cancel is not None:
+                    cancel.wait(wait)
+                else:
+                    time.sleep(wait)
+                remaining = self.get_connection_count()
+                if remaining and now >= next_report:
+                    self.log_info(f"Draining: {remaining} connections left, "
+                                  f"{deadline - now:.0f} seconds to deadline")
+                    next_report = now + DRAIN_REPORT_INTERVAL
+            if remaining:
+                self.log_warning(f"Drain ended with {remaining} connections open, closing them")
+            else:
+                self.log_info("All connections finished")
+        finally:
+            self.stop()
+        return remaining
+    
+    def _close_loops(self):
+        """Close every relay loop and the resources they share"""
+        for loop in self.loops:
+            loop.close()
+            if loop.stats is not self.stats_collector:
+                self.stats_collector.remove_shard(loop.stats)
+        self.loops = []
+        if self.crypto_offload:
+            self.crypto_offload.stop()
+            self.crypto_offload = None
+        if self.trace_recorder:
+            self.trace_recorder.close()
+            self.trace_recorder = None
+        if self.upstreams:
+            self.upstreams.stop()
+            self.upstreams = None
+    
     def stop(self):
         """Stop server"""
         with self._lock:
+            self._drain_deadline = None
             if not self.running:
                 return
             
             self.running = False
-            
-            # Stop event loop
-            if self.eventloop:
-                self.eventloop.stop()
-            
-            # Close TCP relay
-            if self.tcp_relay:
-                self.tcp_relay.close(next_tick=False)
-            
-            # Close DNS resolver
-            if self.dns_resolver:
-                self.dns_resolver.close()
-            
-            # Wait for thread to finish
-            if self.server_thread and self.server_thread.is_alive():
-                self.server_thread.join(timeout=2.0)
+            self._close_loops()
             
             self._log("Server stopped")
     
@@ -177,3 +475,59 @@ class ShadowsocksServer:
         with self._lock:
             return self.running
 
+
+def _sum_stats(items, keep=()):
+    """Add up per-loop counter dicts (`keep` and non-numeric values come from the first), None if empty"""
+    if not items:
+        return None
+    result = dict(items[0])
+    for item in items[1:]:
+        for key, value in item.items():
+            if key not in keep and isinstance(value, (int, float)) and not isinstance(value, bool):
+                result[key] += value
+    return result
+
+
+def _merge_read_chunk_stats(items):
+    """Add up the relays' read size counters, sizes become {size: {reads, bytes, fill}}"""
+    if not items:
+        return None
+    result = _sum_stats(items, keep=('min', 'max'))
+    sizes = {}
+    for item in items:
+        for size, (reads, bytes_count) in item['sizes'].items():
+            counts = sizes.setdefault(size, [0, 0])
+            counts[0] += reads
+            counts[1] += bytes_count
+    # fill: mean share of the buffer a read used
+    result['sizes'] = {str(size): {'reads': reads, 'bytes': bytes_count,
+                                   'fill': round(bytes_count / (reads * size), 3)}
+                       for size, (reads, bytes_count) in sorted(sizes.items())}
+    return result
+
+
+def _sum_upstream_counters(relays):
+    """Add up the relays' counters per upstream name"""
+    result = {}
+    for relay in relays:
+        for name, counters in list(relay.upstream_counters.items()):
+            total = result.get(name)
+            if total is None:
+                total = result[name] = UpstreamCounters()
+            total.add(counters)
+    return result
+
+
+def _merge_acl_stats(items):
+    """Add up rule hit counters of the relay loops' ACLs (all compiled from the same config)"""
+    if not items:
+        return {}
+    result = {}
+    for side in items[0]:
+        merged = dict(items[0][side], rules=[dict(rule) for rule in items[0][side]['rules']])
+        for item in items[1:]:
+            merged['unmatched_denied'] += item[side]['unmatched_denied']
+            for rule, other in zip(merged['rules'], item[side]['rules']):
+                rule['hits'] += other['hits']
+        result[side] = merged
+    return result
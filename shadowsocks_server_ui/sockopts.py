@@ -0,0 +1,175 @@
+"""Socket tuning - TCP options applied to both legs of every connection"""
+import sys
+import socket
+
+IS_LINUX = sys.platform.startswith('linux')
+
+TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN', 23 if IS_LINUX else None)
+# Lets connect() send data in the SYN when a cookie is cached (Linux 4.11+)
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30 if IS_LINUX else None)
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25 if IS_LINUX else None)
+# macOS names the idle time TCP_KEEPALIVE
+TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+TCP_KEEPINTVL = getattr(socket, 'TCP_KEEPINTVL', None)
+TCP_KEEPCNT = getattr(socket, 'TCP_KEEPCNT', None)
+# Several listening sockets on one port, the kernel spreads new connections between them
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
+TFO_SYSCTL = '/proc/sys/net/ipv4/tcp_fastopen'
+
+# Config keys that change the options applied to new connections
+SOCKET_OPTION_KEYS = (
+    'tcp_nodelay',
+    'so_sndbuf',
+    'so_rcvbuf',
+    'tcp_keepalive_idle',
+    'tcp_keepalive_interval',
+    'tcp_keepalive_count',
+    'tcp_notsent_lowat',
+)
+
+
+def build_socket_options(config, remote=False):
+    """
+    Get socket options for a connection leg as (name, level, option, value) tuples
+
+    Built once per config change so accepting a connection is a plain loop of
+    setsockopt calls. Options the platform doesn't define are left out.
+
+    Args:
+        remote: options for the server -> target socket (adds TFO on connect)
+    """
+    options = [('tcp_nodelay', socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                1 if config.get('tcp_nodelay', True) else 0)]
+    if config.get('so_sndbuf'):
+        options.append(('so_sndbuf', socket.SOL_SOCKET, socket.SO_SNDBUF, int(config['so_sndbuf'])))
+    if config.get('so_rcvbuf'):
+        options.append(('so_rcvbuf', socket.SOL_SOCKET, socket.SO_RCVBUF, int(config['so_rcvbuf'])))
+    keepalive_idle = config.get('tcp_keepalive_idle', 0)
+    if keepalive_idle and keepalive_idle > 0:
+        options.append(('so_keepalive', socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        options.append(('tcp_keepalive_idle', socket.IPPROTO_TCP, TCP_KEEPIDLE, int(keepalive_idle)))
+        options.append(('tcp_keepalive_interval', socket.IPPROTO_TCP, TCP_KEEPINTVL,
+                        int(config.get('tcp_keepalive_interval', 30))))
+        options.append(('tcp_keepalive_count', socket.IPPROTO_TCP, TCP_KEEPCNT,
+                        int(config.get('tcp_keepalive_count', 4))))
+    if config.get('tcp_notsent_lowat'):
+        options.append(('tcp_notsent_lowat', socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT,
+                        int(config['tcp_notsent_lowat'])))
+    if remote and config.get('fast_open'):
+        options.append(('tcp_fastopen_connect', socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1))
+    return tuple(option for option in options if option[2] is not None)
+
+
+def listener_socket_options(options):
+    """Get the options that accepted sockets inherit from the listener (buffer sizes)"""
+    return tuple(option for option in options if option[0] in ('so_sndbuf', 'so_rcvbuf'))
+
+
+def apply_socket_options(sock, options):
+    """Apply options, ignoring ones the kernel rejects (reported by probe_socket_options)"""
+    for name, level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError:
+            pass
+
+
+def create_listener(config, reuse_port=False):
+    """
+    Create a bound, non-blocking listening socket for config['server']:config['server_port']
+    
+    Args:
+        reuse_port: set SO_REUSEPORT so each relay loop can have its own listener on the port
+    """
+    addrs = socket.getaddrinfo(config['server'], config['server_port'], 0, socket.SOCK_STREAM, socket.SOL_TCP)
+    if not addrs:
+        raise OSError(f"can't get addrinfo for {config['server']}:{config['server_port']}")
+    af, socktype, proto, _, address = addrs[0]
+    sock = socket.socket(af, socktype, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.setblocking(False)
+        sock.listen(config.get('listen_backlog', 1024))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def listener_matches(sock, config):
+    """Check if a listening socket is bound to config['server']:config['server_port']"""
+    try:
+        addrs = socket.getaddrinfo(config['server'], config['server_port'], 0, socket.SOCK_STREAM, socket.SOL_TCP)
+        return bool(addrs) and sock.family == addrs[0][0] and sock.getsockname()[:2] == addrs[0][4][:2]
+    except OSError:
+        return False
+
+
+def read_tfo_sysctl():
+    """Get Linux net.ipv4.tcp_fastopen value (bit 1: client, bit 2: server), None if unknown"""
+    try:
+        with open(TFO_SYSCTL) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def probe_socket_options(config):
+    """
+    Check which configured options the kernel accepts
+
+    Applies the options to a scratch socket and reads them back (Linux doubles
+    buffer sizes, and caps them at net.core.[rw]mem_max).
+
+    Returns:
+        dict: {'accepted': {name: effective value}, 'rejected': {name: error},
+               'fast_open': {...}}
+    """
+    accepted = {}
+    rejected = {}
+    options = {option[0]: option for option in
+               build_socket_options(config) + build_socket_options(config, remote=True)}
+    family = socket.AF_INET6 if ':' in str(config.get('server', '')) else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        for name, level, option, value in options.values():
+            try:
+                sock.setsockopt(level, option, value)
+                accepted[name] = sock.getsockopt(level, option)
+            except OSError as e:
+                rejected[name] = e.strerror or str(e)
+    finally:
+        sock.close()
+
+    fast_open = {'enabled': bool(config.get('fast_open'))}
+    if fast_open['enabled']:
+        sysctl = read_tfo_sysctl()
+        fast_open['sysctl'] = sysctl
+        if sysctl is not None:
+            fast_open['server'] = bool(sysctl & 2)
+            fast_open['client'] = bool(sysctl & 1)
+        if TCP_FASTOPEN is None:
+            rejected['tcp_fastopen'] = 'not supported on this platform'
+    return {'accepted': accepted, 'rejected': rejected, 'fast_open': fast_open}
+
+
+def format_probe_report(report):
+    """Get one-line summary of a probe report for the log"""
+    parts = [f"{name}={value}" for name, value in sorted(report['accepted'].items())]
+    line = 'Socket options: ' + (', '.join(parts) or 'defaults')
+    if report['rejected']:
+        line += '; rejected: ' + ', '.join(f"{name} ({error})" for name, error in
+                                           sorted(report['rejected'].items()))
+    fast_open = report['fast_open']
+    if fast_open['enabled']:
+        if 'server' not in fast_open:
+            line += '; TCP Fast Open: kernel support unknown'
+        else:
+            line += (f"; TCP Fast Open: server {'on' if fast_open['server'] else 'off'}, "
+                     f"client {'on' if fast_open['client'] else 'off'} "
+                     f"(net.ipv4.tcp_fastopen={fast_open['sysctl']})")
+    return line
@@ -1,7 +1,207 @@
 """Statistics collector"""
+import json
 import time
+import heapq
+import base64
+import bisect
 import threading
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+
+try:
+    from shadowsocks_server_ui.stats.targets import TargetNormalizer
+    from shadowsocks_server_ui.stats.histogram import LogLinearHistogram
+except ImportError:
+    from .targets import TargetNormalizer
+    from .histogram import LogLinearHistogram
+
+
+def _client_total(item):
+    return item[1]['total_bytes_sent'] + item[1]['total_bytes_received']
+
+
+def _target_total(item):
+    return item[1]['bytes_sent'] + item[1]['bytes_received']
+
+
+def _connection_total(item):
+    return item[1].bytes_sent + item[1].bytes_received
+
+
+# Sort keys for paginated queries, items are (key, stats) pairs
+CLIENT_SORT_KEYS = {
+    'total_bytes': _client_total,
+    'bytes_sent': lambda item: item[1]['total_bytes_sent'],
+    'bytes_received': lambda item: item[1]['total_bytes_received'],
+    'active_connections': lambda item: len(item[1]['connections']),
+    'client_ip': lambda item: item[0],
+}
+TARGET_SORT_KEYS = {
+    'total_bytes': _target_total,
+    'bytes_sent': lambda item: item[1]['bytes_sent'],
+    'bytes_received': lambda item: item[1]['bytes_received'],
+    'active_connections': lambda item: item[1]['connections'],
+    'address': lambda item: item[0],
+}
+TCP_PATH_SORT_KEYS = {
+    'rtt_us': lambda item: item[1]['rtt_us'],
+    'min_rtt_us': lambda item: item[1]['min_rtt_us'] or 0,
+    'retransmits': lambda item: item[1]['retransmits'],
+    'delivery_rate': lambda item: item[1]['delivery_rate'] or 0,
+    'samples': lambda item: item[1]['samples'],
+    'address': lambda item: item[0],
+}
+TCP_PATH_SIDES = ('client', 'target')
+CONNECTION_SORT_KEYS = {
+    'start_time': lambda item: item[1].time,
+    'total_bytes': _connection_total,
+    'bytes_sent': lambda item: item[1].bytes_sent,
+    'bytes_received': lambda item: item[1].bytes_received,
+    'client_ip': lambda item: item[1].client_ip or '',
+}
+
+
+def select_page(items, key, descending=True, offset=0, limit=50):
+    """
+    Pick one page of items without sorting the whole collection
+    
+    Uses a bounded heap, so cost is O(n log(offset + limit)) instead of O(n log n).
+    
+    Returns:
+        tuple: (page items, total item count)
+    """
+    items = items if isinstance(items, list) else list(items)
+    count = offset + limit
+    if descending:
+        top = heapq.nlargest(count, items, key=key)
+    else:
+        top = heapq.nsmallest(count, items, key=key)
+    return top[offset:count], len(items)
+
+
+def encode_cursor(sort, value, key):
+    """Get an opaque cursor pointing after the item with this sort value and key"""
+    data = json.dumps([sort, value, key], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """
+    Get (sort value, key) from a cursor made by encode_cursor
+
+    Raises:
+        ValueError: malformed cursor, or one from a listing with another sort key
+    """
+    try:
+        cursor_sort, value, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor") from None
+    if cursor_sort != sort:
+        raise ValueError(f"Cursor belongs to sort key {cursor_sort}, not {sort}")
+    return value, key
+
+
+class SortIndex:
+    """
+    Keys in the order of one sort key, maintained as statistics change
+
+    Writers only add changed keys to `dirty`. A read re-positions those with
+    a binary search before paging, so a page costs O(changed log n + limit)
+    instead of a pass over every item; when most keys changed it re-sorts.
+    Ties are ordered by key, which keeps cursors stable.
+    """
+    __slots__ = ('sort_key', 'entries', 'values', 'dirty')
+
+    def __init__(self, sort_key, keys=()):
+        """
+        Args:
+            sort_key: function of (key, stats) giving the sort value
+            keys: keys to index, positioned on the first refresh
+        """
+        self.sort_key = sort_key
+        self.entries = []  # (sort value, key) ascending
+        self.values = {}  # key -> sort value it is stored under in entries
+        self.dirty = set(keys)
+
+    def refresh(self, lookup):
+        """Re-position changed keys; lookup(key) gives their stats, None when they left the index"""
+        dirty, self.dirty = self.dirty, set()
+        if len(dirty) * 16 > len(self.values):
+            for key in dirty:
+                stats = lookup(key)
+                if stats is None:
+                    self.values.pop(key, None)
+                else:
+                    self.values[key] = self.sort_key((key, stats))
+            self.entries = sorted((value, key) for key, value in self.values.items())
+            return
+        entries = self.entries
+        for key in dirty:
+            stats = lookup(key)
+            value = None if stats is None else self.sort_key((key, stats))
+            old = self.values.get(key)
+            if old is not None:
+                if stats is not None and old == value:
+                    continue
+                del entries[bisect.bisect_left(entries, (old, key))]
+            if stats is None:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = value
+                bisect.insort(entries, (value, key))
+
+    def page(self, descending=True, offset=0, limit=50, after=None, match=None):
+        """
+        Get one page of keys
+
+        Args:
+            after: (sort value, key) of the item before the page, from a cursor
+            match: filter on key, keys failing it are skipped and not counted
+
+        Returns:
+            tuple: (page keys, total matching keys, (sort value, key) of the last item if more follow)
+        """
+        entries = self.entries
+        start = len(entries)
+        try:
+            if after is not None:
+                after = tuple(after)
+                start = bisect.bisect_left(entries, after) if descending else bisect.bisect_right(entries, after)
+        except TypeError:
+            raise ValueError("Invalid cursor") from None
+        positions = range(start - 1, -1, -1) if descending else range(0 if after is None else start, len(entries))
+        if match is None:
+            total = len(entries)
+            selected = positions[offset:offset + limit + 1]
+        else:
+            total = sum(1 for _, key in entries if match(key))
+            selected = []
+            skip = offset
+            for position in positions:
+                if not match(entries[position][1]):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                selected.append(position)
+                if len(selected) > limit:
+                    break
+        keys = [entries[position][1] for position in selected[:limit]]
+        more = entries[selected[limit - 1]] if len(selected) > limit else None
+        return keys, total, more
+
+
+class ConnectionRecord:
+    """Statistics of one active connection (slotted, there can be thousands of idle ones)"""
+    __slots__ = ('time', 'client_ip', 'target_addr', 'target_key', 'target_ip', 'bytes_sent', 'bytes_received')
+    
+    def __init__(self, client_ip, target_addr, target_key, started=None):
+        self.time = started or time.time()
+        self.client_ip = client_ip
+        self.target_addr = target_addr
+        self.target_key = target_key
+        self.target_ip = None  # Resolved address the relay connected to
+        self.bytes_sent = 0
+        self.bytes_received = 0
 
 
 class StatsCollector:
@@ -18,66 +218,155 @@ class StatsCollector:
             'bytes_received': 0,
             'start_time': time.time(),
         }
-        self.connection_times = {}  # connection_id -> connect_time
+        self.connection_times = {}  # connection_id -> ConnectionRecord
+        # Clients with at least one active connection (kept in sync on add/remove)
+        self.active_clients = set()
+        # Sort indexes of paginated listings, created by the first query for a sort key
+        self._client_indexes = {}  # (sort, active_only) -> SortIndex
+        self._dirty_clients = set()  # Clients changed since the client indexes were refreshed
+        self._target_indexes = {}  # client_ip -> {(sort, active_only): SortIndex}, active clients only
+        self._dirty_targets = {}  # client_ip -> target keys changed since its indexes were refreshed
         # Statistics for each client IP
         self.client_stats = {}  # client_ip -> {
         #     'connections': set of connection_ids,
         #     'total_bytes_sent': int,
         #     'total_bytes_received': int,
-        #     'targets': {target_addr: {'connections': int, 'bytes_sent': int, 'bytes_received': int}}
+        #     'targets': {target_key: {'connections': int, 'bytes_sent': int, 'bytes_received': int,
+        #                              'raw': {target_addr: bytes} (top-N raw addresses),
+        #                              'ip': last resolved address (once connected)}}
         # }
+        # Targets are keyed by their roll-up (domain / IP prefix), see configure()
+        self.target_normalizer = TargetNormalizer()
+        self.raw_targets_top_n = 10
+        # Traffic since the last checkpoint, drained by StatsPersister
+        self._pending = {}  # (client_ip, target_addr) -> [connections, bytes_sent, bytes_received]
+        # Lifetime totals restored from the store, applied when a client reconnects
+        self._client_baseline = {}  # client_ip -> (bytes_sent, bytes_received)
+        # Connection lifecycle latency histograms (microseconds)
+        self.latency = {}  # stage -> LogLinearHistogram
+        # Kernel TCP_INFO samples per client IP and per target roll-up key
+        self.tcp_paths = {side: OrderedDict() for side in TCP_PATH_SIDES}  # least recently sampled first
+        self.tcp_rtt = {side: LogLinearHistogram() for side in TCP_PATH_SIDES}  # microseconds
+        self.max_tcp_paths = 10000  # Entries kept per side
+        # Write buffers of extra relay loops, merged before every read
+        self.shards = []
+        self._merge_lock = threading.Lock()  # Keeps each shard's events in order across mergers
     
-    def add_connection(self, connection_id, client_ip=None, target_addr=None):
-        """Add connection"""
+    def _new_client_stats(self, client_ip):
+        """Create statistics entry for a client, seeded from restored totals"""
+        sent, received = self._client_baseline.pop(client_ip, (0, 0))
+        return {
+            'connections': set(),
+            'total_bytes_sent': sent,
+            'total_bytes_received': received,
+            'targets': {}
+        }
+    
+    def configure(self, config):
+        """Apply statistics settings (target roll-up) from configuration"""
+        with self.lock:
+            self.target_normalizer = TargetNormalizer(
+                mode=config.get('target_rollup', 'domain'),
+                ipv4_prefix=config.get('target_rollup_ipv4_prefix', 24),
+                ipv6_prefix=config.get('target_rollup_ipv6_prefix', 48),
+                keep_port=config.get('target_rollup_keep_port', False)
+            )
+            self.raw_targets_top_n = config.get('target_raw_top_n', 10)
+    
+    @staticmethod
+    def _target_stats(client_stats, target_key):
+        """Get or create statistics entry for a target key"""
+        target_stats = client_stats['targets'].get(target_key)
+        if target_stats is None:
+            target_stats = client_stats['targets'][target_key] = {
+                'connections': 0,
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'raw': {}
+            }
+        return target_stats
+    
+    def _record_raw_target(self, target_stats, target_addr, bytes_count):
+        """Credit traffic to a raw address, keeping only the top-N per roll-up key"""
+        raw = target_stats['raw']
+        if self.raw_targets_top_n <= 0:
+            return
+        if target_addr in raw:
+            raw[target_addr] += bytes_count
+            return
+        if len(raw) >= self.raw_targets_top_n:
+            smallest = min(raw, key=raw.get)
+            if raw[smallest] >= bytes_count:
+                return
+            del raw[smallest]
+        raw[target_addr] = bytes_count
+    
+    def _pending_entry(self, client_ip, target_addr):
+        """Get pending checkpoint counters for a client/target pair"""
+        key = (client_ip, target_addr)
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._pending[key] = [0, 0, 0]
+        return entry
+    
+    def _touch(self, client_ip, target_key=None):
+        """Queue a client, and one of its targets, for re-positioning in the sort indexes (lock held)"""
+        if self._client_indexes:
+            self._dirty_clients.add(client_ip)
+        if target_key:
+            dirty = self._dirty_targets.get(client_ip)
+            if dirty is not None:
+                dirty.add(target_key)
+    
+    def add_connection(self, connection_id, client_ip=None, target_addr=None, started=None):
+        """Add connection (started: accept time if recorded earlier, e.g. by a StatsShard)"""
         with self.lock:
             self.stats['total_connections'] += 1
             self.stats['active_connections'] += 1
-            self.connection_times[connection_id] = {
-                'time': time.time(),
-                'client_ip': client_ip,
-                'target_addr': target_addr
-            }
+            record = self.connection_times[connection_id] = ConnectionRecord(
+                client_ip, target_addr, self.target_normalizer.normalize(target_addr), started)
             
             # Update client statistics
             if client_ip:
                 if client_ip not in self.client_stats:
-                    self.client_stats[client_ip] = {
-                        'connections': set(),
-                        'total_bytes_sent': 0,
-                        'total_bytes_received': 0,
-                        'targets': {}
-                    }
+                    self.client_stats[client_ip] = self._new_client_stats(client_ip)
                 self.client_stats[client_ip]['connections'].add(connection_id)
+                self.active_clients.add(client_ip)
                 
                 # Update target address statistics
-                if target_addr:
-                    if target_addr not in self.client_stats[client_ip]['targets']:
-                        self.client_stats[client_ip]['targets'][target_addr] = {
-                            'connections': 0,
-                            'bytes_sent': 0,
-                            'bytes_received': 0
-                        }
-                    self.client_stats[client_ip]['targets'][target_addr]['connections'] += 1
+                target_key = record.target_key
+                if target_key:
+                    self._target_stats(self.client_stats[client_ip], target_key)['connections'] += 1
+                    self._pending_entry(client_ip, target_key)[0] += 1
+                self._touch(client_ip, target_key)
     
     def remove_connection(self, connection_id):
-        """Remove connection"""
+        """Remove connection (unknown IDs are ignored, so counters can't drift)"""
         with self.lock:
-            conn_info = self.connection_times.get(connection_id)
-            if conn_info:
-                client_ip = conn_info.get('client_ip') if isinstance(conn_info, dict) else None
-                target_addr = conn_info.get('target_addr') if isinstance(conn_info, dict) else None
-                del self.connection_times[connection_id]
+            conn_info = self.connection_times.pop(connection_id, None)
+            if conn_info is None:
+                return
+            client_ip = conn_info.client_ip
+            target_key = conn_info.target_key
+            
+            # Update client statistics
+            if client_ip and client_ip in self.client_stats:
+                self.client_stats[client_ip]['connections'].discard(connection_id)
+                self._touch(client_ip, target_key)
+                if not self.client_stats[client_ip]['connections']:
+                    self.active_clients.discard(client_ip)
+                    # Rebuilt on demand, so target indexes are only kept for active clients
+                    self._target_indexes.pop(client_ip, None)
+                    self._dirty_targets.pop(client_ip, None)
                 
-                # Update client statistics
-                if client_ip and client_ip in self.client_stats:
-                    self.client_stats[client_ip]['connections'].discard(connection_id)
-                    
-                    # Update active connection count for target address
-                    if target_addr and target_addr in self.client_stats[client_ip]['targets']:
-                        self.client_stats[client_ip]['targets'][target_addr]['connections'] = max(0, 
-                            self.client_stats[client_ip]['targets'][target_addr]['connections'] - 1)
+                # Update active connection count for target address
+                if target_key and target_key in self.client_stats[client_ip]['targets']:
+                    target_stats = self.client_stats[client_ip]['targets'][target_key]
+                    target_stats['connections'] = max(0, target_stats['connections'] - 1)
+                    self._record_raw_target(target_stats, conn_info.target_addr,
+                                            conn_info.bytes_sent + conn_info.bytes_received)
             
-            self.stats['active_connections'] = max(0, self.stats['active_connections'] - 1)
+            self.stats['active_connections'] -= 1
             self.stats['closed_connections'] += 1
     
     def reject_connection(self):
@@ -89,33 +378,62 @@ class StatsCollector:
         """Update target address of connection"""
         with self.lock:
             conn_info = self.connection_times.get(connection_id)
-            if conn_info and isinstance(conn_info, dict):
-                client_ip = conn_info.get('client_ip')
-                old_target = conn_info.get('target_addr')
+            if conn_info:
+                client_ip = conn_info.client_ip
+                old_target = conn_info.target_addr
                 
                 # If target address has not changed, no need to update
                 if old_target == target_addr:
                     return
                 
                 # Update target address in connection info
-                conn_info['target_addr'] = target_addr
+                conn_info.target_addr = target_addr
+                old_key = conn_info.target_key
+                target_key = conn_info.target_key = self.target_normalizer.normalize(target_addr)
+                # Different raw address under the same roll-up key (e.g. another CDN shard)
+                if old_key == target_key:
+                    return
                 
                 # If client IP exists, update client statistics
                 if client_ip and client_ip in self.client_stats:
                     # If there was a previous target address, need to remove connection from old target address
-                    if old_target and old_target in self.client_stats[client_ip]['targets']:
-                        self.client_stats[client_ip]['targets'][old_target]['connections'] = max(0, 
-                            self.client_stats[client_ip]['targets'][old_target]['connections'] - 1)
+                    if old_key and old_key in self.client_stats[client_ip]['targets']:
+                        old_stats = self.client_stats[client_ip]['targets'][old_key]
+                        old_stats['connections'] = max(0, old_stats['connections'] - 1)
+                        self._touch(client_ip, old_key)
                     
                     # Add to new target address
-                    if target_addr:
-                        if target_addr not in self.client_stats[client_ip]['targets']:
-                            self.client_stats[client_ip]['targets'][target_addr] = {
-                                'connections': 0,
-                                'bytes_sent': 0,
-                                'bytes_received': 0
-                            }
-                        self.client_stats[client_ip]['targets'][target_addr]['connections'] += 1
+                    if target_key:
+                        self._target_stats(self.client_stats[client_ip], target_key)['connections'] += 1
+                        self._set_target_ip(conn_info)
+                        self._touch(client_ip, target_key)
+                        if not old_key:
+                            self._pending_entry(client_ip, target_key)[0] += 1
+    
+    def update_target_ip(self, connection_id, target_ip):
+        """Record the address a connection's target resolved to (for GeoIP attribution)"""
+        with self.lock:
+            conn_info = self.connection_times.get(connection_id)
+            if conn_info:
+                conn_info.target_ip = target_ip
+                self._set_target_ip(conn_info)
+    
+    def _set_target_ip(self, conn_info):
+        """Copy a connection's resolved address to its target entry (lock held)"""
+        if not conn_info.target_ip or not conn_info.target_key:
+            return
+        client_stats = self.client_stats.get(conn_info.client_ip)
+        target_stats = client_stats['targets'].get(conn_info.target_key) if client_stats else None
+        if target_stats is not None:
+            target_stats['ip'] = conn_info.target_ip
+    
+    def get_target_ips(self):
+        """Get the last resolved address of every target roll-up key"""
+        self.merge_shards()
+        with self.lock:
+            return {target_key: target_stats['ip']
+                    for stats in self.client_stats.values()
+                    for target_key, target_stats in stats['targets'].items() if 'ip' in target_stats}
     
     def add_bytes_sent(self, bytes_count, connection_id=None):
         """Increase bytes sent"""
@@ -125,14 +443,17 @@ class StatsCollector:
             # Update connection and client statistics
             if connection_id:
                 conn_info = self.connection_times.get(connection_id)
-                if conn_info and isinstance(conn_info, dict):
-                    client_ip = conn_info.get('client_ip')
-                    target_addr = conn_info.get('target_addr')
+                if conn_info:
+                    client_ip = conn_info.client_ip
+                    target_key = conn_info.target_key
+                    conn_info.bytes_sent += bytes_count
                     
                     if client_ip and client_ip in self.client_stats:
                         self.client_stats[client_ip]['total_bytes_sent'] += bytes_count
-                        if target_addr and target_addr in self.client_stats[client_ip]['targets']:
-                            self.client_stats[client_ip]['targets'][target_addr]['bytes_sent'] += bytes_count
+                        if target_key and target_key in self.client_stats[client_ip]['targets']:
+                            self.client_stats[client_ip]['targets'][target_key]['bytes_sent'] += bytes_count
+                        self._pending_entry(client_ip, target_key)[1] += bytes_count
+                        self._touch(client_ip, target_key)
     
     def add_bytes_received(self, bytes_count, connection_id=None):
         """Increase bytes received"""
@@ -142,47 +463,163 @@ class StatsCollector:
             # Update connection and client statistics
             if connection_id:
                 conn_info = self.connection_times.get(connection_id)
-                if conn_info and isinstance(conn_info, dict):
-                    client_ip = conn_info.get('client_ip')
-                    target_addr = conn_info.get('target_addr')
+                if conn_info:
+                    client_ip = conn_info.client_ip
+                    target_key = conn_info.target_key
+                    conn_info.bytes_received += bytes_count
                     
                     if client_ip and client_ip in self.client_stats:
                         self.client_stats[client_ip]['total_bytes_received'] += bytes_count
-                        if target_addr and target_addr in self.client_stats[client_ip]['targets']:
-                            self.client_stats[client_ip]['targets'][target_addr]['bytes_received'] += bytes_count
+                        if target_key and target_key in self.client_stats[client_ip]['targets']:
+                            self.client_stats[client_ip]['targets'][target_key]['bytes_received'] += bytes_count
+                        self._pending_entry(client_ip, target_key)[2] += bytes_count
+                        self._touch(client_ip, target_key)
+    
+    def _target_entry(self, target_addr, target_stats, include_raw=False):
+        """Build API representation of a target address (roll-up key)"""
+        entry = {
+            'address': target_addr,
+            'active_connections': target_stats['connections'],
+            'bytes_sent': target_stats['bytes_sent'],
+            'bytes_received': target_stats['bytes_received'],
+            'total_bytes': target_stats['bytes_sent'] + target_stats['bytes_received'],
+            'ip': target_stats.get('ip'),
+        }
+        if include_raw:
+            # Raw addresses are credited when their connections close
+            raw = sorted(target_stats['raw'].items(), key=lambda item: item[1], reverse=True)
+            entry['raw_targets'] = [{'address': addr, 'total_bytes': total} for addr, total in raw]
+        return entry
+    
+    def _client_entry(self, client_ip, stats):
+        """Build API representation of a client (without targets)"""
+        return {
+            'client_ip': client_ip,
+            'active_connections': len(stats['connections']),
+            'total_bytes_sent': stats['total_bytes_sent'],
+            'total_bytes_received': stats['total_bytes_received'],
+            'total_bytes': stats['total_bytes_sent'] + stats['total_bytes_received'],
+            'target_count': len(stats['targets'])
+        }
+    
+    def record_latency(self, durations):
+        """Record lifecycle stage durations of one connection ({stage: seconds})"""
+        with self.lock:
+            for stage, seconds in durations.items():
+                histogram = self.latency.get(stage)
+                if histogram is None:
+                    histogram = self.latency[stage] = LogLinearHistogram()
+                histogram.record(seconds * 1000000)
+    
+    def record_tcp_info(self, samples):
+        """
+        Record a batch of TCP_INFO samples
+        
+        Args:
+            samples: [(connection_id, 'client' or 'target', info)] with info from
+                tcpinfo.parse_tcp_info plus 'retransmits' since the previous sample
+        """
+        with self.lock:
+            for connection_id, side, info in samples:
+                conn_info = self.connection_times.get(connection_id)
+                if not conn_info:
+                    continue
+                key = conn_info.client_ip if side == 'client' else conn_info.target_key
+                if not key:
+                    continue
+                paths = self.tcp_paths[side]
+                path = paths.get(key)
+                if path is None:
+                    if len(paths) >= self.max_tcp_paths:
+                        paths.popitem(last=False)
+                    path = paths[key] = {
+                        'samples': 0,
+                        'rtt_us': info['rtt_us'],
+                        'min_rtt_us': None,
+                        'retransmits': 0,
+                        'delivery_rate': None,
+                        'snd_cwnd': 0,
+                    }
+                else:
+                    paths.move_to_end(key)
+                    # Smoothed like the kernel's srtt (gain 1/8)
+                    path['rtt_us'] += (info['rtt_us'] - path['rtt_us']) // 8
+                path['samples'] += 1
+                path['retransmits'] += info['retransmits']
+                path['snd_cwnd'] = info['snd_cwnd']
+                if info['min_rtt_us']:
+                    path['min_rtt_us'] = min(path['min_rtt_us'] or info['min_rtt_us'], info['min_rtt_us'])
+                if info['delivery_rate'] is not None:
+                    path['delivery_rate'] = info['delivery_rate']
+                self.tcp_rtt[side].record(info['rtt_us'])
+    
+    def list_tcp_paths(self, side='client', sort='rtt_us', descending=True, offset=0, limit=50):
+        """
+        Get one page of TCP path statistics for clients or targets
+        
+        Returns:
+            dict: page result plus 'rtt_us' (RTT distribution of all samples on this side)
+        """
+        if side not in TCP_PATH_SIDES:
+            raise ValueError(f"Invalid side: {side}")
+        if sort not in TCP_PATH_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        self.merge_shards()
+        with self.lock:
+            page, total = select_page(self.tcp_paths[side].items(), TCP_PATH_SORT_KEYS[sort],
+                                      descending, offset, limit)
+            result = self._page_result([dict(path, address=key) for key, path in page], total, offset, limit)
+            result['rtt_us'] = self.tcp_rtt[side].summary()
+            return result
+    
+    def get_latency_stats(self, include_buckets=False):
+        """
+        Get latency summaries per lifecycle stage
+        
+        Returns:
+            dict: {stage: {'count', 'mean', 'min', 'max', 'p50', 'p90', 'p99', 'p999'}}
+                in microseconds, plus 'buckets' ([low, high, count]) if requested
+        """
+        self.merge_shards()
+        with self.lock:
+            result = {}
+            for stage, histogram in self.latency.items():
+                result[stage] = histogram.summary()
+                if include_buckets:
+                    result[stage]['buckets'] = histogram.buckets()
+            return result
     
-    def get_stats(self):
-        """Get statistics"""
+    def get_stats(self, max_clients=None, max_targets=None):
+        """
+        Get statistics
+        
+        Args:
+            max_clients: only include the top clients by traffic (None = all)
+            max_targets: only include the top targets per client (None = all)
+        """
+        self.merge_shards()
         with self.lock:
-            # Build client statistics
+            # Build client statistics (only clients with active connections)
+            if max_clients is not None:
+                top, _, _ = self._client_index('total_bytes', True).page(limit=max_clients)
+                active = [(client_ip, self.client_stats[client_ip]) for client_ip in top]
+            else:
+                active = [(client_ip, self.client_stats[client_ip]) for client_ip in self.active_clients]
+            
             client_stats_list = []
-            for client_ip, stats in self.client_stats.items():
-                active_conns = len(stats['connections'])
-                # Only show clients with active connections
-                if active_conns > 0:
-                    targets_list = []
-                    for target_addr, target_stats in stats['targets'].items():
-                        # Only show target addresses with active connections
-                        if target_stats['connections'] > 0:
-                            target_total = target_stats['bytes_sent'] + target_stats['bytes_received']
-                            targets_list.append({
-                                'address': target_addr,
-                                'active_connections': target_stats['connections'],
-                                'bytes_sent': target_stats['bytes_sent'],
-                                'bytes_received': target_stats['bytes_received'],
-                                'total_bytes': target_total
-                            })
-                    # Sort by active connections, then by total traffic
-                    targets_list.sort(key=lambda x: (x['active_connections'], x['total_bytes']), reverse=True)
-                    
-                    client_stats_list.append({
-                        'client_ip': client_ip,
-                        'active_connections': active_conns,
-                        'total_bytes_sent': stats['total_bytes_sent'],
-                        'total_bytes_received': stats['total_bytes_received'],
-                        'total_bytes': stats['total_bytes_sent'] + stats['total_bytes_received'],
-                        'targets': targets_list
-                    })
+            for client_ip, stats in active:
+                # Only show target addresses with active connections
+                targets = [item for item in stats['targets'].items() if item[1]['connections'] > 0]
+                # Sort by active connections, then by total traffic
+                sort_key = lambda item: (item[1]['connections'], _target_total(item))
+                if max_targets is not None:
+                    targets, _ = select_page(targets, sort_key, offset=0, limit=max_targets)
+                else:
+                    targets.sort(key=sort_key, reverse=True)
+                
+                entry = self._client_entry(client_ip, stats)
+                entry['targets'] = [self._target_entry(addr, target_stats) for addr, target_stats in targets]
+                client_stats_list.append(entry)
             
             # Sort by total traffic
             client_stats_list.sort(key=lambda x: x['total_bytes'], reverse=True)
@@ -196,11 +633,155 @@ class StatsCollector:
                 'bytes_received': self.stats['bytes_received'],
                 'total_traffic': self.stats['bytes_sent'] + self.stats['bytes_received'],
                 'uptime': int(time.time() - self.stats['start_time']),
+                'active_clients': len(self.active_clients),
                 'client_stats': client_stats_list  # Statistics for each client
             }
     
+    def _client_index(self, sort, active_only):
+        """Get the refreshed client index of a sort key (lock held)"""
+        if self._dirty_clients:
+            for index in self._client_indexes.values():
+                index.dirty |= self._dirty_clients
+            self._dirty_clients.clear()
+        index = self._client_indexes.get((sort, active_only))
+        if index is None:
+            index = self._client_indexes[(sort, active_only)] = SortIndex(
+                CLIENT_SORT_KEYS[sort], self.active_clients if active_only else self.client_stats)
+        client_stats = self.client_stats
+        if active_only:
+            active = self.active_clients
+            index.refresh(lambda client_ip: client_stats[client_ip] if client_ip in active else None)
+        else:
+            index.refresh(client_stats.get)
+        return index
+    
+    def _target_index(self, client_ip, sort, active_only):
+        """Get the refreshed index of a client's targets for a sort key (lock held)"""
+        targets = self.client_stats[client_ip]['targets']
+        indexes = self._target_indexes.get(client_ip)
+        if indexes is None:
+            indexes = {}
+            if client_ip in self.active_clients:
+                self._target_indexes[client_ip] = indexes
+                self._dirty_targets[client_ip] = set()
+        dirty = self._dirty_targets.get(client_ip)
+        if dirty:
+            for index in indexes.values():
+                index.dirty |= dirty
+            dirty.clear()
+        index = indexes.get((sort, active_only))
+        if index is None:
+            keys = [key for key, stats in targets.items() if stats['connections'] > 0] if active_only else targets
+            index = indexes[(sort, active_only)] = SortIndex(TARGET_SORT_KEYS[sort], keys)
+        if active_only:
+            index.refresh(lambda key: targets[key] if key in targets and targets[key]['connections'] > 0 else None)
+        else:
+            index.refresh(targets.get)
+        return index
+    
+    def list_clients(self, sort='total_bytes', descending=True, offset=0, limit=50,
+                     ip_prefix=None, active_only=True, min_bytes=0, cursor=None):
+        """
+        Get one page of clients, after `cursor` if given or else from `offset`
+        
+        Returns:
+            dict: {'items': [...], 'total': int, 'offset': int, 'limit': int, 'next_offset': int or None,
+                   'next_cursor': str or None}
+        """
+        if sort not in CLIENT_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        after = decode_cursor(cursor, sort) if cursor else None
+        self.merge_shards()
+        with self.lock:
+            client_stats = self.client_stats
+            match = None
+            if ip_prefix or min_bytes:
+                # Filters are checked along the index, counting the total visits every client
+                def match(client_ip):
+                    return (client_ip.startswith(ip_prefix or '')
+                            and _client_total((client_ip, client_stats[client_ip])) >= min_bytes)
+            keys, total, more = self._client_index(sort, active_only).page(
+                descending, 0 if after else offset, limit, after, match)
+            return self._page_result([self._client_entry(client_ip, client_stats[client_ip]) for client_ip in keys],
+                                     total, offset, limit, sort, more, after is not None)
+    
+    def list_targets(self, client_ip, sort='total_bytes', descending=True, offset=0, limit=50,
+                     query=None, active_only=False, cursor=None):
+        """
+        Get one page of target addresses for a client, after `cursor` if given or else from `offset`
+        
+        Returns:
+            dict: page result, or None if the client is unknown
+        """
+        if sort not in TARGET_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        after = decode_cursor(cursor, sort) if cursor else None
+        self.merge_shards()
+        with self.lock:
+            stats = self.client_stats.get(client_ip)
+            if stats is None:
+                return None
+            targets = stats['targets']
+            match = (lambda key: query in key) if query else None
+            keys, total, more = self._target_index(client_ip, sort, active_only).page(
+                descending, 0 if after else offset, limit, after, match)
+            return self._page_result([self._target_entry(key, targets[key], include_raw=True) for key in keys],
+                                     total, offset, limit, sort, more, after is not None)
+    
+    def list_connections(self, sort='start_time', descending=True, offset=0, limit=50,
+                         client_ip=None, query=None, cursor=None):
+        """Get one page of active connections, after `cursor` if given or else from `offset`"""
+        if sort not in CONNECTION_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        after = tuple(decode_cursor(cursor, sort)) if cursor else None
+        self.merge_shards()
+        now = time.time()
+        with self.lock:
+            if client_ip:
+                # Use the per-client index instead of scanning every connection
+                stats = self.client_stats.get(client_ip)
+                ids = stats['connections'] if stats else ()
+                items = [(conn_id, self.connection_times[conn_id]) for conn_id in ids
+                         if conn_id in self.connection_times]
+            else:
+                items = self.connection_times.items()
+            if query:
+                items = [item for item in items if query in (item[1].target_addr or '')]
+            total = len(items)
+            # Byte counts change on every write, so connections are selected per request
+            sort_key = CONNECTION_SORT_KEYS[sort]
+            position = lambda item: (sort_key(item), item[0])
+            if after is not None:
+                try:
+                    items = [item for item in items if (position(item) < after) == descending
+                             and position(item) != after]
+                except TypeError:
+                    raise ValueError("Invalid cursor") from None
+                offset = 0
+            page, _ = select_page(items, position, descending, offset, limit + 1)
+            more = position(page[limit - 1]) if len(page) > limit else None
+            result = [{
+                'connection_id': conn_id,
+                'client_ip': info.client_ip,
+                'target_addr': info.target_addr,
+                'duration': int(now - info.time),
+                'bytes_sent': info.bytes_sent,
+                'bytes_received': info.bytes_received,
+                'total_bytes': info.bytes_sent + info.bytes_received
+            } for conn_id, info in page[:limit]]
+            return self._page_result(result, total, offset, limit, sort, more, after is not None)
+    
+    @staticmethod
+    def _page_result(items, total, offset, limit, sort=None, more=None, by_cursor=False):
+        """Wrap one page of results, more is the (sort value, key) of its last item if another page follows"""
+        next_offset = offset + limit if offset + limit < total and not by_cursor else None
+        next_cursor = encode_cursor(sort, *more) if more is not None else None
+        return {'items': items, 'total': total, 'offset': offset, 'limit': limit, 'next_offset': next_offset,
+                'next_cursor': next_cursor}
+    
     def reset(self):
         """Reset statistics"""
+        self.merge_shards()
         with self.lock:
             self.stats = {
                 'total_connections': 0,
@@ -213,4 +794,203 @@ class StatsCollector:
             }
             self.connection_times.clear()
             self.client_stats.clear()
+            self.active_clients.clear()
+            self._client_indexes.clear()
+            self._dirty_clients.clear()
+            self._target_indexes.clear()
+            self._dirty_targets.clear()
+            self._client_baseline.clear()
+            self.latency.clear()
+            for side in TCP_PATH_SIDES:
+                self.tcp_paths[side].clear()
+                self.tcp_rtt[side] = LogLinearHistogram()
+            # Keep unflushed deltas so a final checkpoint after reset still sees them
+    
+    def collect_deltas(self):
+        """
+        Take traffic accumulated since the last call (for checkpointing)
+        
+        Returns:
+            tuple: (deltas, totals) where deltas is
+                {(client_ip, target_addr): [connections, bytes_sent, bytes_received]}
+                and totals holds the global counters
+        """
+        self.merge_shards()
+        with self.lock:
+            deltas = self._pending
+            self._pending = {}
+            totals = {
+                'total_connections': self.stats['total_connections'],
+                'rejected_connections': self.stats['rejected_connections'],
+                'closed_connections': self.stats['closed_connections'],
+                'bytes_sent': self.stats['bytes_sent'],
+                'bytes_received': self.stats['bytes_received'],
+            }
+            return deltas, totals
+    
+    def snapshot_totals(self):
+        """
+        Get totals per client and per target roll-up key (for federation)
+        
+        Returns:
+            tuple: (totals, clients, targets) where clients and targets map a key
+                to [bytes_sent, bytes_received, active_connections]
+        """
+        self.merge_shards()
+        with self.lock:
+            totals = dict(self.stats, active_clients=len(self.active_clients))
+            clients = {}
+            targets = {}
+            for client_ip, stats in self.client_stats.items():
+                clients[client_ip] = [stats['total_bytes_sent'], stats['total_bytes_received'],
+                                      len(stats['connections'])]
+                for target_key, target_stats in stats['targets'].items():
+                    entry = targets.get(target_key)
+                    if entry is None:
+                        entry = targets[target_key] = [0, 0, 0]
+                    entry[0] += target_stats['bytes_sent']
+                    entry[1] += target_stats['bytes_received']
+                    entry[2] += target_stats['connections']
+            return totals, clients, targets
+    
+    def add_shard(self):
+        """Create a write buffer for one more relay loop"""
+        shard = StatsShard()
+        with self._merge_lock:
+            self.shards = self.shards + [shard]
+        return shard
+    
+    def remove_shard(self, shard):
+        """Merge a shard a last time and stop reading it"""
+        with self._merge_lock:
+            self.shards = [item for item in self.shards if item is not shard]
+            self._apply(shard.drain())
+    
+    def merge_shards(self):
+        """Apply buffered updates of every shard (any thread)"""
+        if not self.shards:
+            return
+        with self._merge_lock:
+            for shard in self.shards:
+                self._apply(shard.drain())
+    
+    def _apply(self, events):
+        """Replay shard events through the regular update methods"""
+        for name, args in events:
+            getattr(self, name)(*args)
+    
+    def merge_deltas(self, deltas):
+        """Put back deltas that could not be written"""
+        with self.lock:
+            for key, values in deltas.items():
+                entry = self._pending_entry(*key)
+                for i, value in enumerate(values):
+                    entry[i] += value
+    
+    def restore(self, totals, client_totals=None):
+        """
+        Restore lifetime counters loaded from the store
+        
+        Args:
+            totals: global counters {name: value}
+            client_totals: {client_ip: (bytes_sent, bytes_received)}
+        """
+        with self.lock:
+            for name in ('total_connections', 'rejected_connections', 'closed_connections',
+                         'bytes_sent', 'bytes_received'):
+                if name in totals:
+                    self.stats[name] = totals[name]
+            for client_ip, (sent, received) in (client_totals or {}).items():
+                if client_ip in self.client_stats:
+                    continue
+                self._client_baseline[client_ip] = (sent, received)
+
 
+class StatsShard:
+    """
+    Write buffer of one relay loop, merged into a StatsCollector on read
+    
+    Has the collector's update methods but only appends to a list under its
+    own lock, so loop threads don't contend on the collector lock. Byte
+    counts are summed per connection and flushed before the connection's
+    next lifecycle event, so the merge replays updates in a valid order.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._events = []  # (collector method name, args) in call order
+        self._bytes = {}  # connection_id -> [bytes_sent, bytes_received] not yet in _events
+    
+    def _flush_bytes(self, connection_id):
+        """Move a connection's summed byte counts into the event list (lock held)"""
+        counts = self._bytes.pop(connection_id, None)
+        if counts:
+            self._append_bytes(self._events, connection_id, counts)
+    
+    @staticmethod
+    def _append_bytes(events, connection_id, counts):
+        if counts[0]:
+            events.append(('add_bytes_sent', (counts[0], connection_id)))
+        if counts[1]:
+            events.append(('add_bytes_received', (counts[1], connection_id)))
+    
+    def add_connection(self, connection_id, client_ip=None, target_addr=None):
+        """Buffer a new connection"""
+        with self.lock:
+            self._events.append(('add_connection', (connection_id, client_ip, target_addr, time.time())))
+    
+    def remove_connection(self, connection_id):
+        """Buffer a closed connection"""
+        with self.lock:
+            self._flush_bytes(connection_id)
+            self._events.append(('remove_connection', (connection_id,)))
+    
+    def reject_connection(self):
+        """Buffer a rejected connection"""
+        with self.lock:
+            self._events.append(('reject_connection', ()))
+    
+    def update_target_addr(self, connection_id, target_addr):
+        """Buffer a target address change"""
+        with self.lock:
+            self._flush_bytes(connection_id)
+            self._events.append(('update_target_addr', (connection_id, target_addr)))
+    
+    def update_target_ip(self, connection_id, target_ip):
+        """Buffer a resolved target address"""
+        with self.lock:
+            self._events.append(('update_target_ip', (connection_id, target_ip)))
+    
+    def _add_bytes(self, index, bytes_count, connection_id):
+        with self.lock:
+            counts = self._bytes.get(connection_id)
+            if counts is None:
+                counts = self._bytes[connection_id] = [0, 0]
+            counts[index] += bytes_count
+    
+    def add_bytes_sent(self, bytes_count, connection_id=None):
+        """Buffer bytes sent"""
+        self._add_bytes(0, bytes_count, connection_id)
+    
+    def add_bytes_received(self, bytes_count, connection_id=None):
+        """Buffer bytes received"""
+        self._add_bytes(1, bytes_count, connection_id)
+    
+    def record_latency(self, durations):
+        """Buffer lifecycle stage durations of one connection"""
+        with self.lock:
+            self._events.append(('record_latency', (durations,)))
+    
+    def record_tcp_info(self, samples):
+        """Buffer a batch of TCP_INFO samples"""
+        with self.lock:
+            self._events.append(('record_tcp_info', (samples,)))
+    
+    def drain(self):
+        """Take buffered events in order"""
+        with self.lock:
+            events, self._events = self._events, []
+            for connection_id, counts in self._bytes.items():
+                self._append_bytes(events, connection_id, counts)
+            self._bytes = {}
+            return events
@@ -0,0 +1,327 @@
+"""GeoIP / ASN attribution - country and autonomous system of client and target IPs
+
+Reads local MaxMind DB (.mmdb) files, e.g. GeoLite2-Country and GeoLite2-ASN
+or a combined country + ASN database, through mmap without extra packages.
+Lookups are cached (LRU) and only run on web request threads, never on the
+relay loop.
+"""
+import mmap
+import struct
+import threading
+import ipaddress
+from collections import OrderedDict
+
+try:
+    from shadowsocks_server_ui.stats.collector import select_page
+except ImportError:
+    from .collector import select_page
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+METADATA_MAX_SIZE = 128 * 1024  # Metadata is searched for in the last 128 KiB
+DATA_SECTION_SEPARATOR = 16  # Zero bytes between the search tree and the data section
+
+GEO_FIELDS = ('country', 'asn')
+# Groups are [bytes_sent, bytes_received, active_connections, members]
+GEO_SORT_KEYS = {
+    'total_bytes': lambda item: item[1][0] + item[1][1],
+    'bytes_sent': lambda item: item[1][0],
+    'bytes_received': lambda item: item[1][1],
+    'active_connections': lambda item: item[1][2],
+    'members': lambda item: item[1][3],
+}
+
+
+class MMDBReader:
+    """Reader for one MaxMind DB file, mapped into memory (thread-safe, lookups don't seek)"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = len(self._buffer)
+            start = self._buffer.rfind(METADATA_MARKER, max(0, size - METADATA_MAX_SIZE))
+            if start < 0:
+                raise ValueError(f"{path} is not a MaxMind DB file")
+            start += len(METADATA_MARKER)
+            self.metadata, _ = self._decode(start, start)
+            self.node_count = self.metadata['node_count']
+            self.record_size = self.metadata['record_size']
+            self.ip_version = self.metadata['ip_version']
+            if self.record_size not in (24, 28, 32):
+                raise ValueError(f"{path}: unsupported record size {self.record_size}")
+            self._node_bytes = self.record_size // 4  # Two records per node
+            self._tree_size = self.node_count * self._node_bytes
+            self._data_start = self._tree_size + DATA_SECTION_SEPARATOR
+            # IPv4 addresses live under ::/96 of an IPv6 tree
+            self._ipv4_start = 0
+            if self.ip_version == 6:
+                for _ in range(96):
+                    if self._ipv4_start >= self.node_count:
+                        break
+                    self._ipv4_start = self._read_node(self._ipv4_start, 0)
+        except (KeyError, IndexError, struct.error) as e:
+            self._buffer.close()
+            raise ValueError(f"{path}: corrupt MaxMind DB ({e})") from None
+        except Exception:
+            self._buffer.close()
+            raise
+
+    @property
+    def database_type(self):
+        return self.metadata.get('database_type', '')
+
+    def _read_node(self, node, index):
+        buffer = self._buffer
+        if self.record_size == 24:
+            offset = node * 6 + index * 3
+            return int.from_bytes(buffer[offset:offset + 3], 'big')
+        if self.record_size == 28:
+            offset = node * 7
+            if index == 0:
+                return ((buffer[offset + 3] & 0xf0) << 20) | int.from_bytes(buffer[offset:offset + 3], 'big')
+            return ((buffer[offset + 3] & 0x0f) << 24) | int.from_bytes(buffer[offset + 4:offset + 7], 'big')
+        offset = node * 8 + index * 4
+        return int.from_bytes(buffer[offset:offset + 4], 'big')
+
+    def _decode(self, offset, base):
+        """Decode the value at offset, returns (value, next offset); pointers are relative to base"""
+        buffer = self._buffer
+        control = buffer[offset]
+        offset += 1
+        kind = control >> 5
+        if kind == 1:  # Pointer, the value is decoded where it points
+            size = (control >> 3) & 3
+            if size == 0:
+                pointer = ((control & 7) << 8) | buffer[offset]
+            elif size == 1:
+                pointer = (((control & 7) << 16) | int.from_bytes(buffer[offset:offset + 2], 'big')) + 2048
+            elif size == 2:
+                pointer = (((control & 7) << 24) | int.from_bytes(buffer[offset:offset + 3], 'big')) + 526336
+            else:
+                pointer = int.from_bytes(buffer[offset:offset + 4], 'big')
+            value, _ = self._decode(base + pointer, base)
+            return value, offset + size + 1
+        if kind == 0:  # Extended type
+            kind = 7 + buffer[offset]
+            offset += 1
+        size = control & 0x1f
+        if size >= 29:
+            extra = size - 28
+            size = (29, 285, 65821)[extra - 1] + int.from_bytes(buffer[offset:offset + extra], 'big')
+            offset += extra
+        if kind == 2:
+            return buffer[offset:offset + size].decode('utf-8'), offset + size
+        if kind == 7:
+            result = {}
+            for _ in range(size):
+                key, offset = self._decode(offset, base)
+                result[key], offset = self._decode(offset, base)
+            return result, offset
+        if kind == 11:
+            result = []
+            for _ in range(size):
+                value, offset = self._decode(offset, base)
+                result.append(value)
+            return result, offset
+        if kind in (5, 6, 9, 10):  # uint16, uint32, uint64, uint128
+            return int.from_bytes(buffer[offset:offset + size], 'big'), offset + size
+        if kind == 8:  # int32, leading zero bytes may be left out
+            return int.from_bytes(buffer[offset:offset + size].rjust(4, b'\0'), 'big', signed=True), offset + size
+        if kind == 14:  # Boolean, the size is the value
+            return bool(size), offset
+        if kind == 3:
+            return struct.unpack('>d', buffer[offset:offset + 8])[0], offset + 8
+        if kind == 15:
+            return struct.unpack('>f', buffer[offset:offset + 4])[0], offset + 4
+        if kind == 4:
+            return bytes(buffer[offset:offset + size]), offset + size
+        raise ValueError(f"{self.path}: unexpected data type {kind}")
+
+    def get(self, address):
+        """
+        Get the record of an address
+
+        Args:
+            address: ipaddress.IPv4Address or IPv6Address
+
+        Returns:
+            dict or None: the record, None if the database has none for the address
+        """
+        packed = address.packed
+        bit_count = len(packed) * 8
+        if bit_count == 128 and self.ip_version == 4:
+            return None
+        node = self._ipv4_start if bit_count == 32 else 0
+        node_count = self.node_count
+        for i in range(bit_count):
+            if node >= node_count:
+                break
+            node = self._read_node(node, (packed[i >> 3] >> (7 - (i & 7))) & 1)
+        if node <= node_count:
+            return None  # node_count marks "no data", a node inside the tree means a corrupt file
+        return self._decode(self._tree_size + node - node_count, self._data_start)[0]
+
+    def close(self):
+        self._buffer.close()
+
+
+def _extract(record, geo):
+    """Fill missing fields of geo from a GeoLite2/GeoIP2 or country + ASN record"""
+    if not isinstance(record, dict):
+        return
+    if geo['country'] is None:
+        for key in ('country', 'registered_country'):
+            country = record.get(key)
+            if isinstance(country, dict) and country.get('iso_code'):
+                geo['country'] = country['iso_code']
+                break
+        else:
+            if isinstance(record.get('country_code'), str):
+                geo['country'] = record['country_code']
+    if geo['asn'] is None:
+        asn = record.get('autonomous_system_number', record.get('asn'))
+        if isinstance(asn, str) and asn.upper().startswith('AS') and asn[2:].isdigit():
+            asn = int(asn[2:])
+        if isinstance(asn, int):
+            geo['asn'] = asn
+            geo['as_org'] = record.get('autonomous_system_organization') or record.get('as_name')
+
+
+def parse_address(ip):
+    """Get an ipaddress object for an IP string (IPv4-mapped IPv6 as IPv4), None if not an IP"""
+    try:
+        address = ipaddress.ip_address(ip.split('%', 1)[0])
+    except (ValueError, AttributeError):
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+class GeoLookup:
+    """
+    Country and ASN of IP addresses from local MMDB files, with an LRU cache
+
+    Every database is asked for every field, so one combined database or a
+    country plus an ASN database both work.
+    """
+
+    def __init__(self, country_db='', asn_db='', cache_size=65536):
+        """
+        Args:
+            country_db: MMDB file with countries (GeoLite2-Country/City or combined)
+            asn_db: MMDB file with autonomous systems (GeoLite2-ASN or combined)
+            cache_size: lookups kept in the LRU cache
+        """
+        self.readers = []
+        try:
+            for path in (country_db, asn_db):
+                if path:
+                    self.readers.append(MMDBReader(path))
+        except Exception:
+            self.close()
+            raise
+        self.cache_size = max(1, int(cache_size))
+        self._cache = OrderedDict()  # ip -> geo dict, least recently used first
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def lookup(self, ip):
+        """
+        Get country and ASN of an IP address
+
+        Returns:
+            dict: {'country': ISO code, 'asn': number, 'as_org': name}, unknown fields None
+        """
+        with self._lock:
+            self.lookups += 1
+            geo = self._cache.get(ip)
+            if geo is not None:
+                self._cache.move_to_end(ip)
+                self.hits += 1
+                return geo
+        geo = {'country': None, 'asn': None, 'as_org': None}
+        address = parse_address(ip)
+        if address is not None:
+            for reader in self.readers:
+                try:
+                    _extract(reader.get(address), geo)
+                except (ValueError, IndexError, struct.error):
+                    pass  # Corrupt record, or the file was closed by a reconfiguration
+        with self._lock:
+            self._cache[ip] = geo
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return geo
+
+    def annotate(self, entries, key):
+        """Add country, asn and as_org to API entries, from the IP in entry[key] (skipped when None)"""
+        for entry in entries:
+            ip = entry.get(key)
+            entry.update(self.lookup(ip) if ip else {'country': None, 'asn': None, 'as_org': None})
+        return entries
+
+    def group(self, totals, ips, by, sort='total_bytes', descending=True, offset=0, limit=50):
+        """
+        Get one page of traffic grouped by country or ASN
+
+        Args:
+            totals: {key: [bytes_sent, bytes_received, active_connections]}, see snapshot_totals
+            ips: {key: ip} for keys that aren't IPs themselves (None: keys are IPs)
+            by: 'country' or 'asn'
+        """
+        if by not in GEO_FIELDS:
+            raise ValueError(f"Invalid grouping: {by}")
+        if sort not in GEO_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        groups = {}
+        names = {}
+        for key, (sent, received, active) in totals.items():
+            ip = key if ips is None else ips.get(key)
+            geo = self.lookup(ip) if ip else None
+            value = geo[by] if geo else None
+            group = groups.get(value)
+            if group is None:
+                group = groups[value] = [0, 0, 0, 0]
+                if by == 'asn' and geo:
+                    names[value] = geo['as_org']
+            group[0] += sent
+            group[1] += received
+            group[2] += active
+            group[3] += 1
+        page, total = select_page(groups.items(), GEO_SORT_KEYS[sort], descending, offset, limit)
+        items = []
+        for value, (sent, received, active, members) in page:
+            item = {by: value}
+            if by == 'asn':
+                item['as_org'] = names.get(value)
+            item.update({
+                'bytes_sent': sent,
+                'bytes_received': received,
+                'total_bytes': sent + received,
+                'active_connections': active,
+                'members': members,
+            })
+            items.append(item)
+        next_offset = offset + limit if offset + limit < total else None
+        return {'items': items, 'total': total, 'offset': offset, 'limit': limit, 'next_offset': next_offset}
+
+    def get_stats(self):
+        """Get databases and cache counters"""
+        with self._lock:
+            return {
+                'databases': [{'file': reader.path, 'type': reader.database_type,
+                               'build_epoch': reader.metadata.get('build_epoch')} for reader in self.readers],
+                'cache_entries': len(self._cache),
+                'cache_size': self.cache_size,
+                'lookups': self.lookups,
+                'hit_ratio': round(self.hits / self.lookups, 4) if self.lookups else None,
+            }
+
+    def close(self):
+        """Unmap the database files"""
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
@@ -0,0 +1,95 @@
+"""Log-linear histogram for latency and size distributions"""
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # 16 linear buckets per power of two (~6% relative error)
+
+
+def bucket_index(value):
+    """Get bucket index of a non-negative integer value"""
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_bounds(index):
+    """Get (lowest, highest) value stored in a bucket"""
+    if index < SUB_BUCKETS:
+        return index, index
+    shift = index // SUB_BUCKETS - 1
+    sub = index % SUB_BUCKETS + SUB_BUCKETS
+    return sub << shift, ((sub + 1) << shift) - 1
+
+
+class LogLinearHistogram:
+    """
+    HDR-style histogram: recording is O(1) and memory is fixed
+
+    Values are non-negative integers (e.g. microseconds or bytes). Buckets are
+    linear within each power of two, so percentiles have bounded relative error.
+    Not thread-safe, callers hold their own lock.
+    """
+
+    def __init__(self, max_value=1 << 36):
+        self.max_value = max_value
+        self.counts = [0] * (bucket_index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        """Record one value (clamped to [0, max_value])"""
+        value = int(value)
+        if value < 0:
+            value = 0
+        elif value > self.max_value:
+            value = self.max_value
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Get value at a percentile (upper bound of the bucket it falls in)"""
+        if not self.count:
+            return 0
+        rank = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bucket_bounds(index)[1], self.max)
+        return self.max
+
+    def merge(self, other):
+        """Add counts from another histogram with the same layout"""
+        for index, bucket_count in enumerate(other.counts):
+            if bucket_count:
+                self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def summary(self):
+        """Get count, mean, min, max and common percentiles"""
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'min': self.min or 0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+    def buckets(self):
+        """Get non-empty buckets as [lowest, highest, count]"""
+        return [list(bucket_bounds(index)) + [bucket_count]
+                for index, bucket_count in enumerate(self.counts) if bucket_count]
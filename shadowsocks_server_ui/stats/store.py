@@ -0,0 +1,230 @@
+"""Statistics store - persists traffic counters across restarts"""
+import time
+import sqlite3
+import threading
+
+HOUR = 3600
+
+
+class StatsStore:
+    """Append-only traffic store backed by SQLite in WAL mode"""
+
+    def __init__(self, db_file='shadowsocks_stats.db'):
+        self.db_file = db_file
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Open database and create tables"""
+        with self.lock:
+            if self.conn:
+                return
+            self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+            # WAL lets report queries run while the checkpoint thread appends
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS traffic (
+                    ts INTEGER NOT NULL,
+                    resolution INTEGER NOT NULL,
+                    client_ip TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    connections INTEGER NOT NULL DEFAULT 0,
+                    bytes_sent INTEGER NOT NULL DEFAULT 0,
+                    bytes_received INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_traffic_ts ON traffic (ts);
+                CREATE INDEX IF NOT EXISTS idx_traffic_client_ts ON traffic (client_ip, ts);
+                CREATE TABLE IF NOT EXISTS totals (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS client_totals (
+                    client_ip TEXT PRIMARY KEY,
+                    bytes_sent INTEGER NOT NULL,
+                    bytes_received INTEGER NOT NULL
+                );
+            ''')
+            self.conn.commit()
+
+    def close(self):
+        """Close database"""
+        with self.lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+    def append(self, ts, resolution, deltas, totals):
+        """
+        Append one checkpoint
+
+        Args:
+            ts: checkpoint timestamp (seconds)
+            resolution: seconds covered by this checkpoint
+            deltas: {(client_ip, target): [connections, bytes_sent, bytes_received]}
+            totals: global counters {name: value}
+        """
+        rows = [(ts, resolution, client_ip, target or '', d[0], d[1], d[2])
+                for (client_ip, target), d in deltas.items()]
+        client_rows = {}
+        for (client_ip, _), d in deltas.items():
+            sent, received = client_rows.get(client_ip, (0, 0))
+            client_rows[client_ip] = (sent + d[1], received + d[2])
+        with self.lock:
+            with self.conn:
+                if rows:
+                    self.conn.executemany(
+                        'INSERT INTO traffic (ts, resolution, client_ip, target, connections, '
+                        'bytes_sent, bytes_received) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                self.conn.executemany(
+                    'INSERT INTO client_totals (client_ip, bytes_sent, bytes_received) VALUES (?, ?, ?) '
+                    'ON CONFLICT(client_ip) DO UPDATE SET '
+                    'bytes_sent = bytes_sent + excluded.bytes_sent, '
+                    'bytes_received = bytes_received + excluded.bytes_received',
+                    [(ip, sent, received) for ip, (sent, received) in client_rows.items()])
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO totals (name, value) VALUES (?, ?)', list(totals.items()))
+
+    def load_totals(self):
+        """Load global counters"""
+        with self.lock:
+            return dict(self.conn.execute('SELECT name, value FROM totals').fetchall())
+
+    def load_client_totals(self):
+        """Load lifetime traffic per client: {client_ip: (bytes_sent, bytes_received)}"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT client_ip, bytes_sent, bytes_received FROM client_totals').fetchall()
+        return {ip: (sent, received) for ip, sent, received in rows}
+
+    def compact(self, now=None, raw_retention=86400, retention_days=90):
+        """
+        Roll raw checkpoints older than raw_retention into hourly rows
+        and delete rows older than retention_days
+
+        Returns:
+            int: number of raw rows compacted
+        """
+        now = now or time.time()
+        # Align to the hour so each hour is rolled up exactly once
+        cutoff = int(now - raw_retention) // HOUR * HOUR
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    'INSERT INTO traffic (ts, resolution, client_ip, target, connections, '
+                    'bytes_sent, bytes_received) '
+                    'SELECT (ts / ?) * ?, ?, client_ip, target, SUM(connections), '
+                    'SUM(bytes_sent), SUM(bytes_received) FROM traffic '
+                    'WHERE resolution < ? AND ts < ? GROUP BY ts / ?, client_ip, target',
+                    (HOUR, HOUR, HOUR, HOUR, cutoff, HOUR))
+                compacted = self.conn.execute(
+                    'DELETE FROM traffic WHERE resolution < ? AND ts < ?', (HOUR, cutoff)).rowcount
+                if retention_days:
+                    self.conn.execute('DELETE FROM traffic WHERE ts < ?',
+                                      (int(now - retention_days * 86400),))
+        return compacted
+
+    def query(self, since=None, until=None, client_ip=None, group_by='client', limit=1000):
+        """
+        Aggregate traffic over a time range (for billing and reports)
+
+        Args:
+            since, until: unix timestamps (inclusive, exclusive)
+            client_ip: only this client
+            group_by: 'client', 'target', 'hour' or 'day'
+        """
+        group_columns = {
+            'client': 'client_ip',
+            'target': 'target',
+            'hour': f'(ts / {HOUR}) * {HOUR}',
+            'day': '(ts / 86400) * 86400',
+        }
+        if group_by not in group_columns:
+            raise ValueError(f"Invalid group_by: {group_by}")
+        column = group_columns[group_by]
+        where = []
+        params = []
+        if since is not None:
+            where.append('ts >= ?')
+            params.append(int(since))
+        if until is not None:
+            where.append('ts < ?')
+            params.append(int(until))
+        if client_ip:
+            where.append('client_ip = ?')
+            params.append(client_ip)
+        sql = (f'SELECT {column}, SUM(connections), SUM(bytes_sent), SUM(bytes_received) '
+               f'FROM traffic {"WHERE " + " AND ".join(where) if where else ""} '
+               f'GROUP BY 1 ORDER BY SUM(bytes_sent) + SUM(bytes_received) DESC LIMIT ?')
+        params.append(int(limit))
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [{
+            group_by: key,
+            'connections': connections,
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'total_bytes': sent + received,
+        } for key, connections, sent, received in rows]
+
+
+class StatsPersister:
+    """Background thread that checkpoints a StatsCollector into a StatsStore"""
+
+    def __init__(self, stats_collector, store, interval=30, compact_interval=HOUR,
+                 raw_retention=86400, retention_days=90, log_callback=None):
+        self.stats_collector = stats_collector
+        self.store = store
+        self.interval = interval
+        self.compact_interval = compact_interval
+        self.raw_retention = raw_retention
+        self.retention_days = retention_days
+        self.log_callback = log_callback
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_checkpoint = time.time()
+
+    def start(self):
+        """Restore counters from the store and start checkpointing"""
+        self.store.open()
+        self.stats_collector.restore(self.store.load_totals(), self.store.load_client_totals())
+        self._stop_event.clear()
+        self._last_checkpoint = time.time()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="StatsPersister")
+        self._thread.start()
+
+    def stop(self):
+        """Write a final checkpoint and stop the thread"""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=5.0)
+        self._thread = None
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Write pending deltas to the store"""
+        now = time.time()
+        deltas, totals = self.stats_collector.collect_deltas()
+        resolution = max(1, int(now - self._last_checkpoint))
+        self._last_checkpoint = now
+        try:
+            self.store.append(int(now), resolution, deltas, totals)
+        except Exception as e:
+            # Put deltas back so the next checkpoint retries them
+            self.stats_collector.merge_deltas(deltas)
+            if self.log_callback:
+                self.log_callback(f"Stats checkpoint failed: {e}")
+
+    def _run(self):
+        """Checkpoint loop"""
+        last_compact = time.time()
+        while not self._stop_event.wait(self.interval):
+            self.checkpoint()
+            if time.time() - last_compact >= self.compact_interval:
+                last_compact = time.time()
+                try:
+                    self.store.compact(raw_retention=self.raw_retention,
+                                       retention_days=self.retention_days)
+                except Exception as e:
+                    if self.log_callback:
+                        self.log_callback(f"Stats compaction failed: {e}")
@@ -0,0 +1,93 @@
+"""Target address normalization - rolls targets up by domain or IP prefix"""
+import sys
+import ipaddress
+
+# Public suffixes with more than one label (second-level registrations and
+# common hosting suffixes where every subdomain belongs to a different owner).
+# Single-label TLDs need no entry: the registrable domain is the last two labels.
+MULTI_LABEL_SUFFIXES = frozenset((
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'net.uk',
+    'com.cn', 'net.cn', 'org.cn', 'gov.cn', 'edu.cn',
+    'com.hk', 'com.tw', 'org.tw', 'com.sg', 'com.my',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'go.jp',
+    'co.kr', 'or.kr', 'ac.kr',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'co.nz', 'org.nz', 'co.in', 'net.in', 'org.in', 'co.id', 'co.th', 'com.vn',
+    'com.br', 'net.br', 'org.br', 'com.mx', 'com.ar', 'com.co',
+    'co.za', 'com.tr', 'com.ua', 'com.ru', 'com.pl', 'co.il',
+    'github.io', 'gitlab.io', 'herokuapp.com', 'appspot.com', 'blogspot.com',
+    'cloudfront.net', 'azurewebsites.net', 'vercel.app', 'netlify.app',
+    'pages.dev', 'workers.dev', 'fastly.net', 'akamaihd.net',
+))
+
+ROLLUP_MODES = ('domain', 'host', 'none')
+
+
+def split_target(target_addr):
+    """Split 'host:port' (IPv6 hosts may contain colons) into (host, port)"""
+    host, sep, port = target_addr.rpartition(':')
+    if not sep or not port.isdigit():
+        return target_addr, ''
+    return host.strip('[]'), port
+
+
+def registrable_domain(host):
+    """Get registrable domain (eTLD+1) of a host name"""
+    labels = host.rstrip('.').lower().split('.')
+    if len(labels) <= 2:
+        return '.'.join(labels)
+    if '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class TargetNormalizer:
+    """Maps raw target addresses to interned roll-up keys"""
+
+    def __init__(self, mode='domain', ipv4_prefix=24, ipv6_prefix=48, keep_port=False,
+                 cache_size=65536):
+        """
+        Args:
+            mode: 'domain' (eTLD+1 / IP prefix), 'host' (drop port only) or 'none' (raw)
+            ipv4_prefix: prefix length used to group IPv4 targets in domain mode
+            ipv6_prefix: prefix length used to group IPv6 targets in domain mode
+            keep_port: keep ':port' in rolled-up keys
+            cache_size: number of raw addresses remembered before the cache is cleared
+        """
+        if mode not in ROLLUP_MODES:
+            raise ValueError(f"Invalid target roll-up mode: {mode}")
+        self.mode = mode
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.keep_port = keep_port
+        self.cache_size = cache_size
+        self._cache = {}  # raw target -> roll-up key
+
+    def normalize(self, target_addr):
+        """Get roll-up key for a raw target address"""
+        if not target_addr or self.mode == 'none':
+            return target_addr
+        key = self._cache.get(target_addr)
+        if key is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            key = self._cache[target_addr] = sys.intern(self._rollup(target_addr))
+        return key
+
+    def _rollup(self, target_addr):
+        """Compute roll-up key"""
+        host, port = split_target(target_addr)
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        if self.mode == 'host':
+            key = str(ip) if ip else host.lower()
+        elif ip is not None:
+            prefix = self.ipv4_prefix if ip.version == 4 else self.ipv6_prefix
+            key = str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+        else:
+            key = registrable_domain(host)
+        if self.keep_port and port:
+            return f"{key}:{port}"
+        return key
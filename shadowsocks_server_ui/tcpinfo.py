@@ -0,0 +1,158 @@
+"""Kernel TCP_INFO sampling - RTT, retransmits and delivery rate of live connections"""
+import time
+import socket
+import struct
+import threading
+from collections import deque
+from shadowsocks import tcprelay
+
+# struct tcp_info (linux/tcp.h) up to tcpi_total_retrans, present since Linux 2.6
+_TCP_INFO = struct.Struct('=8B24I')
+# Later fields, present when the kernel returns enough bytes
+_MIN_RTT_OFFSET, _MIN_RTT = 148, struct.Struct('=I')  # Linux 4.6+
+_DELIVERY_RATE_OFFSET, _DELIVERY_RATE = 160, struct.Struct('=Q')  # Linux 4.9+
+TCP_INFO_LENGTH = 192
+
+TCP_INFO = getattr(socket, 'TCP_INFO', None)  # Linux only
+
+
+def parse_tcp_info(raw):
+    """
+    Parse struct tcp_info bytes
+
+    Returns:
+        dict: state, rtt_us, rttvar_us, min_rtt_us, snd_cwnd, snd_mss, unacked, lost,
+            total_retrans, delivery_rate (bytes/s); min_rtt_us and delivery_rate
+            are None on kernels that don't report them
+    """
+    if len(raw) < _TCP_INFO.size:
+        return None
+    fields = _TCP_INFO.unpack_from(raw)
+    values = fields[8:]
+    info = {
+        'state': fields[0],
+        'rtt_us': values[15],
+        'rttvar_us': values[16],
+        'snd_cwnd': values[18],
+        'snd_mss': values[2],
+        'unacked': values[4],
+        'lost': values[6],
+        'total_retrans': values[23],
+        'min_rtt_us': None,
+        'delivery_rate': None,
+    }
+    if len(raw) >= _MIN_RTT_OFFSET + _MIN_RTT.size:
+        info['min_rtt_us'] = _MIN_RTT.unpack_from(raw, _MIN_RTT_OFFSET)[0]
+    if len(raw) >= _DELIVERY_RATE_OFFSET + _DELIVERY_RATE.size:
+        info['delivery_rate'] = _DELIVERY_RATE.unpack_from(raw, _DELIVERY_RATE_OFFSET)[0]
+    return info
+
+
+def read_tcp_info(sock):
+    """Read TCP_INFO of a socket, None if unavailable or the socket is closed"""
+    if sock is None or TCP_INFO is None:
+        return None
+    try:
+        return parse_tcp_info(sock.getsockopt(socket.IPPROTO_TCP, TCP_INFO, TCP_INFO_LENGTH))
+    except OSError:
+        return None
+
+
+class TcpInfoSampler:
+    """
+    Periodically samples TCP_INFO of streaming connections
+
+    Every `interval` seconds the live handlers are queued, then drained on the
+    loop thread `batch_size` at a time each `tick`, so a sweep over thousands
+    of connections is spread out instead of stalling the loop. Each batch is
+    handed to the collector in one call.
+    """
+
+    def __init__(self, loop_tasks, get_relays, stats_collector, interval=10.0, batch_size=256,
+                 tick=0.1):
+        """
+        Args:
+            loop_tasks: LoopTaskQueue of the relay loop (sockets are only touched there)
+            get_relays: callable returning the relays to sample
+            stats_collector: StatsCollector receiving record_tcp_info() batches
+            interval: seconds between sweeps (each connection sampled at most once per sweep)
+            batch_size: connections sampled per tick
+        """
+        self.loop_tasks = loop_tasks
+        self.get_relays = get_relays
+        self.stats_collector = stats_collector
+        self.interval = interval
+        self.batch_size = batch_size
+        self.tick = tick
+        self.sweeps = 0
+        self.samples = 0
+        self._queue = deque()
+        self._next_sweep = time.monotonic()
+        self._scheduled = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling"""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="TcpInfoSampler")
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=2.0)
+        self._thread = None
+
+    def _run(self):
+        """Post a batch to the loop when there is work, without waking an idle loop"""
+        while not self._stop_event.wait(self.tick):
+            if self._scheduled:
+                continue
+            if not self._queue and time.monotonic() < self._next_sweep:
+                continue
+            self._scheduled = True
+            try:
+                self.loop_tasks.call_soon(self._sample_batch)
+            except OSError:
+                return  # Task queue closed, server stopped
+
+    def _sample_batch(self):
+        """Sample one batch of connections (runs on the loop thread)"""
+        self._scheduled = False
+        if not self._queue:
+            now = time.monotonic()
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + self.interval
+            self.sweeps += 1
+            for relay in self.get_relays():
+                self._queue.extend(relay.get_stream_handlers())
+
+        batch = []
+        for _ in range(min(self.batch_size, len(self._queue))):
+            handler = self._queue.popleft()
+            if handler._stage != tcprelay.STAGE_STREAM:
+                continue  # Closed since it was queued
+            for side, sock in ((0, handler._local_sock), (1, handler._remote_sock)):
+                info = read_tcp_info(sock)
+                if info is None:
+                    continue
+                # total_retrans is cumulative per socket, report the increase
+                info['retransmits'] = max(0, info['total_retrans'] - handler.tcp_retransmits[side])
+                handler.tcp_retransmits[side] = info['total_retrans']
+                batch.append((handler.connection_id, 'client' if side == 0 else 'target', info))
+        if batch:
+            self.samples += len(batch)
+            self.stats_collector.record_tcp_info(batch)
+
+    def get_metrics(self):
+        """Get sampler counters"""
+        return {
+            'interval': self.interval,
+            'batch_size': self.batch_size,
+            'sweeps': self.sweeps,
+            'samples': self.samples,
+            'queued': len(self._queue),
+        }
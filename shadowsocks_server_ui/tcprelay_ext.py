@@ -6,24 +6,105 @@ except ImportError:
     from . import compat  # noqa: F401
 import time
 import logging
+import itertools
 import threading
 import errno
 import socket
-from shadowsocks import tcprelay, eventloop, shell
+from shadowsocks import tcprelay, eventloop, shell, common
+
+try:
+    from shadowsocks_server_ui.sockopts import (
+        SOCKET_OPTION_KEYS, TCP_FASTOPEN, build_socket_options, listener_socket_options,
+        apply_socket_options
+    )
+    from shadowsocks_server_ui.acl import ACL_KEYS, AccessList, parse_ip
+    from shadowsocks_server_ui.crypto_offload import MAX_IN_FLIGHT, update_function
+    from shadowsocks_server_ui.trace import UP, DOWN
+    from shadowsocks_server_ui.upstream import Handshake, UpstreamError, UpstreamCounters
+except ImportError:
+    from .sockopts import (
+        SOCKET_OPTION_KEYS, TCP_FASTOPEN, build_socket_options, listener_socket_options,
+        apply_socket_options
+    )
+    from .acl import ACL_KEYS, AccessList, parse_ip
+    from .crypto_offload import MAX_IN_FLIGHT, update_function
+    from .trace import UP, DOWN
+    from .upstream import Handshake, UpstreamError, UpstreamCounters
+
+MIN_READ_CHUNK = 1024  # Smallest read size accepted for read_chunk_min
+
+
+class ConnectionTimings:
+    """Monotonic timestamps of one connection's lifecycle stages"""
+    __slots__ = ('accept', 'header', 'dns', 'connected', 'first_upstream', 'first_downstream')
+    
+    def __init__(self):
+        self.accept = time.monotonic()
+        self.header = None  # Address header decrypted and parsed
+        self.dns = None  # Target name resolved
+        self.connected = None  # Connection to target established
+        self.first_upstream = None  # First byte written to target
+        self.first_downstream = None  # First byte written back to client
+    
+    def durations(self, closed):
+        """
+        Get stage durations in seconds, only for stages that were reached
+        
+        Each stage is measured from the previous one, time_to_first_byte is the
+        target's response time (first upstream byte -> first downstream byte).
+        """
+        result = {}
+        previous = self.accept
+        for stage, stamp in (('header', self.header), ('dns', self.dns), ('connect', self.connected)):
+            if stamp is None:
+                break
+            result[stage] = stamp - previous
+            previous = stamp
+        if self.first_upstream is not None:
+            result['first_upstream'] = self.first_upstream - self.accept
+        if self.first_downstream is not None:
+            result['first_downstream'] = self.first_downstream - self.accept
+            if self.first_upstream is not None:
+                result['time_to_first_byte'] = self.first_downstream - self.first_upstream
+        result['lifetime'] = closed - self.accept
+        return result
 
 
 class TCPRelayHandlerExt(tcprelay.TCPRelayHandler):
     """Extended TCPRelayHandler with statistics callback"""
+    # Our state lives in slots: the parent's attributes alone fit CPython's shared-key
+    # instance dict, adding ours would give every handler its own full-size dict
+    __slots__ = ('connection_id', 'stats_callback', 'log_callback', 'bytes_sent', 'bytes_received', '_start_time',
+                 'timings', 'tcp_retransmits', '_target_name_allowed', '_iv_checked', '_replayed',
+                 '_remote_paused', 'client_ip', 'target_addr', '_pending_local', '_pending_remote',
+                 '_crypto_jobs', '_trace', '_read_sizes', '_chain', '_upstream_counters', '_direct')
     
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
                  dns_resolver, is_local, stats_callback=None, log_callback=None):
         # Set attributes first to avoid errors when parent class calls methods during initialization
+        # Not id(self): a freed handler's address can come back while another loop's
+        # statistics shard still holds events of the old connection
+        self.connection_id = next(server.connection_ids)
         self.stats_callback = stats_callback
         self.log_callback = log_callback
-        self.connection_id = id(self)
+        self._pending_local = None  # Data waiting for the client socket, see _data_to_write_to_local
+        self._pending_remote = None
         self.bytes_sent = 0
         self.bytes_received = 0
         self._start_time = time.time()  # Record connection start time
+        self.timings = ConnectionTimings()
+        self.tcp_retransmits = [0, 0]  # total_retrans at the last TCP_INFO sample (client, target)
+        self._target_name_allowed = False  # Target host name matched an allow rule
+        self._iv_checked = False  # Client IV looked up in the replay filter
+        self._replayed = False  # Client IV was seen before, connection is drained silently
+        self._remote_paused = False  # Target reads held back by the bandwidth scheduler
+        self._crypto_jobs = None  # Chunks on the crypto offload pool per stream, created on first use
+        self._read_sizes = None  # recv() size per stream, created on the first stream read
+        self._chain = None  # Handshake with an upstream proxy while it runs
+        self._upstream_counters = None  # UpstreamCounters of the upstream this connection goes through
+        self._direct = False  # Target name matched a 'direct' upstream rule
+        recorder = server.trace_recorder
+        self._trace = recorder.open(self.timings.accept) if recorder is not None else None
         
         # Record client address
         try:
@@ -35,10 +116,37 @@ class TCPRelayHandlerExt(tcprelay.TCPRelayHandler):
         # Call parent class initialization
         super().__init__(server, fd_to_handlers, loop, local_sock, config,
                         dns_resolver, is_local)
+        apply_socket_options(local_sock, server.socket_options)
+        if server.replay_filter is not None and self._encryptor.cipher_iv:
+            # Our own IVs must not come back as a client's (reflection probes)
+            server.replay_filter.add(self._encryptor.cipher_iv)
         
         # After connection is established, try to get target address
         self._update_target_addr()
     
+    # The parent keeps a list per direction for data the socket didn't accept yet.
+    # Idle connections hold none: a list is created on the first append and
+    # dropped when it is flushed. Reads go through _pending_* so they don't create one.
+    @property
+    def _data_to_write_to_local(self):
+        if self._pending_local is None:
+            self._pending_local = []
+        return self._pending_local
+    
+    @_data_to_write_to_local.setter
+    def _data_to_write_to_local(self, value):
+        self._pending_local = value or None
+    
+    @property
+    def _data_to_write_to_remote(self):
+        if self._pending_remote is None:
+            self._pending_remote = []
+        return self._pending_remote
+    
+    @_data_to_write_to_remote.setter
+    def _data_to_write_to_remote(self, value):
+        self._pending_remote = value or None
+    
     def _update_target_addr(self):
         """Update target address"""
         try:
@@ -98,6 +206,8 @@ class TCPRelayHandlerExt(tcprelay.TCPRelayHandler):
         bytes_count = len(data)
         # Call parent class method to write data first
         result = super()._write_to_sock(data, sock)
+        if result and self._trace is not None:
+            self._trace_write(sock, bytes_count)
         
         # Statistics traffic (Note: parent class _write_to_sock may only write partial data, but here we count attempted write amount)
         # Actual written data amount is handled by parent class, here we count packet size
@@ -116,33 +226,500 @@ class TCPRelayHandlerExt(tcprelay.TCPRelayHandler):
                     self.stats_callback('update_target_addr', self.connection_id, self.client_ip, self.target_addr)
             
             if sock == self._local_sock:
+                if self.timings.first_downstream is None:
+                    self.timings.first_downstream = time.monotonic()
                 # Send to client (data received from remote, encrypted then sent)
                 # This is downstream traffic (server receives then sends to client)
                 self.bytes_received += bytes_count
+                if self._upstream_counters is not None:
+                    self._upstream_counters.bytes_received += bytes_count
                 # Pass connection_id as third parameter (for statistics)
                 self.stats_callback('add_bytes_received', bytes_count, self.connection_id)
             elif sock == self._remote_sock:
+                if self.timings.first_upstream is None:
+                    self.timings.first_upstream = time.monotonic()
                 # Send to remote (data received from client, decrypted then sent)
                 # This is upstream traffic (client sends to server then forwards to remote)
                 self.bytes_sent += bytes_count
+                if self._upstream_counters is not None:
+                    self._upstream_counters.bytes_sent += bytes_count
                 # Pass connection_id as third parameter (for statistics)
                 self.stats_callback('add_bytes_sent', bytes_count, self.connection_id)
         
         return result
     
+    def _trace_write(self, sock, bytes_count):
+        """Record the bytes a write put on the socket (the parent queues what it didn't take)"""
+        # Nothing is queued when a write starts: flushes take the whole queue first
+        pending = self._pending_local if sock == self._local_sock else self._pending_remote
+        sent = bytes_count - sum(len(chunk) for chunk in pending) if pending else bytes_count
+        if sent > 0:
+            self._trace.record(DOWN if sock == self._local_sock else UP, sent, time.monotonic())
+    
+    def _check_target_ip(self, address):
+        """Check a target address against the target ACL, logs denials"""
+        acl = self._server.target_acl
+        if acl:
+            rule = acl.match_ip(address)
+            # An allowed host name admits its addresses unless an address rule says otherwise
+            if not (rule is None and self._target_name_allowed) and not acl.decide(rule):
+                host = self._remote_address[0] if self._remote_address else address
+                self._log_acl_denied(host if host == address else f"{host} ({address})")
+                return False
+        return True
+    
+    def _create_remote_socket(self, ip, port):
+        """Override remote socket creation, check target ACL and apply socket options"""
+        address = common.to_str(ip)  # Resolver returns bytes
+        if not self._check_target_ip(address):
+            raise Exception(f'Target {address} denied by ACL')
+        remote_sock = super()._create_remote_socket(ip, port)
+        apply_socket_options(remote_sock, self._server.remote_socket_options)
+        if self.stats_callback:
+            self.stats_callback('update_target_ip', self.connection_id, self.client_ip, address)
+        return remote_sock
+    
+    def _handle_stage_addr(self, data):
+        """Override address stage, record header time"""
+        # data is already decrypted here; DNS may resolve synchronously inside
+        self.timings.header = time.monotonic()
+        if self._server.target_acl and not self._check_target_name(data):
+            self.destroy()
+            return
+        if self._server.upstreams is not None and self._route_target_name(data):
+            return
+        super()._handle_stage_addr(data)
+    
+    def _check_target_name(self, data):
+        """Check the requested host name before it is resolved, IP targets are checked later"""
+        header = common.parse_header(data)
+        if header is None or header[0] != common.ADDRTYPE_HOST:
+            return True  # Parent reports bad headers
+        host = common.to_str(header[1])
+        acl = self._server.target_acl
+        rule = acl.match_domain(host)
+        if rule is None:
+            return True  # Address rules (and the default policy) decide after resolution
+        if acl.decide(rule):
+            self._target_name_allowed = True
+            return True
+        self._log_acl_denied(host)
+        return False
+    
+    def _log_acl_denied(self, target):
+        """Log a target denied by ACL"""
+        if self.log_callback:
+            self.log_callback(f"Target denied by ACL: {self.client_ip} -> {target}")
+    
+    def _handle_dns_resolved(self, result, error):
+        """Override DNS callback, record resolve time and send routed addresses to their upstream"""
+        self.timings.dns = time.monotonic()
+        upstreams = self._server.upstreams
+        if (upstreams is not None and not error and result and result[1] and not self._direct
+                and self._stage == tcprelay.STAGE_DNS):
+            address = common.to_str(result[1])
+            route = upstreams.route_ip(address)
+            upstream = upstreams.get(route.upstream) if route is not None and route.upstream else None
+            if upstream is not None:
+                if self._check_target_ip(address):
+                    self._chain_connect(upstream, address, self._remote_address[1])
+                else:
+                    self.destroy()
+                return
+        super()._handle_dns_resolved(result, error)
+    
+    def _route_target_name(self, data):
+        """
+        Send a host name target to its upstream without resolving it here
+        
+        The upstream's network may be the only place the name resolves.
+        
+        Returns:
+            bool: True if the connection was routed (or refused), the parent must not handle it
+        """
+        header = common.parse_header(data)
+        if header is None or header[0] != common.ADDRTYPE_HOST:
+            return False  # Addresses are routed after the resolver returns them
+        _, remote_addr, remote_port, header_length = header
+        host = common.to_str(remote_addr)
+        route = self._server.upstreams.route_domain(host)
+        if route is None:
+            return False
+        upstream = self._server.upstreams.get(route.upstream) if route.upstream else None
+        if upstream is None:
+            self._direct = True  # Broader address rules don't apply either
+            return False
+        acl = self._server.target_acl
+        if acl and not self._target_name_allowed and not acl.decide(None):
+            # No name rule matched and the address is never known here
+            self._log_acl_denied(host)
+            self.destroy()
+            return True
+        self._remote_address = (host, remote_port)
+        # Like the parent: stop reading the client, keep what followed the header
+        self._update_stream(tcprelay.STREAM_UP, tcprelay.WAIT_STATUS_WRITING)
+        if len(data) > header_length:
+            self._data_to_write_to_remote.append(data[header_length:])
+        self._chain_connect(upstream, host, remote_port)
+        return True
+    
+    def _chain_connect(self, upstream, host, port):
+        """Connect to a target through an upstream proxy, on a pooled connection if there is one"""
+        self._stage = tcprelay.STAGE_CONNECTING
+        counters = self._server.get_upstream_counters(upstream.name)
+        counters.connections += 1
+        counters.active += 1
+        self._upstream_counters = counters
+        sock = self._server.upstreams.take(upstream)
+        pooled = sock is not None
+        try:
+            if pooled:
+                counters.pool_hits += 1
+                apply_socket_options(sock, self._server.remote_socket_options)
+            else:
+                sock = upstream.create_socket(self._server.remote_socket_options)
+            chain = Handshake(upstream, host, port, pooled, sock)
+        except (OSError, UpstreamError) as e:
+            if sock is not None:
+                sock.close()
+            counters.failures += 1
+            self._chain_failed(upstream, e)
+            return
+        self._chain = chain
+        self._fd_to_handlers[sock.fileno()] = self
+        self._loop.add(sock, eventloop.POLL_ERR | (eventloop.POLL_IN if pooled else eventloop.POLL_OUT),
+                       self._server)
+        if pooled:
+            self._on_chain_event(eventloop.POLL_OUT)  # Send the CONNECT now
+    
+    def handle_event(self, sock, event):
+        """Override event dispatch, the upstream handshake owns its socket until it is done"""
+        chain = self._chain
+        if chain is not None and sock is chain.sock:
+            if self._stage != tcprelay.STAGE_DESTROYED:
+                self._on_chain_event(event)
+            return
+        super().handle_event(sock, event)
+    
+    def _on_chain_event(self, event):
+        """Drive the upstream handshake: finish connecting, send, read the proxy's answers"""
+        chain = self._chain
+        sock = chain.sock
+        try:
+            if event & eventloop.POLL_ERR:
+                raise OSError(eventloop.get_sock_error(sock))
+            if event & eventloop.POLL_OUT and not chain.connected:
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise OSError(error, errno.errorcode.get(error, str(error)))
+                chain.connected = True
+            if event & eventloop.POLL_OUT and chain.out:
+                sent = sock.send(chain.out)
+                chain.out = chain.out[sent:]
+            if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                data = sock.recv(4096)
+                if not data:
+                    raise UpstreamError("closed the connection")
+                extra = chain.feed(data)
+                if chain.done:
+                    self._chain_established(extra)
+                    return
+        except (BlockingIOError, InterruptedError):
+            pass
+        except (OSError, UpstreamError) as e:
+            self._chain_failed(chain.upstream, e)
+            return
+        mode = eventloop.POLL_ERR
+        if chain.connected:
+            mode |= eventloop.POLL_IN
+        if chain.out or not chain.connected:
+            mode |= eventloop.POLL_OUT
+        self._loop.modify(sock, mode)
+    
+    def _chain_established(self, extra):
+        """Hand the tunnel to the parent as a connected target socket"""
+        chain = self._chain
+        self._chain = None
+        counters = self._upstream_counters
+        counters.handshakes += 1
+        counters.handshake_time += time.monotonic() - chain.started
+        self._remote_sock = chain.sock
+        self.timings.connected = time.monotonic()
+        host = self._remote_address[0]
+        if self.stats_callback and parse_ip(host) is not None:
+            self.stats_callback('update_target_ip', self.connection_id, self.client_ip, host)
+        # Same states as the parent after connect(): the next POLL_OUT starts the stream
+        self._update_stream(tcprelay.STREAM_UP, tcprelay.WAIT_STATUS_READWRITING)
+        self._update_stream(tcprelay.STREAM_DOWN, tcprelay.WAIT_STATUS_READING)
+        if extra:
+            # The target spoke first and it came with the proxy's answer
+            self._write_to_sock(self._encryptor.encrypt(extra), self._local_sock)
+    
+    def _chain_failed(self, upstream, error):
+        """Close a connection whose upstream could not connect the target"""
+        if self.log_callback:
+            target = f"{self._remote_address[0]}:{self._remote_address[1]}" if self._remote_address else "?"
+            self.log_callback(f"Upstream {upstream.name} failed: {self.client_ip} -> {target}: {error}")
+        self.destroy()
+    
+    def _on_remote_write(self):
+        """Override remote write, record connect time and flush like _on_local_write"""
+        if self.timings.connected is None and self._stage == tcprelay.STAGE_CONNECTING:
+            # First POLL_OUT on the remote socket means connect() completed
+            self.timings.connected = time.monotonic()
+        self._stage = tcprelay.STAGE_STREAM
+        if self._pending_remote:
+            data = b''.join(self._pending_remote)
+            self._pending_remote = None
+            self._write_to_sock(data, self._remote_sock)
+        else:
+            self._update_stream(tcprelay.STREAM_UP, tcprelay.WAIT_STATUS_READING)
+    
+    def _on_local_write(self):
+        """Override local write, flush pending data (the parent's check would create an empty list)"""
+        if self._pending_local:
+            data = b''.join(self._pending_local)
+            self._pending_local = None
+            self._write_to_sock(data, self._local_sock)
+        else:
+            self._update_stream(tcprelay.STREAM_DOWN, tcprelay.WAIT_STATUS_READING)
+    
     def _on_local_read(self):
-        """Override local read"""
+        """Override local read, check the client IV before the first decrypt"""
+        if not self._iv_checked and self._server.replay_filter is not None:
+            self._check_replay()
+        if self._replayed:
+            self._drain_local()
+            return
+        if self._stage == tcprelay.STAGE_STREAM and self._local_sock:
+            self._read_stream(tcprelay.STREAM_UP)
+            return
         # Call parent class method, traffic statistics handled in _write_to_sock
         super()._on_local_read()
     
+    def _check_replay(self):
+        """Peek at the IV of the first packet and look it up in the replay filter"""
+        self._iv_checked = True
+        iv_len = self._encryptor._method_info[1]
+        if not iv_len or self._stage != tcprelay.STAGE_INIT:
+            return
+        try:
+            iv = self._local_sock.recv(iv_len, socket.MSG_PEEK)
+        except (OSError, IOError):
+            return  # Parent's recv handles the error
+        if len(iv) < iv_len:
+            return  # IV split across segments, too rare to matter
+        if self._server.replay_filter.check_and_add(iv):
+            self._replayed = True
+            if self.log_callback:
+                self.log_callback(f"Replayed IV from {self.client_ip}, ignoring connection")
+    
+    def _drain_local(self):
+        """Read and discard client data without answering, like a wrong password would"""
+        try:
+            data = self._local_sock.recv(tcprelay.BUF_SIZE)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = None
+        if not data:
+            # Otherwise the connect timeout sweep closes it
+            self.destroy()
+    
     def _on_remote_read(self):
-        """Override remote read"""
-        # Call parent class method, traffic statistics handled in _write_to_sock
-        super()._on_remote_read()
+        """Override remote read, ask the bandwidth scheduler first"""
+        if self._stage != tcprelay.STAGE_STREAM:
+            # Call parent class method, traffic statistics handled in _write_to_sock
+            super()._on_remote_read()
+            return
+        scheduler = self._server.scheduler
+        if scheduler is not None and not scheduler.admit(self):
+            return  # Paused and queued, the scheduler reads when it's our turn
+        bytes_count = self._relay_remote()
+        if scheduler is not None:
+            scheduler.charge(self, bytes_count)
+    
+    def _relay_remote(self):
+        """Read one chunk from the target and relay it to the client, returns bytes relayed"""
+        return self._read_stream(tcprelay.STREAM_DOWN)
+    
+    def _read_size(self, stream):
+        """Get the recv() size of a stream, within the relay's current bounds"""
+        server = self._server
+        if server.read_chunk_min == server.read_chunk_max:
+            return server.read_chunk_max
+        sizes = self._read_sizes
+        if sizes is None:
+            sizes = self._read_sizes = [server.read_chunk_start, server.read_chunk_start]
+        return min(max(sizes[stream], server.read_chunk_min), server.read_chunk_max)
+    
+    def _adapt_read_size(self, stream, size, bytes_count):
+        """
+        Pick the next recv() size of a stream from the last read
+        
+        A read that filled the buffer means more data was waiting: the size
+        doubles, fewer calls then carry a bulk transfer. It halves when reads
+        come back under a quarter full (interactive traffic) or while the
+        other side still has data queued, so a slow receiver isn't fed
+        larger chunks.
+        """
+        server = self._server
+        if server.read_chunk_min == server.read_chunk_max:
+            return
+        if stream == tcprelay.STREAM_UP:
+            backlog = self._upstream_status & tcprelay.WAIT_STATUS_WRITING
+        else:
+            backlog = self._downstream_status & tcprelay.WAIT_STATUS_WRITING
+        jobs = self._crypto_jobs
+        if jobs and jobs[stream] > 1:
+            backlog = True
+        if backlog or bytes_count < size >> 2:
+            if size > server.read_chunk_min:
+                self._read_sizes[stream] = max(size >> 1, server.read_chunk_min)
+                server.read_chunks_shrunk += 1
+        elif bytes_count >= size and size < server.read_chunk_max:
+            self._read_sizes[stream] = min(size << 1, server.read_chunk_max)
+            server.read_chunks_grown += 1
+    
+    def _read_stream(self, stream):
+        """
+        Read one chunk in the stream stage, cipher it inline or on the offload pool
+        
+        The read size adapts per stream, see _adapt_read_size. Chunks of at
+        least the offload threshold go to a worker. While a stream has chunks
+        in flight, later chunks follow them there: the cipher state and the
+        write order are both sequential.
+        
+        Returns:
+            int: bytes read
+        """
+        if stream == tcprelay.STREAM_UP:
+            source, cipher = self._local_sock, self._encryptor.decipher
+        else:
+            source, cipher = self._remote_sock, self._encryptor.cipher
+        size = self._read_size(stream)
+        data = None
+        try:
+            data = source.recv(size)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+        if not data:
+            self.destroy()
+            return 0
+        bytes_count = len(data)
+        self._server.count_read(size, bytes_count)
+        self._update_activity(bytes_count)
+        offload = self._server.crypto_offload
+        jobs = self._crypto_jobs
+        update = None
+        if offload is not None and ((jobs and jobs[stream]) or 0 < offload.threshold <= bytes_count):
+            update = update_function(cipher)
+        if update is None:
+            # Inline, like the parent
+            if stream == tcprelay.STREAM_UP:
+                self._write_to_sock(self._encryptor.decrypt(data), self._remote_sock)
+            else:
+                self._write_to_sock(self._encryptor.encrypt(data), self._local_sock)
+            if self._stage == tcprelay.STAGE_STREAM:
+                self._adapt_read_size(stream, size, bytes_count)
+            return bytes_count
+        prefix = b''
+        if stream == tcprelay.STREAM_DOWN and not self._encryptor.iv_sent:
+            self._encryptor.iv_sent = True
+            prefix = self._encryptor.cipher_iv
+        if jobs is None:
+            jobs = self._crypto_jobs = [0, 0]
+        jobs[stream] += 1
+        offload.submit(self, stream, update, cipher, data, prefix)
+        if jobs[stream] >= MAX_IN_FLIGHT:
+            # Stop reading this stream until a chunk comes back
+            self._update_stream(stream, tcprelay.WAIT_STATUS_INIT)
+        self._adapt_read_size(stream, size, bytes_count)
+        return bytes_count
+    
+    def crypto_done(self, stream, data):
+        """Write a chunk ciphered on the offload pool (loop thread, in read order)"""
+        self._crypto_jobs[stream] -= 1
+        if self._stage == tcprelay.STAGE_DESTROYED:
+            return
+        if data is None:
+            self.destroy()  # Cipher failed, the stream can't continue
+            return
+        if stream == tcprelay.STREAM_UP:
+            if self._upstream_status & tcprelay.WAIT_STATUS_WRITING:
+                # Earlier data still waits for the socket, queue behind it
+                self._data_to_write_to_remote.append(data)
+            else:
+                self._write_to_sock(data, self._remote_sock)
+        elif self._downstream_status & tcprelay.WAIT_STATUS_WRITING:
+            self._data_to_write_to_local.append(data)
+        else:
+            # A complete write resumes reading the stream unless it is still at MAX_IN_FLIGHT
+            self._write_to_sock(data, self._local_sock)
+    
+    def _update_stream(self, stream, status):
+        """Override stream update, keep reads off while the scheduler or the offload pool holds them"""
+        if status == tcprelay.WAIT_STATUS_READING and (
+                (stream == tcprelay.STREAM_DOWN and self._remote_paused)
+                or (self._crypto_jobs is not None and self._crypto_jobs[stream] >= MAX_IN_FLIGHT)):
+            status = tcprelay.WAIT_STATUS_INIT
+        super()._update_stream(stream, status)
+    
+    def pause_remote_read(self):
+        """Stop polling the target socket for reads (bandwidth scheduler)"""
+        self._remote_paused = True
+        if self._downstream_status == tcprelay.WAIT_STATUS_READING:
+            self._update_stream(tcprelay.STREAM_DOWN, tcprelay.WAIT_STATUS_INIT)
+    
+    def resume_remote_read(self):
+        """Poll the target socket for reads again"""
+        self._remote_paused = False
+        if self._stage == tcprelay.STAGE_STREAM and self._downstream_status == tcprelay.WAIT_STATUS_INIT:
+            self._update_stream(tcprelay.STREAM_DOWN, tcprelay.WAIT_STATUS_READING)
+    
+    def scheduled_remote_read(self):
+        """
+        Read one chunk from the target on behalf of the scheduler
+        
+        Returns:
+            tuple: (bytes sent to the client, whether more data is likely waiting);
+                when no more is expected the handler polls its target again
+        """
+        if self._stage != tcprelay.STAGE_STREAM:
+            return 0, False
+        if self._downstream_status & tcprelay.WAIT_STATUS_WRITING:
+            # Client is slow, parent resumes target reads once its buffer drains
+            self._remote_paused = False
+            return 0, False
+        size = self._read_size(tcprelay.STREAM_DOWN)
+        count = self._relay_remote()
+        if (count >= size and self._stage == tcprelay.STAGE_STREAM
+                and not self._downstream_status & tcprelay.WAIT_STATUS_WRITING
+                and not (self._crypto_jobs and self._crypto_jobs[tcprelay.STREAM_DOWN] >= MAX_IN_FLIGHT)):
+            return count, True  # Full read, stay queued without touching the poller
+        self.resume_remote_read()
+        return count, False
     
     def destroy(self):
         """Destroy connection, call statistics callback"""
-        if self.stats_callback:
+        chain = self._chain
+        if chain is not None:
+            # Not the parent's _remote_sock yet
+            self._chain = None
+            self._loop.remove(chain.sock)
+            del self._fd_to_handlers[chain.sock.fileno()]
+            chain.sock.close()
+            # Cut short by a proxy error, the connect timeout or the client leaving
+            self._upstream_counters.failures += 1
+        if self._upstream_counters is not None and self._stage != tcprelay.STAGE_DESTROYED:
+            self._upstream_counters.active -= 1
+        if self._trace is not None:
+            self._trace.finish(self._start_time, time.monotonic())
+            self._trace = None
+        if self.stats_callback and self._stage != tcprelay.STAGE_DESTROYED:
+            # Reported once: destroy() may run again on a destroyed handler
+            self.stats_callback('record_latency', self.timings.durations(time.monotonic()))
             self.stats_callback('remove_connection', self.connection_id)
         if self.log_callback:
             try:
@@ -174,28 +751,147 @@ class TCPRelayExt(tcprelay.TCPRelay):
     """Extended TCPRelay with connection limit and statistics"""
     
     def __init__(self, config, dns_resolver, is_local, 
-                 stats_callback=None, log_callback=None, max_connections=2000):
-        # Call parent class initialization
-        super().__init__(config, dns_resolver, is_local)
+                 stats_callback=None, log_callback=None, max_connections=2000, replay_filter=None,
+                 scheduler=None, crypto_offload=None, listener=None, loop_tasks=None, trace_recorder=None,
+                 connection_ids=None, upstreams=None):
+        if listener is None:
+            # Call parent class initialization
+            super().__init__(config, dns_resolver, is_local)
+        else:
+            self._adopt_listener(config, dns_resolver, is_local, listener)
+        self.loop_tasks = loop_tasks  # LoopTaskQueue of the loop this relay runs on
+        # Statistics connection IDs, shared by the relays of a loop and disjoint between loops
+        self.connection_ids = connection_ids if connection_ids is not None else itertools.count(1)
         self.stats_callback = stats_callback
         self.log_callback = log_callback
         self.max_connections = max_connections
+        self.replay_filter = replay_filter  # Shared by all relays of a server
+        self.scheduler = scheduler  # FairScheduler or None, shared by all relays of a server
+        self.crypto_offload = crypto_offload  # CryptoOffload or None, shared by all relays of a server
+        self.trace_recorder = trace_recorder  # TraceRecorder or None, shared by all relays of a server
+        self.upstreams = upstreams  # UpstreamPool or None, shared by all relays of a server
+        self.upstream_counters = {}  # Upstream name -> UpstreamCounters of this relay's connections
         self._connection_count_lock = threading.Lock()
+        self._handlers = set()  # Live connection handlers, a handler has one or two fds
+        self._draining = False
+        self._accepting = True
+        self._connect_timeout = config.get('target_connect_timeout', 30)
+        self.events_handled = 0  # Events dispatched by handle_event
+        self.event_time = 0.0  # Seconds spent in handle_event
+        self.read_counts = {}  # recv() size -> [reads, bytes read]
+        self.read_chunks_grown = 0
+        self.read_chunks_shrunk = 0
+        self._build_read_chunks()
+        self._build_socket_options()
+        self._build_acls()
+        self.fast_open_active = False
+        if self._server_socket is not None:
+            apply_socket_options(self._server_socket, listener_socket_options(self.socket_options))
+            self._configure_listener()
+    
+    def _configure_listener(self):
+        """Size the listen backlog and TCP Fast Open queue of the bound listening socket"""
+        backlog = self._config.get('listen_backlog', 1024)
+        fast_open = bool(self._config.get('fast_open')) and TCP_FASTOPEN is not None
+        if fast_open or self.fast_open_active:
+            # Parent sets a TFO queue of 5 (or clears fast_open if refused), size it like the backlog
+            try:
+                self._server_socket.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, backlog if fast_open else 0)
+                self.fast_open_active = fast_open
+            except OSError:
+                pass
+        # listen() again to replace the parent's fixed backlog of 1024
+        self._server_socket.listen(backlog)
+    
+    def update_listener(self, changes):
+        """Apply fast_open and listen_backlog to the listening socket in place, queued connections stay"""
+        self._config.update(changes)
+        if self._server_socket is not None:
+            self._configure_listener()
+    
+    def _adopt_listener(self, config, dns_resolver, is_local, listener):
+        """Set up the parent's state around a listening socket created elsewhere (e.g. SO_REUSEPORT)"""
+        self._config = config
+        self._is_local = is_local
+        self._dns_resolver = dns_resolver
+        self._closed = False
+        self._eventloop = None
+        self._fd_to_handlers = {}
+        self._timeout = config['timeout']
+        self._timeouts = []
+        self._timeout_offset = 0
+        self._handler_to_timeouts = {}
+        self._listen_port = listener.getsockname()[1]
+        self._server_socket = listener
+        self._stat_callback = None
+    
+    def _build_acls(self, sides=('client', 'target')):
+        """Compile allow/deny rules into client_acl / target_acl (hit counters start over)"""
+        for side in sides:
+            setattr(self, f'{side}_acl', AccessList(self._config.get(f'{side}_allow'),
+                                                    self._config.get(f'{side}_deny')))
+    
+    def get_acl_stats(self):
+        """Get ACL rules with hit counters"""
+        return {'client': self.client_acl.get_stats(), 'target': self.target_acl.get_stats()}
+    
+    def _build_read_chunks(self):
+        """Set the bounds of the per-stream read size, equal bounds read fixed chunks"""
+        low = max(MIN_READ_CHUNK, int(self._config.get('read_chunk_min', 4096)))
+        high = max(low, int(self._config.get('read_chunk_max', 131072)))
+        self.read_chunk_min = low
+        self.read_chunk_max = high
+        self.read_chunk_start = min(max(tcprelay.BUF_SIZE, low), high)
+    
+    def count_read(self, size, bytes_count):
+        """Count a stream read of bytes_count with a buffer of size (loop thread)"""
+        counts = self.read_counts.get(size)
+        if counts is None:
+            counts = self.read_counts[size] = [0, 0]
+        counts[0] += 1
+        counts[1] += bytes_count
+    
+    def get_upstream_counters(self, name):
+        """Get this relay's counters of an upstream, created on first use (loop thread)"""
+        counters = self.upstream_counters.get(name)
+        if counters is None:
+            counters = self.upstream_counters[name] = UpstreamCounters()
+        return counters
+    
+    def get_read_chunk_stats(self):
+        """Get read size bounds and reads per size"""
+        return {
+            'min': self.read_chunk_min,
+            'max': self.read_chunk_max,
+            'grown': self.read_chunks_grown,
+            'shrunk': self.read_chunks_shrunk,
+            'sizes': {size: list(counts) for size, counts in list(self.read_counts.items())},
+        }
+    
+    def _build_socket_options(self):
+        """Precompute socket options for accepted and remote sockets"""
+        self.socket_options = build_socket_options(self._config)
+        self.remote_socket_options = build_socket_options(self._config, remote=True)
     
     def _get_connection_count(self):
         """Get current connection count"""
-        # _fd_to_handlers contains server socket and all client connections
-        # Server socket handler is self, client connection handlers are TCPRelayHandlerExt instances
+        # Not len(_fd_to_handlers): a connection with its target socket open has two fds there
         with self._connection_count_lock:
-            count = len(self._fd_to_handlers)
-            # If server socket is in _fd_to_handlers, subtract 1
-            if self._server_socket and self._server_socket.fileno() in self._fd_to_handlers:
-                count -= 1
-            return max(0, count)
+            return len(self._handlers)
     
     def handle_event(self, sock, fd, event):
+        """Handle event, counting events and time spent for the loop monitor"""
+        start = time.perf_counter()
+        try:
+            self._dispatch_event(sock, fd, event)
+        finally:
+            self.events_handled += 1
+            self.event_time += time.perf_counter() - start
+    
+    def _dispatch_event(self, sock, fd, event):
         """Handle event, add connection limit"""
-        if sock == self._server_socket:
+        # Server socket is None once the relay is draining
+        if self._server_socket is not None and sock == self._server_socket:
             if event & eventloop.POLL_ERR:
                 raise Exception('server_socket error')
             
@@ -237,6 +933,12 @@ class TCPRelayExt(tcprelay.TCPRelay):
             
             try:
                 conn = self._server_socket.accept()
+                if self.client_acl and not self.client_acl.allows_ip(conn[1][0]):
+                    conn[0].close()
+                    self._stats_wrapper('reject_connection')
+                    if self.log_callback:
+                        self.log_callback(f"Client denied by ACL: {conn[1][0]}")
+                    return
                 # Create extended Handler
                 handler = TCPRelayHandlerExt(
                     self, self._fd_to_handlers,
@@ -245,6 +947,7 @@ class TCPRelayExt(tcprelay.TCPRelay):
                     stats_callback=self._stats_wrapper,
                     log_callback=self.log_callback
                 )
+                self._handlers.add(handler)
                 # Notify connection established (after handler created, connection count is updated)
                 current_count = self._get_connection_count()
                 if self.stats_callback:
@@ -293,10 +996,107 @@ class TCPRelayExt(tcprelay.TCPRelay):
             # Actual statistics completed in TCPRelayHandlerExt._write_to_sock
             pass
     
+    def update_config(self, changes):
+        """Apply live-reloadable configuration changes
+
+        Handlers read password/method from the shared config dict when they are
+        created, so new connections use the new values while existing ones keep
+        their encryptors.
+        """
+        self._config.update(changes)
+        if 'timeout' in changes:
+            self._timeout = changes['timeout']
+        if 'target_connect_timeout' in changes:
+            self._connect_timeout = changes['target_connect_timeout']
+        if 'max_connections' in changes:
+            self.max_connections = changes['max_connections']
+        if 'read_chunk_min' in changes or 'read_chunk_max' in changes:
+            self._build_read_chunks()
+        if any(key in SOCKET_OPTION_KEYS for key in changes):
+            self._build_socket_options()
+        if any(key in ACL_KEYS for key in changes):
+            self._build_acls([side for side in ('client', 'target')
+                              if f'{side}_allow' in changes or f'{side}_deny' in changes])
+    
+    def drain(self):
+        """Stop accepting new connections, existing connections keep running"""
+        if self._draining:
+            return
+        self._draining = True
+        if self._server_socket:
+            if self._eventloop:
+                self._eventloop.remove(self._server_socket)
+            self._server_socket.close()
+            self._server_socket = None
+            if self.log_callback:
+                self.log_callback(f"Stopped listening on port {self._listen_port}, draining existing connections")
+    
+    def set_accepting(self, accepting):
+        """Pause or resume accepting new connections (listener stays bound)"""
+        if accepting == self._accepting:
+            return
+        self._accepting = accepting
+        if self._server_socket is not None and self._eventloop:
+            # Pending connections wait in the kernel backlog while paused
+            mode = eventloop.POLL_IN | eventloop.POLL_ERR if accepting else eventloop.POLL_ERR
+            self._eventloop.modify(self._server_socket, mode)
+    
+    def is_accepting(self):
+        """Check if relay is accepting new connections"""
+        return self._accepting and not self._draining
+    
+    def is_draining(self):
+        """Check if relay has stopped accepting connections"""
+        return self._draining
+    
+    def get_handler_count(self):
+        """Get number of live connection handlers"""
+        return len(self._handlers)
+    
+    def get_stream_handlers(self):
+        """Get handlers in the stream stage (both sockets connected)"""
+        return [handler for handler in set(self._fd_to_handlers.values())
+                if isinstance(handler, TCPRelayHandlerExt) and handler._stage == tcprelay.STAGE_STREAM]
+    
+    def handle_periodic(self):
+        """Periodic housekeeping: idle and connect timeouts"""
+        if self._draining:
+            # Parent would stop the whole event loop once handlers are gone
+            self._sweep_timeout()
+        else:
+            super().handle_periodic()
+        self._sweep_connect_timeout()
+    
+    def _sweep_connect_timeout(self):
+        """Destroy handlers that did not reach the stream stage in time"""
+        if not self._connect_timeout or self._connect_timeout <= 0:
+            return
+        now = time.time()
+        for handler in set(self._fd_to_handlers.values()):
+            if not isinstance(handler, TCPRelayHandlerExt):
+                continue
+            if handler._stage in (tcprelay.STAGE_STREAM, tcprelay.STAGE_DESTROYED):
+                continue
+            if now - handler._start_time > self._connect_timeout:
+                if self.log_callback:
+                    target_info = f" -> {handler.target_addr}" if handler.target_addr else ""
+                    self.log_callback(f"Connect timeout: {handler.client_ip}{target_info}")
+                handler.destroy()
+    
+    def close(self, next_tick=False):
+        """Close relay, also works after drain() has closed the server socket"""
+        if self._server_socket is not None:
+            super().close(next_tick)
+            return
+        self._closed = True
+        if not next_tick:
+            if self._eventloop:
+                self._eventloop.remove_periodic(self.handle_periodic)
+            for handler in list(self._fd_to_handlers.values()):
+                handler.destroy()
+    
     def remove_handler(self, handler):
-        """Remove handler"""
+        """Remove handler (called once, from its destroy(), which reports the closed connection)"""
         super().remove_handler(handler)
-        # Notify connection closed
-        if isinstance(handler, TCPRelayHandlerExt) and self.stats_callback:
-            self.stats_callback('remove_connection', handler.connection_id)
+        self._handlers.discard(handler)
 
@@ -0,0 +1,190 @@
+"""Connection traces - chunk sizes and timing of real connections, without payload
+
+A trace file starts with MAGIC followed by one record per closed connection:
+
+    varint record length
+    varint start (wall clock, microseconds since the epoch)
+    varint lifetime (microseconds)
+    varint flags (FLAG_TRUNCATED)
+    varint event count
+    per event: varint (gap << 1 | direction), varint bytes
+
+The gap is the microseconds since the previous event (the accept for the
+first one). Records are appended, so traces of several runs can share a file.
+"""
+import threading
+from collections import namedtuple
+
+MAGIC = b'SSTRACE1'
+UP = 0  # Client -> target, bytes written to the target
+DOWN = 1  # Target -> client, bytes written to the client
+FLAG_TRUNCATED = 1  # Events stopped at MAX_EVENTS, the lifetime is still complete
+MAX_EVENTS = 65536  # Events kept per connection (bounds memory of long downloads)
+
+# start: wall clock seconds; lifetime: seconds;
+# events: [(seconds since accept, direction, bytes)]
+TracedConnection = namedtuple('TracedConnection', 'start lifetime events truncated')
+
+
+def put_varint(buffer, value):
+    """Append an unsigned LEB128 varint to a bytearray"""
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def get_varint(data, pos):
+    """Read a varint, returns (value, next position)"""
+    value = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[pos]
+        except IndexError:
+            raise ValueError("Truncated trace record") from None
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class ConnectionTrace:
+    """Events of one live connection, already varint-encoded"""
+    __slots__ = ('recorder', 'accept', 'offset', 'events', 'count', 'truncated')
+
+    def __init__(self, recorder, accept):
+        self.recorder = recorder
+        self.accept = accept  # Monotonic accept time
+        self.offset = 0  # Microseconds since accept of the last event
+        self.events = bytearray()
+        self.count = 0
+        self.truncated = False
+
+    def record(self, direction, size, now):
+        """Add an event (loop thread)"""
+        if self.count >= MAX_EVENTS:
+            self.truncated = True
+            return
+        offset = int((now - self.accept) * 1000000)
+        put_varint(self.events, max(0, offset - self.offset) << 1 | direction)
+        put_varint(self.events, size)
+        self.offset = max(offset, self.offset)
+        self.count += 1
+
+    def finish(self, start, closed):
+        """Hand the connection to the recorder (start: wall clock, closed: monotonic)"""
+        self.recorder.write(self, start, closed)
+
+
+class TraceRecorder:
+    """
+    Appends connection traces to a file
+
+    Records are encoded on the loop thread when a connection closes and go
+    through a buffered file under a lock, so relay loops can share one
+    recorder. Recording stops once the file reaches max_bytes.
+    """
+
+    def __init__(self, path, max_bytes=0, log_callback=None):
+        """
+        Args:
+            path: trace file, appended to
+            max_bytes: stop recording at this file size (0 = no limit)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.log_callback = log_callback
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab', buffering=65536)
+        try:
+            self.size = self._file.tell()
+            if self.size == 0:
+                self._file.write(MAGIC)
+                self.size = len(MAGIC)
+            else:
+                with open(path, 'rb') as existing:
+                    if existing.read(len(MAGIC)) != MAGIC:
+                        raise ValueError(f"{path} is not a connection trace file")
+        except Exception:
+            self._file.close()
+            raise
+        self.connections = 0
+        self.recording = True
+
+    def open(self, accept):
+        """Start tracing a new connection, None while not recording"""
+        return ConnectionTrace(self, accept) if self.recording else None
+
+    def write(self, trace, start, closed):
+        """Append a closed connection's record"""
+        body = bytearray()
+        put_varint(body, int(start * 1000000))
+        put_varint(body, int((closed - trace.accept) * 1000000))
+        put_varint(body, FLAG_TRUNCATED if trace.truncated else 0)
+        put_varint(body, trace.count)
+        body += trace.events
+        record = bytearray()
+        put_varint(record, len(body))
+        record += body
+        with self._lock:
+            if not self.recording:
+                return
+            self._file.write(record)
+            self.size += len(record)
+            self.connections += 1
+            if self.max_bytes and self.size >= self.max_bytes:
+                self.recording = False
+                self._file.flush()
+                if self.log_callback:
+                    self.log_callback(f"Trace file {self.path} reached its size limit, recording stopped")
+
+    def close(self):
+        """Stop recording and close the file (connections still open are not written)"""
+        with self._lock:
+            self.recording = False
+            if not self._file.closed:
+                self._file.close()
+
+    def get_stats(self):
+        """Get recorder state"""
+        return {
+            'file': self.path,
+            'recording': self.recording,
+            'connections': self.connections,
+            'bytes': self.size,
+        }
+
+
+def read_trace(path):
+    """
+    Read the connections of a trace file in the order they were written
+
+    Yields:
+        TracedConnection
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a connection trace file")
+    pos = len(MAGIC)
+    while pos < len(data):
+        length, pos = get_varint(data, pos)
+        end = pos + length
+        if end > len(data):
+            return  # Last record cut short (recorder killed mid-write)
+        start, pos = get_varint(data, pos)
+        lifetime, pos = get_varint(data, pos)
+        flags, pos = get_varint(data, pos)
+        count, pos = get_varint(data, pos)
+        events = []
+        offset = 0
+        for _ in range(count):
+            value, pos = get_varint(data, pos)
+            size, pos = get_varint(data, pos)
+            offset += value >> 1
+            events.append((offset / 1000000, value & 1, size))
+        if pos != end:
+            raise ValueError("Corrupt trace record")
+        yield TracedConnection(start / 1000000, lifetime / 1000000, events, bool(flags & FLAG_TRUNCATED))
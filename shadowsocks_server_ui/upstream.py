@@ -0,0 +1,659 @@
+"""Upstream proxies - reach matching targets through SOCKS5 or HTTP CONNECT proxies
+
+Rules map target CIDRs and domain suffixes to named upstreams. A pool thread
+keeps a few connections per upstream open (SOCKS5 ones already past method
+negotiation and authentication), so a chained connection usually costs one
+CONNECT round trip. The same thread checks upstream health.
+"""
+import time
+import errno
+import socket
+import base64
+import threading
+import ipaddress
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit, unquote
+
+try:
+    from shadowsocks_server_ui.acl import IPTrie, DomainTrie, parse_ip
+    from shadowsocks_server_ui.sockopts import apply_socket_options
+except ImportError:
+    from .acl import IPTrie, DomainTrie, parse_ip
+    from .sockopts import apply_socket_options
+
+# Config keys of upstream chaining
+UPSTREAM_KEYS = ('upstreams', 'upstream_rules', 'upstream_pool_size', 'upstream_health_interval')
+SCHEMES = ('socks5', 'http')
+DIRECT = 'direct'  # Rule target for connecting directly, overrides broader rules
+
+CHECK_TIMEOUT = 5  # Seconds a pool connection or health check may take
+IDLE_MAX_AGE = 60  # Seconds a pooled connection may wait before it is replaced
+RETRY_INTERVAL = 5  # Seconds before refilling the pool of a failed upstream
+MAX_REPLY = 8192  # Largest HTTP CONNECT response header accepted
+
+SOCKS5_ERRORS = {
+    1: 'general failure',
+    2: 'connection not allowed by ruleset',
+    3: 'network unreachable',
+    4: 'host unreachable',
+    5: 'connection refused',
+    6: 'TTL expired',
+    7: 'command not supported',
+    8: 'address type not supported',
+}
+
+
+class UpstreamError(Exception):
+    """Upstream proxy refused or broke the handshake"""
+
+
+class Upstream:
+    """One upstream proxy from the config, with its health"""
+    __slots__ = ('name', 'scheme', 'host', 'port', 'username', 'password', 'address',
+                 'healthy', 'check_ms', 'checked', 'last_error', 'next_check', 'retry_at')
+
+    def __init__(self, name, url):
+        parts = urlsplit(str(url))
+        scheme = parts.scheme.lower()
+        if scheme == 'socks5h':
+            scheme = 'socks5'  # Target names always go to the proxy
+        if scheme not in SCHEMES:
+            raise ValueError(f"Upstream {name}: unsupported scheme {parts.scheme!r} (socks5 or http)")
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        if not parts.hostname or not port:
+            raise ValueError(f"Upstream {name}: URL needs a host and a port")
+        self.name = name
+        self.scheme = scheme
+        self.host = parts.hostname
+        self.port = port
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else ''
+        if scheme == 'socks5' and self.username and (len(self.username.encode()) > 255
+                                                     or len(self.password.encode()) > 255):
+            raise ValueError(f"Upstream {name}: SOCKS5 user name and password are limited to 255 bytes")
+        self.address = None  # (family, sockaddr) once resolved
+        parsed = parse_ip(self.host)
+        if parsed is not None:
+            family = socket.AF_INET if parsed[0] == 4 else socket.AF_INET6
+            self.address = (family, (self.host, self.port))
+        self.healthy = None  # Unknown until the first check
+        self.check_ms = None
+        self.checked = None  # time.time() of the last check
+        self.last_error = None
+        self.next_check = 0.0  # time.monotonic() of the next health check
+        self.retry_at = 0.0  # No pool connections before this time.monotonic() after a failure
+
+    @property
+    def url(self):
+        """URL without credentials"""
+        host = f"[{self.host}]" if ':' in self.host else self.host
+        return f"{self.scheme}://{host}:{self.port}"
+
+    def resolve(self):
+        """Look up the proxy address (blocking, pool thread)"""
+        if parse_ip(self.host) is not None:
+            return
+        family, _, _, _, sockaddr = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.address = (family, sockaddr)
+
+    def create_socket(self, options=None):
+        """
+        Start a non-blocking connect to the proxy
+
+        Args:
+            options: socket options applied before connecting, see sockopts
+        """
+        if self.address is None:
+            raise OSError(f"address of {self.host} not resolved yet")
+        family, sockaddr = self.address
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            if options is not None:
+                apply_socket_options(sock, options)
+            error = sock.connect_ex(sockaddr)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise OSError(error, f"connect to {self.url}: {errno.errorcode.get(error, error)}")
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+
+class Handshake:
+    """
+    Protocol side of an upstream handshake, socket I/O is left to the caller
+
+    `out` holds bytes to send, feed() takes what the proxy answered. With a
+    target the handshake ends once the proxy connected it; without one it
+    ends where a pooled connection waits (SOCKS5 authenticated, HTTP at once).
+    """
+    __slots__ = ('upstream', 'sock', 'out', 'done', 'started', 'connected', '_request', '_state', '_buffer')
+
+    def __init__(self, upstream, host=None, port=None, pooled=False, sock=None):
+        """
+        Args:
+            upstream: Upstream to talk to
+            host, port: target to connect (None: prepare a pooled connection)
+            pooled: the connection already went through the handshake without a target
+            sock: socket of the handshake, kept for the caller
+        """
+        self.upstream = upstream
+        self.sock = sock
+        self.started = time.monotonic()
+        self.connected = pooled  # TCP connect finished
+        self.done = False
+        self._buffer = b''
+        self._request = None if host is None else self._connect_request(host, port)
+        if upstream.scheme == 'http' or pooled:
+            self.out = self._request or b''
+            self._state = 'reply'
+            if self._request is None:
+                self.done = True
+        else:
+            methods = b'\x00\x02' if upstream.username else b'\x00'
+            self.out = b'\x05' + bytes([len(methods)]) + methods
+            self._state = 'method'
+
+    def _connect_request(self, host, port):
+        """Build the CONNECT request for a target"""
+        if self.upstream.scheme == 'http':
+            authority = f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+            lines = [f"CONNECT {authority} HTTP/1.1", f"Host: {authority}"]
+            if self.upstream.username:
+                credentials = f"{self.upstream.username}:{self.upstream.password}".encode()
+                lines.append(f"Proxy-Authorization: Basic {base64.b64encode(credentials).decode()}")
+            return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+        parsed = parse_ip(host)
+        if parsed is None:
+            try:
+                name = host.encode('idna')
+            except UnicodeError:
+                raise UpstreamError(f"bad target name: {host}") from None
+            if len(name) > 255:
+                raise UpstreamError(f"target name too long: {host}")
+            address = b'\x03' + bytes([len(name)]) + name
+        elif ':' in host:
+            address = b'\x04' + socket.inet_pton(socket.AF_INET6, host.strip('[]'))
+        else:
+            address = b'\x01' + socket.inet_aton(host)
+        return b'\x05\x01\x00' + address + port.to_bytes(2, 'big')
+
+    def feed(self, data):
+        """
+        Take bytes from the proxy, queue the next message in `out`
+
+        Returns:
+            bytes: data after the proxy's final answer (the target's first bytes) once done
+
+        Raises:
+            UpstreamError: the proxy refused or answered something else
+        """
+        self._buffer += data
+        while not self.done:
+            step = getattr(self, f'_read_{self._state}')()
+            if step is None:
+                return b''  # Need more bytes
+        extra, self._buffer = self._buffer, b''
+        return extra
+
+    def _take(self, count):
+        """Remove count bytes from the buffer, None if fewer arrived"""
+        if len(self._buffer) < count:
+            return None
+        data, self._buffer = self._buffer[:count], self._buffer[count:]
+        return data
+
+    def _read_method(self):
+        reply = self._take(2)
+        if reply is None:
+            return None
+        if reply[0] != 5:
+            raise UpstreamError("not a SOCKS5 proxy")
+        if reply[1] == 0:
+            return self._authenticated()
+        if reply[1] == 2 and self.upstream.username:
+            user = self.upstream.username.encode()
+            password = self.upstream.password.encode()
+            self.out += b'\x01' + bytes([len(user)]) + user + bytes([len(password)]) + password
+            self._state = 'auth'
+            return True
+        raise UpstreamError("no acceptable authentication method")
+
+    def _read_auth(self):
+        reply = self._take(2)
+        if reply is None:
+            return None
+        if reply[1] != 0:
+            raise UpstreamError("authentication failed")
+        return self._authenticated()
+
+    def _authenticated(self):
+        if self._request is None:
+            self.done = True  # Pooled connection, the CONNECT comes later
+        else:
+            self.out += self._request
+            self._state = 'reply'
+        return True
+
+    def _read_reply(self):
+        if self.upstream.scheme == 'http':
+            return self._read_http_reply()
+        if len(self._buffer) < 5:
+            return None
+        if self._buffer[0] != 5:
+            raise UpstreamError("not a SOCKS5 proxy")
+        if self._buffer[1] != 0:
+            raise UpstreamError(SOCKS5_ERRORS.get(self._buffer[1], f"error {self._buffer[1]}"))
+        address_type = self._buffer[3]
+        if address_type == 1:
+            length = 10
+        elif address_type == 4:
+            length = 22
+        elif address_type == 3:
+            length = 7 + self._buffer[4]
+        else:
+            raise UpstreamError(f"bad address type {address_type}")
+        if self._take(length) is None:
+            return None
+        self.done = True
+        return True
+
+    def _read_http_reply(self):
+        end = self._buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self._buffer) > MAX_REPLY:
+                raise UpstreamError("response header too long")
+            return None
+        status_line = self._take(end + 4).split(b'\r\n', 1)[0].decode('latin-1')
+        parts = status_line.split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise UpstreamError(f"not an HTTP proxy: {status_line[:80]}")
+        if not parts[1].startswith('2'):
+            raise UpstreamError(f"CONNECT refused: {status_line[:80]}")
+        self.done = True
+        return True
+
+
+class Route:
+    """One rule of upstream_rules"""
+    __slots__ = ('pattern', 'upstream')
+    allows = True  # Trie tie-break: the first rule inserted on a prefix stays
+
+    def __init__(self, pattern, upstream):
+        self.pattern = pattern
+        self.upstream = upstream  # Upstream name, None for direct
+
+
+def build_routes(rules, names):
+    """
+    Compile upstream_rules into tries, longest prefix / suffix wins
+
+    Args:
+        rules: {pattern: upstream name or 'direct'}, patterns as in ACLs
+        names: configured upstream names
+
+    Returns:
+        tuple: ({4: IPTrie, 6: IPTrie}, DomainTrie)
+
+    Raises:
+        ValueError: bad pattern or unknown upstream
+    """
+    ip_tries = {4: IPTrie(32), 6: IPTrie(128)}
+    domains = DomainTrie()
+    for pattern, name in (rules or {}).items():
+        pattern = str(pattern).strip()
+        if name != DIRECT and name not in names:
+            raise ValueError(f"Upstream rule {pattern}: unknown upstream {name!r}")
+        route = Route(pattern, None if name == DIRECT else name)
+        if pattern == '*':
+            ip_tries[4].insert(0, 0, route)
+            ip_tries[6].insert(0, 0, route)
+            domains.insert('', route)
+            continue
+        try:
+            network = ipaddress.ip_network(pattern, strict=False)
+        except ValueError:
+            domain = pattern.lower().lstrip('*').strip('.')
+            if not domain or ' ' in domain or '/' in domain:
+                raise ValueError(f"Invalid upstream rule pattern: {pattern}") from None
+            domains.insert(domain, route)
+        else:
+            ip_tries[network.version].insert(int(network.network_address), network.prefixlen, route)
+    return ip_tries, domains
+
+
+def mask_url(url):
+    """Get an upstream URL with its credentials replaced by ***, for showing the config"""
+    parts = urlsplit(str(url))
+    if '@' not in parts.netloc:
+        return str(url)
+    return urlunsplit(parts._replace(netloc='***@' + parts.netloc.rsplit('@', 1)[1]))
+
+
+def _endpoint(parts):
+    """(scheme, host, port) of a split upstream URL, for matching a masked URL to the stored one"""
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    return ('socks5' if scheme == 'socks5h' else scheme), (parts.hostname or '').lower(), port
+
+
+def unmask_urls(upstreams, current):
+    """
+    Put the stored credentials back into URLs sent with the *** of mask_url
+
+    The credentials are only restored into the stored scheme, host and port,
+    so they can't be sent on to another proxy.
+
+    Raises:
+        ValueError: a *** URL with no stored credentials for that endpoint
+    """
+    current = current or {}
+    result = {}
+    for name, url in (upstreams or {}).items():
+        parts = urlsplit(str(url))
+        if parts.netloc.startswith('***@'):
+            stored = urlsplit(str(current.get(name, '')))
+            if '@' not in stored.netloc or _endpoint(parts) != _endpoint(stored):
+                raise ValueError(f"Upstream {name}: *** only keeps the stored credentials of the same "
+                                 f"scheme, host and port, give the credentials for a changed URL")
+            userinfo = stored.netloc.rsplit('@', 1)[0]
+            url = urlunsplit(parts._replace(netloc=userinfo + parts.netloc[3:]))
+        result[name] = url
+    return result
+
+
+def parse_config(upstreams, rules):
+    """
+    Parse the upstreams and upstream_rules config values
+
+    Returns:
+        tuple: ({name: Upstream}, ip tries, DomainTrie)
+
+    Raises:
+        ValueError: bad URL, rule pattern or upstream name
+    """
+    parsed = {str(name): Upstream(str(name), url) for name, url in (upstreams or {}).items()}
+    ip_tries, domains = build_routes(rules, parsed)
+    return parsed, ip_tries, domains
+
+
+class UpstreamPool:
+    """
+    Upstream proxies, routing rules and pre-connected connections
+
+    Shared by all relay loops: idle connections aren't registered with any
+    event loop, the handler taking one adds it to its own. Routing and take()
+    run on loop threads; the pool thread connects, authenticates and checks.
+    """
+
+    def __init__(self, upstreams=None, rules=None, pool_size=2, health_interval=10, log_callback=None):
+        """
+        Args:
+            upstreams: {name: URL}, see Upstream
+            rules: {pattern: upstream name or 'direct'}
+            pool_size: idle connections kept per upstream
+            health_interval: seconds between health checks (0 = none)
+            log_callback: log function for health changes
+        """
+        self.log_callback = log_callback
+        self._lock = threading.Lock()
+        self._idle = {}  # name -> deque of (socket, time.monotonic() when ready)
+        self._throughput = {}  # name -> (time.monotonic(), bytes_sent, bytes_received, sent_bps, received_bps)
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self.upstreams = {}
+        self.configure(upstreams, rules, pool_size, health_interval)
+
+    def configure(self, upstreams, rules, pool_size=2, health_interval=10):
+        """Replace upstreams and rules (raises ValueError, keeping the old ones, on bad config)"""
+        parsed, ip_tries, domains = parse_config(upstreams, rules)
+        with self._lock:
+            for name, old in self.upstreams.items():
+                new = parsed.get(name)
+                if new is not None and new.url == old.url and (new.username, new.password) == (
+                        old.username, old.password):
+                    parsed[name] = old  # Unchanged, keep its health and pool
+                else:
+                    self._close_idle(name)
+            self.upstreams = parsed
+            self._ip_tries, self._domains = ip_tries, domains
+            self.pool_size = max(0, int(pool_size))
+            self.health_interval = max(0, float(health_interval or 0))
+        self._wakeup.set()
+
+    def start(self):
+        """Start pool thread"""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="UpstreamPool")
+        self._thread.start()
+
+    def stop(self):
+        """Stop pool thread and close idle connections"""
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=CHECK_TIMEOUT + 1)
+        self._thread = None
+        with self._lock:
+            for name in list(self._idle):
+                self._close_idle(name)
+
+    def route_domain(self, host):
+        """
+        Get the route of a target name
+
+        Returns:
+            Route or None: None when no rule matches the name
+        """
+        return self._domains.lookup(host)
+
+    def route_ip(self, address):
+        """Get the route of a target IP address, None when no rule matches"""
+        parsed = parse_ip(address)
+        if parsed is None:
+            return None
+        return self._ip_tries[parsed[0]].lookup(parsed[1])
+
+    def get(self, name):
+        """Get an upstream by name, None if it was removed"""
+        return self.upstreams.get(name)
+
+    def take(self, upstream):
+        """
+        Get a pooled connection to an upstream (loop thread)
+
+        Returns:
+            socket or None: non-blocking socket ready for the CONNECT request, None when the pool is empty
+        """
+        now = time.monotonic()
+        sock = None
+        with self._lock:
+            idle = self._idle.get(upstream.name)
+            while idle:
+                candidate, ready = idle.popleft()
+                if now - ready < IDLE_MAX_AGE and _is_open(candidate):
+                    sock = candidate
+                    break
+                candidate.close()
+        self._wakeup.set()  # Refill
+        return sock
+
+    def _close_idle(self, name):
+        """Close the idle connections of an upstream (lock held)"""
+        for sock, _ in self._idle.pop(name, ()):
+            sock.close()
+
+    def _run(self):
+        """Keep pools filled and check health until stopped"""
+        while not self._stopping:
+            self._wakeup.clear()
+            next_run = time.monotonic() + IDLE_MAX_AGE / 4
+            for upstream in list(self.upstreams.values()):
+                if self._stopping:
+                    return
+                next_run = min(next_run, self._service(upstream))
+            self._wakeup.wait(max(0.05, next_run - time.monotonic()))
+
+    def _service(self, upstream):
+        """Check an upstream if due and top up its pool, returns time.monotonic() of its next service"""
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get(upstream.name, ())
+            # Replace connections halfway to the age limit, proxies drop idle ones
+            while idle and now - idle[0][1] >= IDLE_MAX_AGE / 2:
+                idle.popleft()[0].close()
+        next_run = now + IDLE_MAX_AGE / 4
+        if self.health_interval:
+            if now >= upstream.next_check:
+                # The check's connection goes to the pool, pushing out the oldest
+                upstream.next_check = now + self.health_interval
+                self._open(upstream)
+            next_run = min(next_run, upstream.next_check)
+        while self._missing(upstream) > 0 and not self._stopping:
+            if time.monotonic() < upstream.retry_at:
+                return min(next_run, upstream.retry_at)
+            self._open(upstream)
+        return next_run
+
+    def _missing(self, upstream):
+        """Get the number of idle connections an upstream's pool lacks"""
+        with self._lock:
+            if self.upstreams.get(upstream.name) is not upstream:
+                return 0
+            return self.pool_size - len(self._idle.get(upstream.name, ()))
+
+    def _open(self, upstream):
+        """Open and prepare one pooled connection, it doubles as health check (pool thread)"""
+        start = time.monotonic()
+        sock = None
+        try:
+            upstream.resolve()
+            family, sockaddr = upstream.address
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(CHECK_TIMEOUT)
+            sock.connect(sockaddr)
+            handshake = Handshake(upstream)
+            while not handshake.done:
+                if handshake.out:
+                    sock.sendall(handshake.out)
+                    handshake.out = b''
+                data = sock.recv(512)
+                if not data:
+                    raise UpstreamError("closed the connection")
+                if handshake.feed(data):
+                    raise UpstreamError("sent data before a CONNECT")
+        except (OSError, UpstreamError) as e:
+            if sock is not None:
+                sock.close()
+            self._set_health(upstream, False, f"{type(e).__name__}: {e}" if isinstance(e, OSError) else str(e))
+            upstream.retry_at = time.monotonic() + RETRY_INTERVAL
+            return False
+        upstream.check_ms = round((time.monotonic() - start) * 1000, 1)
+        self._set_health(upstream, True)
+        sock.setblocking(False)
+        with self._lock:
+            if self.upstreams.get(upstream.name) is not upstream:
+                sock.close()  # Reconfigured meanwhile
+                return False
+            idle = self._idle.setdefault(upstream.name, deque())
+            idle.append((sock, time.monotonic()))
+            while len(idle) > self.pool_size:
+                old, _ = idle.popleft()  # Oldest first, a check rotates the pool
+                old.close()
+        return True
+
+    def _set_health(self, upstream, healthy, error=None):
+        """Record a check result and log changes"""
+        upstream.checked = time.time()
+        upstream.last_error = error
+        if healthy != upstream.healthy and self.log_callback:
+            if healthy:
+                self.log_callback(f"INFO: Upstream {upstream.name} ({upstream.url}) is reachable")
+            else:
+                self.log_callback(f"WARNING: Upstream {upstream.name} ({upstream.url}) failed: {error}")
+        upstream.healthy = healthy
+
+    def get_stats(self, counters=None):
+        """
+        Get health, pool and traffic per upstream
+
+        Args:
+            counters: {name: UpstreamCounters} summed over the relays
+        """
+        counters = counters or {}
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for name, upstream in self.upstreams.items():
+                entry = {
+                    'url': upstream.url,
+                    'healthy': upstream.healthy,
+                    'check_ms': upstream.check_ms,
+                    'checked': upstream.checked,
+                    'last_error': upstream.last_error,
+                    'idle': len(self._idle.get(name, ())),
+                }
+                entry.update((counters.get(name) or UpstreamCounters()).as_dict())
+                # Throughput between calls at least a second apart, None on the first call
+                sent, received = entry['bytes_sent'], entry['bytes_received']
+                last = self._throughput.get(name)
+                if last is None:
+                    last = self._throughput[name] = (now, sent, received, None, None)
+                elif now - last[0] >= 1:
+                    elapsed = now - last[0]
+                    last = self._throughput[name] = (now, sent, received, round((sent - last[1]) * 8 / elapsed),
+                                                     round((received - last[2]) * 8 / elapsed))
+                entry['sent_bps'], entry['received_bps'] = last[3], last[4]
+                result[name] = entry
+        return result
+
+
+class UpstreamCounters:
+    """Traffic and handshake counters of one upstream on one relay (loop thread)"""
+    __slots__ = ('connections', 'active', 'pool_hits', 'failures', 'handshakes', 'handshake_time',
+                 'bytes_sent', 'bytes_received')
+
+    def __init__(self):
+        self.connections = 0
+        self.active = 0
+        self.pool_hits = 0  # Connections that skipped connect and authentication
+        self.failures = 0
+        self.handshakes = 0
+        self.handshake_time = 0.0  # Seconds from dialing to the proxy's CONNECT answer
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, other):
+        """Add another relay's counters"""
+        for key in self.__slots__:
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+
+    def as_dict(self):
+        return {
+            'connections': self.connections,
+            'active': self.active,
+            'pool_hits': self.pool_hits,
+            'failures': self.failures,
+            'handshake_ms': round(self.handshake_time * 1000 / self.handshakes, 1) if self.handshakes else None,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+
+def _is_open(sock):
+    """Check that an idle connection is still open and silent"""
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return True  # Nothing to read: open
+    except OSError:
+        return False
+    return False  # Closed, or the proxy sent something unasked
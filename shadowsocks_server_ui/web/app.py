@@ -1,6 +1,9 @@
 """Flask web application"""
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, render_template, jsonify, request, Response
+import hmac
+import functools
 import threading
+import time
 import json
 import os
 
@@ -8,16 +11,28 @@ try:
     from shadowsocks_server_ui.server import ShadowsocksServer
     from shadowsocks_server_ui.config.manager import ConfigManager
     from shadowsocks_server_ui.stats.collector import StatsCollector
+    from shadowsocks_server_ui.stats.store import StatsStore, StatsPersister
+    from shadowsocks_server_ui.stats.geoip import GeoLookup
+    from shadowsocks_server_ui.web import serving
+    from shadowsocks_server_ui.web.federation import Federation, FederationSource
+    from shadowsocks_server_ui.profiling import RelayProfiler
+    from shadowsocks_server_ui.upstream import mask_url, unmask_urls
 except ImportError:
     from ..server import ShadowsocksServer
     from ..config.manager import ConfigManager
     from ..stats.collector import StatsCollector
+    from ..stats.store import StatsStore, StatsPersister
+    from ..stats.geoip import GeoLookup
+    from . import serving
+    from .federation import Federation, FederationSource
+    from ..profiling import RelayProfiler
+    from ..upstream import mask_url, unmask_urls
 
 
 class WebApp:
     """Flask web application wrapper"""
     
-    def __init__(self, host='127.0.0.1', port=5000):
+    def __init__(self, host='127.0.0.1', port=5000, config_file='shadowsocks_config.json'):
         self.host = host
         self.port = port
         # Get the directory where this file is located
@@ -28,11 +43,25 @@ class WebApp:
                         static_folder=os.path.join(web_dir, 'static'))
         self.server = None
         self.stats_collector = StatsCollector()
-        self.config_manager = ConfigManager()
+        self.config_manager = ConfigManager(config_file)
+        self.stats_store = None
+        self.stats_persister = None
         self.server_lock = threading.Lock()
         self.logs = []  # Store logs
         self.max_logs = 500  # Maximum log entries
+        self.max_page_size = 1000  # Maximum items per page in list endpoints
+        # Stats snapshots are shared by all pollers for this long (seconds)
+        self.stats_cache_ttl = 1.0
+        self.stats_cache_size = 32  # Cached snapshots kept at most (keys include query arguments)
+        self._stats_cache = {}  # key -> (expires_at, payload)
+        self._stats_cache_lock = threading.Lock()
         self.logs_lock = threading.Lock()
+        self.profiler = RelayProfiler()
+        # Stats deltas served to aggregators, and the fleet view when peers are configured
+        self.federation_source = FederationSource(self.stats_collector)
+        self.federation = None
+        self.geoip = None  # GeoLookup when GeoIP databases are configured
+        self._geoip_settings = ('', '', None)
         
         # Register routes
         self._register_routes()
@@ -52,6 +81,9 @@ class WebApp:
             # Don't expose password in response
             safe_config = config.copy()
             safe_config['password'] = '***' if config.get('password') else ''
+            safe_config['admin_token'] = '***' if config.get('admin_token') else ''
+            safe_config['federation_token'] = '***' if config.get('federation_token') else ''
+            safe_config['upstreams'] = {name: mask_url(url) for name, url in (config.get('upstreams') or {}).items()}
             return jsonify(safe_config)
         
         @self.app.route('/api/config', methods=['POST'])
@@ -66,8 +98,39 @@ class WebApp:
                     # Keep existing password if not provided
                     data['password'] = current_config.get('password', '')
                 # Otherwise use the new password
+                if data.get('admin_token') == '***':
+                    data['admin_token'] = current_config.get('admin_token', '')
+                if data.get('federation_token') == '***':
+                    data['federation_token'] = current_config.get('federation_token', '')
+                if isinstance(data.get('upstreams'), dict):
+                    data['upstreams'] = unmask_urls(data['upstreams'], current_config.get('upstreams'))
+                # Setting the token would otherwise open the admin endpoints to anyone, and changed
+                # upstreams or federation peers could send the stored credentials elsewhere
+                for key, default in (('admin_token', ''), ('upstreams', {}),
+                                     ('federation_peers', []), ('federation_token', '')):
+                    if key in data and data[key] != (current_config.get(key) or default) and not self._is_admin():
+                        return jsonify({'success': False, 'message': f'Admin access required to change {key}'}), 403
                 
                 self.config_manager.save(data)
+                self._configure_federation(self.config_manager.config)
+                self._configure_geoip(self.config_manager.config)
+
+                # Apply to the running server without restarting it
+                with self.server_lock:
+                    if self.server and self.server.is_running():
+                        try:
+                            result = self.server.apply_config(self.config_manager.config)
+                        except Exception as e:
+                            return jsonify({'success': False,
+                                            'message': f'Configuration saved but not applied: {e}'}), 400
+                        if result['listener_restarted']:
+                            message = 'Configuration saved and applied, old listener is draining'
+                        elif result['applied']:
+                            message = 'Configuration saved and applied'
+                        else:
+                            message = 'Configuration saved'
+                        return jsonify({'success': True, 'message': message, 'applied': result['applied']})
+
                 return jsonify({'success': True, 'message': 'Configuration saved'})
             except Exception as e:
                 return jsonify({'success': False, 'message': str(e)}), 400
@@ -89,6 +152,9 @@ class WebApp:
                     if not config.get('server_port') or config['server_port'] < 1 or config['server_port'] > 65535:
                         return jsonify({'success': False, 'message': 'Invalid port number'}), 400
                     
+                    self.stats_collector.configure(config)
+                    self._start_stats_persistence(config)
+                    
                     # Create and start server
                     self.server = ShadowsocksServer(
                         config,
@@ -99,6 +165,7 @@ class WebApp:
                     if self.server.start():
                         return jsonify({'success': True, 'message': 'Server started successfully'})
                     else:
+                        self._stop_stats_persistence()
                         return jsonify({'success': False, 'message': 'Failed to start server'}), 500
                         
                 except Exception as e:
@@ -114,22 +181,259 @@ class WebApp:
                 try:
                     self.server.stop()
                     self.server = None
+                    # Flush to disk first, counters are restored on next start
+                    self._stop_stats_persistence()
                     self.stats_collector.reset()
                     return jsonify({'success': True, 'message': 'Server stopped successfully'})
                 except Exception as e:
                     return jsonify({'success': False, 'message': str(e)}), 500
         
+        @self.app.route('/api/server/drain', methods=['POST'])
+        def drain_server():
+            """Stop accepting connections, stop the server once open ones finish (progress in status)"""
+            data = request.get_json(silent=True) or {}
+            with self.server_lock:
+                server = self.server
+                if not server or not server.is_running():
+                    return jsonify({'success': False, 'message': 'Server is not running'}), 400
+                if server.get_drain_status():
+                    return jsonify({'success': False, 'message': 'Server is already draining'}), 400
+                try:
+                    timeout = float(data.get('timeout', server.config.get('drain_timeout', 30)))
+                except (TypeError, ValueError):
+                    return jsonify({'success': False, 'message': 'Invalid timeout'}), 400
+                threading.Thread(target=self._drain_server, args=(server, timeout), daemon=True).start()
+            return jsonify({'success': True, 'message': f"Draining, server stops within {timeout:g} seconds"})
+        
         @self.app.route('/api/server/status', methods=['GET'])
         def get_server_status():
             """Get server status"""
             with self.server_lock:
-                is_running = self.server is not None and self.server.is_running()
-                stats = self.stats_collector.get_stats() if self.stats_collector else {}
-                
-                return jsonify({
-                    'running': is_running,
-                    'stats': stats
-                })
+                server = self.server
+                is_running = server is not None and server.is_running()
+            # Dashboard only needs the top entries, drill down via /api/clients
+            # Clamped so the cache key only varies within the page size
+            max_clients = min(max(request.args.get('max_clients', 100, type=int), 1), self.max_page_size)
+            max_targets = min(max(request.args.get('max_targets', 20, type=int), 1), self.max_page_size)
+            stats = self._cached(('status', max_clients, max_targets), lambda: self.stats_collector.get_stats(
+                max_clients=max_clients, max_targets=max_targets))
+            
+            return jsonify({
+                'running': is_running,
+                'drain': server.get_drain_status() if is_running else None,
+                'stats': stats
+            })
+        
+        @self.app.route('/api/stats/latency', methods=['GET'])
+        def get_latency_stats():
+            """Get connection lifecycle latency histograms (microseconds)"""
+            include_buckets = request.args.get('buckets') == '1'
+            return jsonify({
+                'unit': 'us',
+                'stages': self._cached(('latency', include_buckets),
+                                       lambda: self.stats_collector.get_latency_stats(include_buckets))
+            })
+        
+        @self.app.route('/api/stats/tcp', methods=['GET'])
+        def list_tcp_paths():
+            """Get kernel TCP_INFO statistics (RTT, retransmits, delivery rate) per client or target"""
+            try:
+                result = self.stats_collector.list_tcp_paths(
+                    side=request.args.get('side', 'client'),
+                    **self._page_args('rtt_us')
+                )
+                return jsonify(result)
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+
+        @self.app.route('/api/metrics', methods=['GET'])
+        def get_metrics():
+            """Get event loop lag and relay metrics"""
+            server = self.server
+            if not server or not server.is_running():
+                return jsonify({'running': False, 'metrics': {}})
+            metrics = server.get_metrics()
+            geoip = self.geoip
+            if geoip:
+                metrics['geoip'] = geoip.get_stats()
+            return jsonify({'running': True, 'metrics': metrics})
+
+        @self.app.route('/api/clients', methods=['GET'])
+        def list_clients():
+            """Get one page of clients"""
+            try:
+                result = self.stats_collector.list_clients(
+                    ip_prefix=request.args.get('ip'),
+                    active_only=request.args.get('active', 'true') != 'false',
+                    min_bytes=request.args.get('min_bytes', 0, type=int),
+                    cursor=request.args.get('cursor'),
+                    **self._page_args('total_bytes')
+                )
+                geoip = self.geoip
+                if geoip:
+                    geoip.annotate(result['items'], 'client_ip')
+                return jsonify(result)
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+        
+        @self.app.route('/api/clients/<client_ip>/targets', methods=['GET'])
+        def list_client_targets(client_ip):
+            """Get one page of target addresses for a client"""
+            try:
+                result = self.stats_collector.list_targets(
+                    client_ip,
+                    query=request.args.get('q'),
+                    active_only=request.args.get('active', 'false') == 'true',
+                    cursor=request.args.get('cursor'),
+                    **self._page_args('total_bytes')
+                )
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            if result is None:
+                return jsonify({'success': False, 'message': 'Unknown client'}), 404
+            geoip = self.geoip
+            if geoip:
+                geoip.annotate(result['items'], 'ip')
+            return jsonify(result)
+        
+        @self.app.route('/api/connections', methods=['GET'])
+        def list_connections():
+            """Get one page of active connections"""
+            try:
+                result = self.stats_collector.list_connections(
+                    client_ip=request.args.get('client_ip'),
+                    query=request.args.get('q'),
+                    cursor=request.args.get('cursor'),
+                    **self._page_args('start_time')
+                )
+                return jsonify(result)
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+        
+        @self.app.route('/api/stats/history', methods=['GET'])
+        def get_stats_history():
+            """Get persisted traffic aggregated over a time range"""
+            if not self.stats_store:
+                return jsonify({'success': False, 'message': 'Statistics persistence is disabled'}), 400
+            try:
+                self.stats_store.open()
+                rows = self.stats_store.query(
+                    since=request.args.get('since', type=int),
+                    until=request.args.get('until', type=int),
+                    client_ip=request.args.get('client_ip'),
+                    group_by=request.args.get('group_by', 'client'),
+                    limit=request.args.get('limit', 1000, type=int)
+                )
+                return jsonify({'success': True, 'rows': rows})
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+        
+        @self.app.route('/api/geo/clients', methods=['GET'])
+        def get_geo_clients():
+            """Get client traffic grouped by country (?by=country) or ASN (?by=asn)"""
+            return self._geo_page('clients', 'country')
+        
+        @self.app.route('/api/geo/targets', methods=['GET'])
+        def get_geo_targets():
+            """Get target traffic grouped by ASN (?by=asn) or country (?by=country)"""
+            return self._geo_page('targets', 'asn')
+        
+        @self.app.route('/api/geo/lookup/<ip>', methods=['GET'])
+        def get_geo_lookup(ip):
+            """Get country and ASN of an IP address"""
+            geoip = self.geoip
+            if not geoip:
+                return jsonify({'success': False, 'message': 'GeoIP is not configured'}), 400
+            return jsonify(dict(geoip.lookup(ip), ip=ip))
+        
+        @self.app.route('/api/federation/deltas', methods=['GET'])
+        @self._admin_only
+        def get_federation_deltas():
+            """Get stats changes since a generation, pulled by aggregators"""
+            return jsonify(self.federation_source.deltas(
+                since=request.args.get('since', 0, type=int),
+                node=request.args.get('node')))
+        
+        @self.app.route('/api/federation/status', methods=['GET'])
+        def get_federation_status():
+            """Get fleet totals and the state of each peer"""
+            federation = self.federation
+            if not federation:
+                return jsonify({'success': False, 'message': 'No federation peers configured'}), 400
+            return jsonify(federation.get_status())
+        
+        @self.app.route('/api/federation/clients', methods=['GET'])
+        def list_federation_clients():
+            """Get one page of clients merged over all peers"""
+            return self._federation_page('list_clients')
+        
+        @self.app.route('/api/federation/targets', methods=['GET'])
+        def list_federation_targets():
+            """Get one page of targets merged over all peers"""
+            return self._federation_page('list_targets')
+        
+        @self.app.route('/api/admin/profile', methods=['POST'])
+        @self._admin_only
+        def profile_relay():
+            """Profile the relay thread for a while (sample: collapsed stacks, cprofile: pstats)"""
+            server = self.server
+            if not server or not server.is_running():
+                return jsonify({'success': False, 'message': 'Server is not running'}), 400
+            mode = request.args.get('mode', 'sample')
+            duration = request.args.get('duration', 5.0, type=float)
+            try:
+                if mode == 'sample':
+                    result = self.profiler.sample_stacks(
+                        server.server_thread.ident, duration,
+                        interval=request.args.get('interval', 0.005, type=float))
+                    return jsonify(dict(result, success=True))
+                if mode == 'cprofile':
+                    raw = request.args.get('format') == 'pstats'
+                    report = self.profiler.profile_calls(
+                        server.loop_tasks, duration,
+                        sort=request.args.get('sort', 'cumulative'),
+                        limit=request.args.get('limit', 50, type=int),
+                        raw=raw)
+                    if raw:
+                        return Response(report, mimetype='application/octet-stream', headers={
+                            'Content-Disposition': 'attachment; filename=relay.pstats'})
+                    return Response(report, mimetype='text/plain')
+                return jsonify({'success': False, 'message': f'Invalid mode: {mode}'}), 400
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            except RuntimeError as e:
+                return jsonify({'success': False, 'message': str(e)}), 409
+            except TimeoutError as e:
+                return jsonify({'success': False, 'message': str(e)}), 503
+        
+        @self.app.route('/api/admin/memory/start', methods=['POST'])
+        @self._admin_only
+        def start_memory_tracing():
+            """Start tracemalloc and take the baseline snapshot"""
+            status = self.profiler.start_memory_tracing(request.args.get('frames', 10, type=int))
+            return jsonify(dict(status, success=True))
+        
+        @self.app.route('/api/admin/memory/diff', methods=['GET'])
+        @self._admin_only
+        def get_memory_diff():
+            """Get allocation growth since the baseline snapshot"""
+            try:
+                result = self.profiler.memory_diff(
+                    limit=request.args.get('limit', 25, type=int),
+                    group_by=request.args.get('group_by', 'lineno'),
+                    reset=request.args.get('reset') == '1')
+                return jsonify(dict(result, success=True))
+            except ValueError as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            except RuntimeError as e:
+                return jsonify({'success': False, 'message': str(e)}), 409
+        
+        @self.app.route('/api/admin/memory/stop', methods=['POST'])
+        @self._admin_only
+        def stop_memory_tracing():
+            """Stop tracemalloc"""
+            self.profiler.stop_memory_tracing()
+            return jsonify({'success': True, 'message': 'Memory tracing stopped'})
         
         @self.app.route('/api/logs', methods=['GET'])
         def get_logs():
@@ -138,6 +442,134 @@ class WebApp:
                 # Return recent logs (reverse order, newest first)
                 return jsonify({'logs': self.logs[-100:]})  # Return last 100 entries
     
+    def _drain_server(self, server, timeout):
+        """Drain a server and clean up like /api/server/stop (background thread)"""
+        server.drain(timeout)
+        with self.server_lock:
+            if self.server is not server or server.is_running():
+                return  # Stopped through /api/server/stop meanwhile, or another drain owns it
+            self.server = None
+            self._stop_stats_persistence()
+            self.stats_collector.reset()
+    
+    def _is_admin(self):
+        """Check the admin token (X-Admin-Token) of this request, or a loopback client when no token is set"""
+        token = self.config_manager.load().get('admin_token')
+        if token:
+            supplied = request.headers.get('X-Admin-Token', '')
+            return hmac.compare_digest(supplied.encode(), str(token).encode())
+        return request.remote_addr in ('127.0.0.1', '::1')
+    
+    def _admin_only(self, view):
+        """Require the admin token, see _is_admin"""
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self._is_admin():
+                return jsonify({'success': False, 'message': 'Admin access required'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    
+    def _cached(self, key, builder):
+        """Return a recent snapshot or build a new one
+
+        Many dashboards polling at once then cost one snapshot per TTL instead of
+        one per request, which keeps the collector lock free for the relay thread.
+        """
+        now = time.monotonic()
+        with self._stats_cache_lock:
+            cached = self._stats_cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+        payload = builder()
+        with self._stats_cache_lock:
+            cache = self._stats_cache
+            for stale in [stale for stale, (expires, _) in cache.items() if expires <= now]:
+                del cache[stale]
+            while len(cache) >= self.stats_cache_size:
+                del cache[min(cache, key=lambda cached_key: cache[cached_key][0])]
+            cache[key] = (now + self.stats_cache_ttl, payload)
+        return payload
+    
+    def _page_args(self, default_sort):
+        """Parse pagination and sorting query arguments"""
+        limit = request.args.get('limit', 50, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        if limit < 1 or limit > self.max_page_size or offset < 0:
+            raise ValueError(f"limit must be 1-{self.max_page_size} and offset must not be negative")
+        return {
+            'sort': request.args.get('sort', default_sort),
+            'descending': request.args.get('order', 'desc') != 'asc',
+            'offset': offset,
+            'limit': limit,
+        }
+    
+    def _federation_page(self, method):
+        """Serve a paginated fleet list"""
+        federation = self.federation
+        if not federation:
+            return jsonify({'success': False, 'message': 'No federation peers configured'}), 400
+        try:
+            return jsonify(getattr(federation, method)(query=request.args.get('q'),
+                                                       **self._page_args('total_bytes')))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+    
+    def _geo_page(self, kind, default_by):
+        """Serve a page of client or target traffic grouped by country or ASN"""
+        geoip = self.geoip
+        if not geoip:
+            return jsonify({'success': False, 'message': 'GeoIP is not configured'}), 400
+        
+        def snapshot():
+            _, clients, targets = self.stats_collector.snapshot_totals()
+            if kind == 'clients':
+                return clients, None  # Keys are the client IPs
+            return targets, self.stats_collector.get_target_ips()
+        
+        try:
+            totals, ips = self._cached(('geo', kind), snapshot)
+            return jsonify(geoip.group(totals, ips, request.args.get('by', default_by),
+                                       **self._page_args('total_bytes')))
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+    
+    def _configure_geoip(self, config):
+        """Open, replace or close the GeoIP databases when their settings change"""
+        settings = (config.get('geoip_country_db') or '', config.get('geoip_asn_db') or '',
+                    config.get('geoip_cache_size', 65536))
+        if settings == self._geoip_settings:
+            return
+        self._geoip_settings = settings
+        old, geoip = self.geoip, None
+        if settings[0] or settings[1]:
+            try:
+                geoip = GeoLookup(*settings)
+                types = ', '.join(reader.database_type for reader in geoip.readers)
+                self._log_callback(f"GeoIP databases loaded: {types}")
+            except (OSError, ValueError) as e:
+                self._log_callback(f"GeoIP disabled: {e}")
+        self.geoip = geoip
+        if old:
+            old.close()
+    
+    def _configure_federation(self, config):
+        """Start, update or stop pulling stats from federation peers"""
+        peers = config.get('federation_peers') or []
+        settings = {
+            'interval': config.get('federation_interval', 10),
+            'timeout': config.get('federation_timeout', 3),
+            'token': config.get('federation_token', ''),
+        }
+        if peers and self.federation:
+            self.federation.configure(peers, **settings)
+        elif peers:
+            self.federation = Federation(peers, local_source=self.federation_source,
+                                         log_callback=self._log_callback, **settings)
+            self.federation.start()
+        elif self.federation:
+            self.federation.stop()
+            self.federation = None
+    
     def _log_callback(self, message):
         """Log callback for server"""
         import datetime
@@ -154,9 +586,53 @@ class WebApp:
             if len(self.logs) > self.max_logs:
                 self.logs = self.logs[-self.max_logs:]
     
-    def run(self, debug=False):
-        """Run the Flask app"""
-        self.app.run(host=self.host, port=self.port, debug=debug, threaded=True)
+    def _start_stats_persistence(self, config):
+        """Restore persisted counters and start checkpointing"""
+        # A server that died on its own leaves the previous persister running
+        self._stop_stats_persistence()
+        if not config.get('stats_db'):
+            return
+        if not self.stats_store or self.stats_store.db_file != config['stats_db']:
+            if self.stats_store:
+                self.stats_store.close()
+            self.stats_store = StatsStore(config['stats_db'])
+        try:
+            self.stats_persister = StatsPersister(
+                self.stats_collector,
+                self.stats_store,
+                interval=config.get('stats_checkpoint_interval', 30),
+                raw_retention=config.get('stats_raw_retention', 86400),
+                retention_days=config.get('stats_retention_days', 90),
+                log_callback=self._log_callback
+            )
+            self.stats_persister.start()
+        except Exception as e:
+            self.stats_persister = None
+            self._log_callback(f"Statistics persistence disabled: {e}")
+    
+    def _stop_stats_persistence(self):
+        """Write final checkpoint and stop checkpointing"""
+        if self.stats_persister:
+            self.stats_persister.stop()
+            self.stats_persister = None
+    
+    def run(self, debug=False, server='auto', threads=4):
+        """
+        Run the web interface
+        
+        Args:
+            debug: use Flask's debug server (development only)
+            server: 'auto', 'waitress', 'builtin' or 'flask', see web.serving
+            threads: maximum request worker threads
+        """
+        config = self.config_manager.load()
+        self._configure_federation(config)
+        self._configure_geoip(config)
+        if debug:
+            self.app.run(host=self.host, port=self.port, debug=True, threaded=True)
+            return
+        serving.serve(self.app, self.host, self.port, server=server, threads=threads,
+                      log_callback=lambda message: print(f"[WEB] {message}"))
     
     def stop(self):
         """Stop the Flask app and server"""
@@ -164,4 +640,11 @@ class WebApp:
             if self.server and self.server.is_running():
                 self.server.stop()
                 self.server = None
+            self._stop_stats_persistence()
+        if self.federation:
+            self.federation.stop()
+            self.federation = None
+        if self.geoip:
+            self.geoip.close()
+            self.geoip = None
 
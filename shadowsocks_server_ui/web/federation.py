@@ -0,0 +1,394 @@
+"""Stats federation - merges compact stats deltas pulled from peer instances into a fleet view"""
+import json
+import time
+import uuid
+import threading
+import http.client
+from urllib.parse import urlsplit, urlencode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from shadowsocks_server_ui.stats.collector import select_page
+except ImportError:
+    from ..stats.collector import select_page
+
+LOCAL_PEER = 'local'
+
+# Merged entries are [bytes_sent, bytes_received, active_connections, nodes]
+FLEET_SORT_KEYS = {
+    'total_bytes': lambda item: item[1][0] + item[1][1],
+    'bytes_sent': lambda item: item[1][0],
+    'bytes_received': lambda item: item[1][1],
+    'active_connections': lambda item: item[1][2],
+    'nodes': lambda item: item[1][3],
+    'address': lambda item: item[0],
+}
+
+
+def _check_deltas(data):
+    """Check the shape of a peer's deltas response before it is merged (raises ValueError)"""
+    try:
+        valid = (isinstance(data, dict) and isinstance(data['node'], str) and isinstance(data['full'], bool)
+                 and isinstance(data['generation'], int) and isinstance(data['time'], (int, float))
+                 and all(isinstance(data['totals'][key], (int, float)) for key in ('bytes_sent', 'bytes_received'))
+                 and all(isinstance(data[kind], dict) and all(
+                     isinstance(entry, list) and len(entry) == 3
+                     and all(isinstance(value, (int, float)) for value in entry)
+                     for entry in data[kind].values()) for kind in ('clients', 'targets'))
+                 and (data['full'] or all(isinstance(data[kind], list) and all(isinstance(key, str) for key in data[kind])
+                                          for kind in ('removed_clients', 'removed_targets'))))
+    except (KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise ValueError("Malformed deltas response")
+    return data
+
+
+class FederationSource:
+    """
+    Serves stats deltas of the local collector to aggregators
+
+    Snapshots of per-client and per-target totals are numbered. An aggregator
+    sends the node id and generation it last merged and gets only the entries
+    that changed since then, or everything if that generation is no longer
+    kept. The node id is new for every process, so a restarted node always
+    sends a full snapshot.
+    """
+
+    def __init__(self, stats_collector, history=8, min_interval=1.0):
+        """
+        Args:
+            stats_collector: StatsCollector to serve
+            history: snapshots kept to compute deltas from
+            min_interval: seconds a snapshot is reused for further requests
+        """
+        self.stats_collector = stats_collector
+        self.node_id = uuid.uuid4().hex[:12]
+        self.history = history
+        self.min_interval = min_interval
+        self._snapshots = OrderedDict()  # generation -> (clients, targets)
+        self._generation = 0
+        self._totals = {}
+        self._taken = 0.0
+        self._time = 0.0  # Wall clock of the last snapshot, peers' rates are computed from it
+        self._lock = threading.Lock()
+
+    def _snapshot(self):
+        """Take a new snapshot unless the last one is recent (lock held)"""
+        now = time.monotonic()
+        if self._snapshots and now - self._taken < self.min_interval:
+            return
+        self._totals, clients, targets = self.stats_collector.snapshot_totals()
+        self._generation += 1
+        self._snapshots[self._generation] = (clients, targets)
+        self._taken = now
+        self._time = time.time()
+        while len(self._snapshots) > self.history:
+            self._snapshots.popitem(last=False)
+
+    def deltas(self, since=0, node=None):
+        """
+        Get changes since a generation of this node
+
+        Returns:
+            dict: {'node', 'generation', 'full', 'time', 'totals', 'clients', 'targets',
+                'removed_clients', 'removed_targets'}, entries are
+                [bytes_sent, bytes_received, active_connections]
+        """
+        with self._lock:
+            self._snapshot()
+            clients, targets = self._snapshots[self._generation]
+            base = self._snapshots.get(since) if node == self.node_id else None
+            result = {
+                'node': self.node_id,
+                'generation': self._generation,
+                'full': base is None,
+                'time': self._time,
+                'totals': self._totals,
+            }
+        if base is None:
+            result.update(clients=clients, targets=targets, removed_clients=[], removed_targets=[])
+        else:
+            result.update(clients=_changed(base[0], clients), targets=_changed(base[1], targets),
+                          removed_clients=[key for key in base[0] if key not in clients],
+                          removed_targets=[key for key in base[1] if key not in targets])
+        return result
+
+
+def _changed(old, new):
+    """Get entries of `new` that differ from `old`"""
+    return {key: value for key, value in new.items() if old.get(key) != value}
+
+
+class PeerState:
+    """Stats last merged from one peer"""
+
+    def __init__(self, url):
+        self.url = url
+        self.node = None
+        self.generation = 0
+        self.clients = {}  # client_ip -> [bytes_sent, bytes_received, active_connections]
+        self.targets = {}  # target key -> same
+        self.totals = {}
+        self.sample_time = None  # Peer clock at the last merged snapshot
+        self.pulled_at = None  # Local monotonic time of the last successful pull
+        self.rates = (0.0, 0.0)  # bytes/s sent and received between the last two pulls
+        self.latency_ms = None
+        self.error = None
+        self.failures = 0
+        self.connection = None  # Kept-alive HTTP connection, reopened after errors
+
+
+class Federation:
+    """
+    Pulls stats deltas from peer web interfaces and merges them into a fleet view
+
+    Every `interval` seconds all peers are pulled in parallel, each over its
+    own kept-alive HTTP connection with a timeout. A peer that doesn't answer
+    keeps its last merged stats (shown as stale) until it answers again.
+    """
+
+    def __init__(self, peers, interval=10.0, timeout=3.0, token='', local_source=None, log_callback=None):
+        """
+        Args:
+            peers: peer base URLs (http://host:port)
+            token: sent as X-Admin-Token (the peers' admin_token)
+            local_source: FederationSource of this instance, merged as peer 'local'
+        """
+        self.local_source = local_source
+        self.log_callback = log_callback
+        self.peers = {}
+        self._lock = threading.Lock()  # Guards peer states and the merged view
+        self._merged = {}  # 'clients'/'targets' -> merged entries, rebuilt after a pull
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pool = None
+        self.configure(peers, interval, timeout, token)
+
+    def configure(self, peers, interval=10.0, timeout=3.0, token=''):
+        """Set peers and pull settings, keeping the state of peers still listed"""
+        timeout_changed = float(timeout) != getattr(self, 'timeout', None)
+        self.interval = max(1.0, float(interval))
+        self.timeout = float(timeout)
+        self.token = token or ''
+        urls = [str(url).rstrip('/') for url in peers]
+        if self.local_source is not None:
+            urls.insert(0, LOCAL_PEER)
+        with self._lock:
+            for url in list(self.peers):
+                if url not in urls:
+                    self._close_connection(self.peers.pop(url))
+            for url in urls:
+                if url not in self.peers:
+                    self.peers[url] = PeerState(url)
+            self._merged = {}
+        if timeout_changed:
+            # Connections pick up the timeout when they are opened
+            for peer in list(self.peers.values()):
+                self._close_connection(peer)
+
+    def start(self):
+        """Start pulling"""
+        self._stop_event.clear()
+        self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='Federation')
+        self._thread = threading.Thread(target=self._run, daemon=True, name="Federation")
+        self._thread.start()
+
+    def stop(self):
+        """Stop pulling and close peer connections"""
+        self._stop_event.set()
+        if self._thread and self._thread.is_alive():
+            self._thread.join(timeout=self.timeout + 2.0)
+        self._thread = None
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        for peer in list(self.peers.values()):
+            self._close_connection(peer)
+
+    def _run(self):
+        """Pull all peers every interval"""
+        while True:
+            try:
+                self.pull_all()
+            except Exception as e:
+                # Keep pulling: one failure must not stop the fleet view for good
+                if self.log_callback:
+                    self.log_callback(f"Federation pull failed: {e}")
+            if self._stop_event.wait(self.interval):
+                return
+
+    def pull_all(self):
+        """Pull every peer once, in parallel, and wait for the results"""
+        peers = list(self.peers.values())
+        if self._pool is None:
+            for peer in peers:
+                self._pull(peer)
+            return
+        for future in [self._pool.submit(self._pull, peer) for peer in peers]:
+            future.result()
+
+    def _pull(self, peer):
+        """Fetch and merge one peer's deltas"""
+        start = time.monotonic()
+        try:
+            if peer.url == LOCAL_PEER:
+                data = self.local_source.deltas(peer.generation, peer.node)
+            else:
+                data = _check_deltas(self._request(peer))
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self._close_connection(peer)
+            if peer.error is None and self.log_callback:
+                self.log_callback(f"Federation peer {peer.url} unavailable: {e}")
+            peer.error = str(e) or type(e).__name__
+            peer.failures += 1
+            return
+        if peer.error is not None and self.log_callback:
+            self.log_callback(f"Federation peer {peer.url} is back")
+        peer.latency_ms = round((time.monotonic() - start) * 1000, 1)
+        peer.error = None
+        with self._lock:
+            self._merge(peer, data)
+            self._merged = {}
+
+    def _request(self, peer):
+        """GET the peer's deltas, reusing its connection (one retry if a reused one was closed)"""
+        parts = urlsplit(peer.url)
+        query = urlencode({'since': peer.generation, 'node': peer.node or ''})
+        path = f"{parts.path.rstrip('/')}/api/federation/deltas?{query}"
+        headers = {'X-Admin-Token': self.token} if self.token else {}
+        for attempt in (0, 1):
+            reused = peer.connection is not None
+            if not reused:
+                connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                    else http.client.HTTPConnection)
+                peer.connection = connection_class(parts.hostname, parts.port, timeout=self.timeout)
+            try:
+                peer.connection.request('GET', path, headers=headers)
+                response = peer.connection.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._close_connection(peer)
+                if reused and attempt == 0:
+                    continue  # Idle keep-alive connection was closed by the peer
+                raise
+            if response.will_close:
+                self._close_connection(peer)
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}")
+            return json.loads(body)
+
+    @staticmethod
+    def _close_connection(peer):
+        if peer.connection is not None:
+            peer.connection.close()
+            peer.connection = None
+
+    @staticmethod
+    def _merge(peer, data):
+        """Apply a deltas response to the peer's state (lock held)"""
+        restarted = data['node'] != peer.node
+        if data['full']:
+            peer.clients = dict(data['clients'])
+            peer.targets = dict(data['targets'])
+        else:
+            peer.clients.update(data['clients'])
+            peer.targets.update(data['targets'])
+            for key in data['removed_clients']:
+                peer.clients.pop(key, None)
+            for key in data['removed_targets']:
+                peer.targets.pop(key, None)
+        totals = data['totals']
+        if restarted:
+            peer.rates = (0.0, 0.0)
+        elif peer.sample_time and data['time'] > peer.sample_time:
+            elapsed = data['time'] - peer.sample_time
+            # Counters go back when the peer's server is restarted, count that as idle
+            peer.rates = tuple(max(0.0, (totals[key] - peer.totals.get(key, 0)) / elapsed)
+                               for key in ('bytes_sent', 'bytes_received'))
+        peer.node = data['node']
+        peer.generation = data['generation']
+        peer.totals = totals
+        peer.sample_time = data['time']
+        peer.pulled_at = time.monotonic()
+
+    def _fleet(self, kind):
+        """Get entries of all peers merged by key (lock held, cached until the next pull)"""
+        merged = self._merged.get(kind)
+        if merged is None:
+            merged = {}
+            for peer in self.peers.values():
+                for key, (sent, received, active) in getattr(peer, kind).items():
+                    entry = merged.get(key)
+                    if entry is None:
+                        entry = merged[key] = [0, 0, 0, 0]
+                    entry[0] += sent
+                    entry[1] += received
+                    entry[2] += active
+                    entry[3] += 1
+            self._merged[kind] = merged
+        return merged
+
+    def _list(self, kind, key_name, sort, descending, offset, limit, query):
+        if sort not in FLEET_SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        with self._lock:
+            items = self._fleet(kind).items()
+            if query:
+                items = [item for item in items if query in item[0]]
+            page, total = select_page(items, FLEET_SORT_KEYS[sort], descending, offset, limit)
+        result = [{
+            key_name: key,
+            'bytes_sent': sent,
+            'bytes_received': received,
+            'total_bytes': sent + received,
+            'active_connections': active,
+            'nodes': nodes,
+        } for key, (sent, received, active, nodes) in page]
+        next_offset = offset + limit if offset + limit < total else None
+        return {'items': result, 'total': total, 'offset': offset, 'limit': limit, 'next_offset': next_offset}
+
+    def list_clients(self, sort='total_bytes', descending=True, offset=0, limit=50, query=None):
+        """Get one page of clients over all peers (query: client IP substring)"""
+        return self._list('clients', 'client_ip', sort, descending, offset, limit, query)
+
+    def list_targets(self, sort='total_bytes', descending=True, offset=0, limit=50, query=None):
+        """Get one page of target roll-up keys over all peers (query: substring)"""
+        return self._list('targets', 'address', sort, descending, offset, limit, query)
+
+    def get_status(self):
+        """Get per-peer state and fleet totals"""
+        now = time.monotonic()
+        nodes = []
+        fleet = {'active_connections': 0, 'total_connections': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                 'send_rate': 0.0, 'receive_rate': 0.0, 'nodes_up': 0, 'nodes': len(self.peers)}
+        with self._lock:
+            for peer in self.peers.values():
+                totals = peer.totals
+                up = peer.error is None and peer.pulled_at is not None
+                nodes.append({
+                    'url': peer.url,
+                    'node': peer.node,
+                    'up': up,
+                    'error': peer.error,
+                    'failures': peer.failures,
+                    'age': round(now - peer.pulled_at, 1) if peer.pulled_at is not None else None,
+                    'latency_ms': peer.latency_ms,
+                    'active_connections': totals.get('active_connections', 0),
+                    'active_clients': totals.get('active_clients', 0),
+                    'bytes_sent': totals.get('bytes_sent', 0),
+                    'bytes_received': totals.get('bytes_received', 0),
+                    'send_rate': round(peer.rates[0]),
+                    'receive_rate': round(peer.rates[1]),
+                })
+                fleet['nodes_up'] += up
+                for key in ('active_connections', 'total_connections', 'bytes_sent', 'bytes_received'):
+                    fleet[key] += totals.get(key, 0)
+                if up:
+                    fleet['send_rate'] += peer.rates[0]
+                    fleet['receive_rate'] += peer.rates[1]
+            fleet['active_clients'] = sum(1 for entry in self._fleet('clients').values() if entry[2])
+        fleet['send_rate'] = round(fleet['send_rate'])
+        fleet['receive_rate'] = round(fleet['receive_rate'])
+        return {'fleet': fleet, 'nodes': nodes, 'interval': self.interval}
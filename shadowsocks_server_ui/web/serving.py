@@ -0,0 +1,132 @@
+"""WSGI serving - runs the control plane on a bounded worker pool"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+SERVER_CHOICES = ('auto', 'waitress', 'builtin', 'flask')
+# Sent to connections beyond the limit, without reading their request
+BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n'
+                 b'Content-Length: 12\r\nRetry-After: 1\r\nConnection: close\r\n\r\nServer busy\n')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Request handler with a socket timeout so slow clients can't hold a worker"""
+    timeout = 15
+
+    def log_request(self, code='-', size='-'):
+        """Access logging off, the dashboard polls every second"""
+        pass
+
+
+class BoundedWSGIServer(BaseWSGIServer):
+    """Werkzeug server that handles connections on a fixed-size thread pool
+
+    Unlike the threaded development server it never spawns more than
+    `threads` workers, so dashboard polling can't pile up threads that
+    compete with the relay thread for the GIL. At most `connection_limit`
+    connections are served or queued for a worker, later ones get a 503.
+    Werkzeug closes the connection after every response, use waitress for
+    keep-alive.
+    """
+
+    def __init__(self, host, port, app, threads=4, backlog=64, timeout=15, connection_limit=100):
+        handler = type('BoundedRequestHandler', (QuietRequestHandler,), {'timeout': timeout})
+        self.request_queue_size = backlog
+        super().__init__(host, port, app, handler=handler)
+        self._pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='WebWorker')
+        self.connection_limit = max(threads, connection_limit)
+        self._pending = 0  # Connections being served or waiting for a worker
+        self._pending_lock = threading.Lock()
+        self.rejected = 0
+
+    def process_request(self, request, client_address):
+        """Hand the connection to the pool instead of a new thread, or refuse it when the pool is backed up"""
+        with self._pending_lock:
+            accepted = self._pending < self.connection_limit
+            if accepted:
+                self._pending += 1
+            else:
+                self.rejected += 1
+        if not accepted:
+            try:
+                request.sendall(BUSY_RESPONSE)  # Fits the send buffer of a new socket
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            self._pool.submit(self._process_request_in_pool, request, client_address)
+        except RuntimeError:
+            # Pool shut down by server_close
+            self._release()
+            self.shutdown_request(request)
+
+    def _release(self):
+        """Count a connection as finished"""
+        with self._pending_lock:
+            self._pending -= 1
+
+    def _process_request_in_pool(self, request, client_address):
+        """Serve one connection"""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._release()
+
+    def server_close(self):
+        """Stop accepting and wait for workers"""
+        super().server_close()
+        self._pool.shutdown(wait=False)
+
+
+def serve(app, host, port, server='auto', threads=4, backlog=64, keepalive_timeout=15,
+          connection_limit=None, log_callback=None):
+    """
+    Serve a WSGI app until interrupted
+
+    Args:
+        server: 'waitress' (keep-alive, bounded threads), 'builtin' (bounded werkzeug
+            server, no keep-alive), 'flask' (development server) or 'auto'
+            (waitress if installed, otherwise builtin)
+        threads: maximum number of request worker threads
+        backlog: listen backlog for pending connections
+        keepalive_timeout: seconds before an idle connection is closed
+        connection_limit: connections served or waiting for a worker at once
+            (default max(100, 25 per thread)), further ones are refused
+    """
+    if server not in SERVER_CHOICES:
+        raise ValueError(f"Invalid web server: {server}")
+    if server == 'auto':
+        server = 'waitress' if waitress is not None else 'builtin'
+    log = log_callback or logging.info
+    if connection_limit is None:
+        connection_limit = max(100, threads * 25)
+
+    if server == 'waitress':
+        if waitress is None:
+            raise RuntimeError('waitress is not installed (pip install waitress)')
+        log(f"Web interface: waitress, {threads} threads")
+        waitress.serve(app, host=host, port=port, threads=threads, backlog=backlog,
+                       channel_timeout=keepalive_timeout, connection_limit=connection_limit,
+                       ident='shadowsocks-server-ui', _quiet=True)
+    elif server == 'builtin':
+        log(f"Web interface: built-in server, {threads} threads")
+        httpd = BoundedWSGIServer(host, port, app, threads=threads, backlog=backlog,
+                                  timeout=keepalive_timeout, connection_limit=connection_limit)
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+    else:
+        log("Web interface: Flask development server")
+        app.run(host=host, port=port, debug=False, threaded=True)
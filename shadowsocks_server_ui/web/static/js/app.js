@@ -93,8 +93,8 @@ class ShadowsocksUI {
 
             const result = await response.json();
             if (result.success) {
-                this.addLog('Configuration saved successfully', 'success');
-                this.showNotification('Configuration saved', 'success');
+                this.addLog(result.message, 'success');
+                this.showNotification(result.message, 'success');
             } else {
                 this.addLog(`Error: ${result.message}`, 'error');
                 this.showNotification(result.message, 'error');